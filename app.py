@@ -2,8 +2,9 @@
 # Imports
 #----------------------------------------------------------------------------#
 from distutils.log import error
+import hmac
 import json
-import sys
+import math
 import dateutil.parser
 import babel
 from flask import (
@@ -15,7 +16,8 @@ from flask import (
     redirect,
     abort, 
     url_for,
-    jsonify
+    jsonify,
+    stream_with_context
 )
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
@@ -25,9 +27,33 @@ from sqlalchemy import true
 from forms import *
 from flask_wtf import Form
 from flask_migrate import Migrate
-from models import db, Venue, Artist, Show, Genre
+from models import db, Venue, Artist, Show, Genre, TicketTier, TicketHold
+from writes import StaleEditError, TicketsSoldError, update_listing, delete_listing, archive_listing, book_tour, \
+    listing_show_ids, check_no_tickets_sold
+from jobs import enqueue, jobs_cli
+from dashboard import home_dashboard, dashboard_cli
+from areas import venue_areas, bump_area
+from partitions import shows_cli
+from benchmarks import bench_cli
+from geo import location_values, geocode, within, venue_location, geo_cli
+from changes import record_change, changed_values, stream_changes, changes_cli
+from cache import get_or_compute
+from ratelimit import rate_limited
+from typeahead import venue_names, artist_names
+from facets import FACETS, venue_facets, artist_facets, facet_choices
+from readmodels import show_listing, show_summary, venue_search, artist_search
+from sessions import DatabaseSessionInterface, init_secret_key, sessionless, sessions_cli
+from reports import load_reports, reports_cli
+from online_migrations import migrations_cli
+from traffic import init_capture, traffic_cli
+from profiling import init_profiling, profiles_cli
+from calendars import calendar_response, feed_query
+from prerender import pages_cli
+from dedup import likely_duplicates, dedup_cli
+from tickets import SoldOut, show_tiers, hold_tickets, purchase_hold, release_hold, tickets_cli
+from transactions import transactional, run_in_transaction, metrics as transaction_metrics
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime
-import re
 from operator import itemgetter # for sorting lists of tuples
 
 #----------------------------------------------------------------------------#
@@ -38,9 +64,48 @@ app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
 db.init_app(app)
+# SECRET_KEY from the environment, or the one kept in instance/ (created on the first start)
+init_secret_key(app)
+# Sessions (flashed messages) live in the database; the cookie only holds the session id
+app.session_interface = DatabaseSessionInterface()
+# Opt-in request logging for `flask traffic replay` (TRAFFIC_CAPTURE_PATH)
+init_capture(app)
+# Per-request sampling profiles on demand (X-Profile header / flask profiles enable)
+init_profiling(app)
+if app.config['TRUSTED_PROXY_COUNT']:
+    # Behind a load balancer: take the client address (used by the rate limits) from X-Forwarded-For
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_COUNT'])
 
 # connect to a local postgresql database
 migrate = Migrate(app, db)
+# flask jobs work / flask jobs stats
+app.cli.add_command(jobs_cli)
+# flask dashboard refresh
+app.cli.add_command(dashboard_cli)
+# flask shows create-partitions / flask shows archive
+app.cli.add_command(shows_cli)
+# flask bench ...
+app.cli.add_command(bench_cli)
+# flask geo backfill
+app.cli.add_command(geo_cli)
+# flask changes prune
+app.cli.add_command(changes_cli)
+# flask sessions cleanup
+app.cli.add_command(sessions_cli)
+# flask reports refresh / show / snapshot
+app.cli.add_command(reports_cli)
+# flask migrations plan / backfill / status
+app.cli.add_command(migrations_cli)
+# flask traffic replay / summary
+app.cli.add_command(traffic_cli)
+# flask profiles token / enable / disable / list / show / prune
+app.cli.add_command(profiles_cli)
+# flask tickets add-tier / status / expire
+app.cli.add_command(tickets_cli)
+# flask pages build / refresh
+app.cli.add_command(pages_cli)
+# flask dedup scan / merge
+app.cli.add_command(dedup_cli)
 
 #----------------------------------------------------------------------------#
 # Models
@@ -52,7 +117,8 @@ from models import *
 #----------------------------------------------------------------------------#
 
 def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
+  # Read models hand over datetimes; the detail pages still pass strings
+  date = value if isinstance(value, datetime) else dateutil.parser.parse(value)
   if format == 'full':
       format="EEEE MMMM, d, y 'at' h:mma"
   elif format == 'medium':
@@ -67,7 +133,8 @@ app.jinja_env.filters['datetime'] = format_datetime
 
 @app.route('/')
 def index():
-  return render_template('pages/home.html')
+  # Precomputed by a background job (see dashboard.py): one primary-key read, no aggregation
+  return render_template('pages/home.html', dashboard=home_dashboard())
 
 
 #  Venues
@@ -75,57 +142,61 @@ def index():
 
 @app.route('/venues')
 def venues():
-    data = []
-    results = Venue.query.distinct(Venue.city, Venue.state).all()
-    for result in results:
-        city_state_unit = {
-            "city": result.city,
-            "state": result.state
-        }
-        venues = Venue.query.filter_by(city=result.city, state=result.state).all()
-
-        # format each venue
-        formatted_venues = []
-        for venue in venues:
-            formatted_venues.append({
-                "id": venue.id,
-                "name": venue.name,
-                "num_upcoming_shows": len(list(filter(lambda x: x.start_time > datetime.now(), venue.shows)))
-            })
-        
-        city_state_unit["venues"] = formatted_venues
-        data.append(city_state_unit)
-   
-    return render_template('pages/venues.html', areas=data)
+    # Assembled from per-(city, state) fragments that are cached and invalidated one area at a time
+    return render_template('pages/venues.html', areas=venue_areas())
 
 
-@app.route('/venues/search', methods=['POST'])
-def search_venues():
-    search_term = request.form.get('search_term', '')
+def browse_listings(facets, endpoint, kind):
+    # Filters come from the query string (?genre=Jazz&genre=Folk&state=CA&seeking=yes), and every
+    # facet value links to the same page with that value toggled
+    selected = {facet: set(request.args.getlist(facet)) for facet in FACETS if request.args.getlist(facet)}
+    matches, counts = facets.browse(selected)
+    page_size = app.config['FACETS_PAGE_SIZE']
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    def toggled(facet, value):
+        args = {name: sorted(values) for name, values in selected.items()}
+        args[facet] = sorted(set(args.get(facet, ())) ^ {value})
+        return url_for(endpoint, **args)
+
+    def page_url(number):
+        return url_for(endpoint, page=number, **{name: sorted(values) for name, values in selected.items()})
+
+    return render_template('pages/browse.html', kind=kind, endpoint=endpoint, selected=selected,
+                           choices=facet_choices(counts, selected), toggled=toggled, page_url=page_url,
+                           count=len(matches),
+                           results=matches[(page - 1) * page_size:page * page_size], page=page,
+                           pages=max((len(matches) + page_size - 1) // page_size, 1))
+
+
+@app.route('/venues/browse')
+def browse_venues():
+    # Bitmap intersections over an in-memory index instead of SQL joins; see facets.py
+    return browse_listings(venue_facets, 'browse_venues', 'venues')
 
-    # Use filter, not filter_by when doing LIKE search (i=insensitive to case)
-    #implement search on artists with partial string search. Ensure it is case-insensitive.
-    venues = Venue.query.filter(Venue.name.ilike('%' + search_term + '%')).all()
-    #Showcases Each Venues
-    venues_list = []
-    current_time = datetime.now()
-    for venue in venues:
-        venue_shows = Show.query.filter_by(venue_id=venue.id).all()
-        num_upcoming = 0
-        for show in venue_shows:
-            if show.start_time > current_time:
-                num_upcoming += 1
-
-        venues_list.append({
-            "id": venue.id,
-            "name": venue.name,
-            "num_upcoming_shows": num_upcoming 
-        })
-
-    response = {
+
+def normalize_search_term(search_term):
+    # Searches are case-insensitive, so 'Hop', ' hop ' and 'HOP' are the same search
+    return ' '.join(search_term.split()).lower()
+
+
+def find_venues(search_term):
+    # Only the columns the page shows, and the upcoming counts in the same query; see readmodels.py
+    venues = venue_search(search_term)
+    return {
         "count": len(venues),
-        "data": venues_list
+        "data": venues
     }
+
+
+@app.route('/venues/search', methods=['POST'])
+@rate_limited('search')
+def search_venues():
+    search_term = request.form.get('search_term', '')
+    # Repeats within SEARCH_CACHE_TTL are served from the cache, and concurrent
+    # identical searches wait for one query instead of each running it
+    term = normalize_search_term(search_term)
+    response = get_or_compute(f'search-venues:{term}', app.config['SEARCH_CACHE_TTL'], lambda: find_venues(term))
     return render_template('pages/search_venues.html', results=response, search_term=search_term)
 
 
@@ -146,6 +217,16 @@ def show_venue(venue_id):
         past_shows.append(temp_show)
     else:
         upcoming_shows.append(temp_show)
+  # Archived shows (see partitions.py) are no longer in venue.shows but are still part of its history
+  archived = db.session.query(ShowArchive.artist_id, Artist.name, Artist.image_link, ShowArchive.start_time) \
+    .join(Artist, Artist.id == ShowArchive.artist_id).filter(ShowArchive.venue_id == venue_id).all()
+  for artist_id, artist_name, artist_image_link, start_time in archived:
+    past_shows.append({
+        'artist_id': artist_id,
+        'artist_name': artist_name,
+        'artist_image_link': artist_image_link,
+        'start_time': start_time.strftime("%m/%d/%Y, %H:%M")
+    })
 
   data = {
     "id" : venue.id,
@@ -167,6 +248,74 @@ def show_venue(venue_id):
   }
   return render_template('pages/show_venue.html', venue=data)
 
+#  Autocomplete
+#  ----------------------------------------------------------------
+
+def autocomplete_response(names):
+    limit = min(request.args.get('limit', app.config['TYPEAHEAD_LIMIT'], type=int), app.config['TYPEAHEAD_LIMIT'])
+    matches = names.search(request.args.get('q', ''), limit)
+    return jsonify(results=[{"id": id, "name": name} for id, name in matches])
+
+
+@app.route('/venues/autocomplete')
+@sessionless
+@rate_limited('typeahead')
+def autocomplete_venues():
+    # Top name matches for ?q=, served from the in-memory prefix index in typeahead.py
+    return autocomplete_response(venue_names)
+
+
+@app.route('/artists/autocomplete')
+@sessionless
+@rate_limited('typeahead')
+def autocomplete_artists():
+    return autocomplete_response(artist_names)
+
+#  Nearby
+#  ----------------------------------------------------------------
+
+def requested_radius(default):
+  # Bigger circles cover more geohash cells than are worth scanning; inf or nan can't be searched at all
+  km = request.args.get('km', default, type=float)
+  if not math.isfinite(km) or km <= 0:
+    abort(400)
+  return min(km, app.config['GEO_MAX_RADIUS_KM'])
+
+def checked_point(point):
+  if not point or None in point:
+    abort(404)
+  lat, lon = point
+  if not (math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180):
+    abort(400)
+  return lat, lon
+
+def proximity_response(results):
+  return jsonify([
+    {"id": id, "name": name, "city": city, "state": state, "distance_km": distance}
+    for id, name, city, state, distance in results
+  ])
+
+@app.route('/venues/near')
+@sessionless
+def venues_near():
+  # /venues/near?venue_id=1&km=25, ?city=Oakland&state=CA&km=25 or ?lat=37.8&lon=-122.3&km=25
+  km = requested_radius(25)
+  if request.args.get('venue_id'):
+    point = venue_location(request.args.get('venue_id', type=int))
+  elif request.args.get('state'):
+    point = geocode(request.args.get('city', ''), request.args['state'])
+  else:
+    point = (request.args.get('lat', type=float), request.args.get('lon', type=float))
+  lat, lon = checked_point(point)
+  return proximity_response(within(Venue, lat, lon, km))
+
+@app.route('/venues/<int:venue_id>/artists/near')
+@sessionless
+def artists_near_venue(venue_id):
+  km = requested_radius(50)
+  lat, lon = checked_point(venue_location(venue_id))
+  return proximity_response(within(Artist, lat, lon, km))
+
 #  Create Venue
 #  ----------------------------------------------------------------
 
@@ -180,32 +329,26 @@ def create_venue_form():
 def create_venue_submission():
     form = VenueForm()
 
-    name = form.name.data.strip()
-    city = form.city.data.strip()
-    state = form.state.data
-    address = form.address.data.strip()
-    phone = form.phone.data
-    #Strip anything from phone that isn't a number
-    phone = re.sub('\D', '', phone) 
-    genres = form.genres.data
-    seeking_talent = True if form.seeking_talent.data == 'Yes' else False
-    seeking_description = form.seeking_description.data.strip()
-    image_link = form.image_link.data.strip()
-    website = form.website.data.strip()
-    facebook_link = form.facebook_link.data.strip()
-    
+    # Validate first: an invalid post is turned away before any field is read or normalized
     if not form.validate():
         flash( form.errors )
         return redirect(url_for('create_venue_submission'))
 
     else:
-        error_in_insert = False
-
-        try:
+        values = form.listing_values()
+        # Same phone, or a similar name in the same city: show the match instead of listing it twice
+        duplicates = [] if form.confirm_duplicate.data else likely_duplicates(Venue, values)
+        if duplicates:
+            flash('Venue ' + values['name'] + ' may already be listed. Check the listings below, or confirm it is a different venue.')
+            return render_template('forms/new_venue.html', form=form, duplicates=duplicates)
+        values.update(location_values(values['city'], values['state']))
+        genres = form.genres.data                   # ['Alternative', 'Classical', 'Country']
+
+        # Committed, or rolled back and retried on a transient conflict; see transactions.py
+        @transactional('create_venue')
+        def save():
             # creates the new venue with all fields but not genre yet
-            new_venue = Venue(name=name, city=city, state=state, address=address, phone=phone, \
-                seeking_talent=seeking_talent, seeking_description=seeking_description, image_link=image_link, \
-                website=website, facebook_link=facebook_link)
+            new_venue = Venue(**values)
             # adding genres and taking a list of string
             for genre in genres:
                 # fetch_genre = session.query(Genre).filter_by(name=genre).one_or_none()  # Throws an exception if more than one returned, returns None if none
@@ -220,20 +363,18 @@ def create_venue_submission():
                     db.session.add(new_genre)
                     new_venue.genres.append(new_genre)  # Create a new Genre item and append it
             db.session.add(new_venue)
-            db.session.commit()
-        except Exception as e:
-            error_in_insert = True
-            print(f'Exception "{e}" in create_venue_submission()')
-            db.session.rollback()
-        finally:
-            db.session.close()
-        if not error_in_insert:
-            flash('Venue ' + request.form['name'] + ' was successfully listed!')
-            return redirect(url_for('index'))
-        else:
-            flash('An error occurred. Venue ' + name + ' could not be listed.')
-            print("Error in create_venue_submission()")
+            db.session.flush()
+            bump_area(values['city'], values['state'])
+            record_change('venue', new_venue.id, 'create', genres=genres, **values)
+
+        try:
+            save()
+        except Exception:
+            app.logger.exception('Error in create_venue_submission()')
+            flash('An error occurred. Venue ' + values['name'] + ' could not be listed.')
             abort(500)
+        flash('Venue ' + request.form['name'] + ' was successfully listed!')
+        return redirect(url_for('index'))
 
 
 
@@ -241,35 +382,28 @@ def create_venue_submission():
 #  ----------------------------------------------------------------
 @app.route('/artists')
 def artists():
-  artists = db.session.query(Artist.id, Artist.name).all()
+  artists = db.session.query(Artist.id, Artist.name).filter(Artist.archived_at.is_(None)).all()
   return render_template('pages/artists.html', artists=artists)
 
-@app.route('/artists/search', methods=['POST'])
-def search_artists():
-    search_term = request.form.get('search_term', '')
-    artists = Artist.query.filter(
-        Artist.name.ilike(f"%{search_term}%") |
-        Artist.city.ilike(f"%{search_term}%") |
-        Artist.state.ilike(f"%{search_term}%")
-    ).all()
-    response = {
+@app.route('/artists/browse')
+def browse_artists():
+    return browse_listings(artist_facets, 'browse_artists', 'artists')
+
+def find_artists(search_term):
+    artists = artist_search(search_term)
+    return {
         "count": len(artists),
-        "data": []
+        "data": artists
     }
 
-    for artist in artists:
-        temp = {}
-        temp["name"] = artist.name
-        temp["id"] = artist.id
-
-        upcoming_shows = 0
-        for show in artist.shows:
-            if show.start_time > datetime.now():
-                upcoming_shows = upcoming_shows + 1
-        temp["upcoming_shows"] = upcoming_shows
-
-        response["data"].append(temp)
 
+@app.route('/artists/search', methods=['POST'])
+@rate_limited('search')
+def search_artists():
+    search_term = request.form.get('search_term', '')
+    # Cached and coalesced like search_venues()
+    term = normalize_search_term(search_term)
+    response = get_or_compute(f'search-artists:{term}', app.config['SEARCH_CACHE_TTL'], lambda: find_artists(term))
     return render_template('pages/search_artists.html', results=response, search_term=search_term)
 
 @app.route('/artists/<int:artist_id>')
@@ -288,6 +422,16 @@ def show_artist(artist_id):
         past_shows.append(temp_show)
     else:
         upcoming_shows.append(temp_show)
+  # Archived shows (see partitions.py) are no longer in artist.shows but are still part of its history
+  archived = db.session.query(ShowArchive.venue_id, Venue.name, Venue.image_link, ShowArchive.start_time) \
+    .join(Venue, Venue.id == ShowArchive.venue_id).filter(ShowArchive.artist_id == artist_id).all()
+  for venue_id, venue_name, venue_image_link, start_time in archived:
+    past_shows.append({
+        'venue_id': venue_id,
+        'venue_name': venue_name,
+        'venue_image_link': venue_image_link,
+        'start_time': start_time.strftime("%m/%d/%Y, %H:%M")
+    })
 
   data = {
     "id" : artist.id,
@@ -350,87 +494,36 @@ def edit_artist_submission(artist_id):
     # Much of this code from edit_venue_submission()
     form = ArtistForm(request.form)
 
-    name = form.name.data.strip()
-    city = form.city.data.strip()
-    state = form.state.data
-    # address = form.address.data.strip()
-    phone = form.phone.data
-    # Normalize DB.  Strip anything from phone that isn't a number
-    phone = re.sub('\D', '', phone) # e.g. (819) 392-1234 --> 8193921234
-    genres = form.genres.data                   # ['Alternative', 'Classical', 'Country']
-    seeking_venue = True if form.seeking_venue.data == 'Yes' else False
-    seeking_description = form.seeking_description.data.strip()
-    image_link = form.image_link.data.strip()
-    website = form.website.data.strip()
-    facebook_link = form.facebook_link.data.strip()
-    
-    # Redirect back to form if errors in form validation
+    # Validate first: an invalid post is turned away before any field is read or normalized
     if not form.validate():
         flash( form.errors )
         return redirect(url_for('edit_artist_submission', artist_id=artist_id))
 
     else:
-        error_in_update = False
+        values = form.listing_values()
+        values.update(location_values(values['city'], values['state']))
+        genres = form.genres.data                   # ['Alternative', 'Classical', 'Country']
+        version = form.version.data
+
+        # Write only what changed; see writes.update_listing()
+        @transactional('edit_artist')
+        def save():
+            previous = update_listing(Artist, artist_genre_table, 'artist_id', artist_id, version, values, genres)
+            if previous:
+                record_change('artist', artist_id, 'update', genres=genres, **changed_values(previous, values))
 
-        # Insert form data into DB
         try:
-            # First get the existing artist object
-            artist = Artist.query.get(artist_id)
-            # artist = Artist.query.filter_by(id=artist_id).one_or_none()
-
-            # Update fields
-            artist.name = name
-            artist.city = city
-            artist.state = state
-            # artist.address = address
-            artist.phone = phone
-
-            artist.seeking_venue = seeking_venue
-            artist.seeking_description = seeking_description
-            artist.image_link = image_link
-            artist.website = website
-            artist.facebook_link = facebook_link
-
-            # First we need to clear (delete) all the existing genres off the artist otherwise it just adds them
-            
-            # For some reason this didn't work! Probably has to do with flushing/lazy, etc.
-            # for genre in artist.genres:
-            #     artist.genres.remove(genre)
-                        
-            # artist.genres.clear()  # Either of these work.
-            artist.genres = []
-            
-            # genres can't take a list of strings, it needs to be assigned to db objects
-            # genres from the form is like: ['Alternative', 'Classical', 'Country']
-            for genre in genres:
-                fetch_genre = Genre.query.filter_by(name=genre).one_or_none()  # Throws an exception if more than one returned, returns None if none
-                if fetch_genre:
-                    # if found a genre, append it to the list
-                    artist.genres.append(fetch_genre)
-
-                else:
-                    # fetch_genre was None. It's not created yet, so create it
-                    new_genre = Genre(name=genre)
-                    db.session.add(new_genre)
-                    artist.genres.append(new_genre)  # Create a new Genre item and append it
-
-            # Attempt to save everything
-            db.session.commit()
-        except Exception as e:
-            error_in_update = True
-            print(f'Exception "{e}" in edit_artist_submission()')
-            db.session.rollback()
-        finally:
-            db.session.close()
-
-        if not error_in_update:
-            # on successful db update, flash success
-            flash('Artist ' + request.form['name'] + ' was successfully updated!')
-            return redirect(url_for('show_artist', artist_id=artist_id))
-        else:
-            flash('An error occurred. Artist ' + name + ' could not be updated.')
-            print("Error in edit_artist_submission()")
+            save()
+        except StaleEditError:
+            flash('Artist ' + values['name'] + ' was changed by someone else. Please review and submit your edit again.')
+            return redirect(url_for('edit_artist', artist_id=artist_id))
+        except Exception:
+            app.logger.exception('Error in edit_artist_submission()')
+            flash('An error occurred. Artist ' + values['name'] + ' could not be updated.')
             abort(500)
+        # on successful db update, flash success
+        flash('Artist ' + request.form['name'] + ' was successfully updated!')
+        return redirect(url_for('show_artist', artist_id=artist_id))
 
 
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
@@ -474,98 +567,73 @@ def edit_venue_submission(venue_id):
     # Much of this code same as /venue/create view.
     form = VenueForm(request.form)
 
-    name = form.name.data.strip()
-    city = form.city.data.strip()
-    state = form.state.data
-    address = form.address.data.strip()
-    phone = form.phone.data
-    # Normalize DB.  Strip anything from phone that isn't a number
-    phone = re.sub('\D', '', phone) # e.g. (819) 392-1234 --> 8193921234
-    genres = form.genres.data                   # ['Alternative', 'Classical', 'Country']
-    seeking_talent = True if form.seeking_talent.data == 'Yes' else False
-    seeking_description = form.seeking_description.data.strip()
-    image_link = form.image_link.data.strip()
-    website = form.website.data.strip()
-    facebook_link = form.facebook_link.data.strip()
-    
-    # Redirect back to form if errors in form validation
+    # Validate first: an invalid post is turned away before any field is read or normalized
     if not form.validate():
         flash( form.errors )
         return redirect(url_for('edit_venue_submission', venue_id=venue_id))
 
     else:
-        error_in_update = False
+        values = form.listing_values()
+        values.update(location_values(values['city'], values['state']))
+        genres = form.genres.data                   # ['Alternative', 'Classical', 'Country']
+        version = form.version.data
+
+        # Write only what changed; see writes.update_listing()
+        @transactional('edit_venue')
+        def save():
+            previous = update_listing(Venue, venue_genre_table, 'venue_id', venue_id, version, values, genres)
+            if previous:
+                # Only the area(s) this venue was and is in need rebuilding
+                for area in {(previous.city, previous.state), (values['city'], values['state'])}:
+                    bump_area(*area)
+                record_change('venue', venue_id, 'update', genres=genres, **changed_values(previous, values))
 
         try:
-            # First get the existing venue object
-            venue = Venue.query.get(venue_id)
-
-            # Update fields
-            venue.name = name
-            venue.city = city
-            venue.state = state
-            venue.address = address
-            venue.phone = phone
-
-            venue.seeking_talent = seeking_talent
-            venue.seeking_description = seeking_description
-            venue.image_link = image_link
-            venue.website = website
-            venue.facebook_link = facebook_link
-
-            # First we need to clear (delete) all the existing genres off the venue otherwise it just adds them
-            
-            # For some reason this didn't work! Probably has to do with flushing/lazy, etc.
-            # for genre in venue.genres:
-            #     venue.genres.remove(genre)
-                        
-            # venue.genres.clear()  # Either of these work.
-            venue.genres = []
-            
-            # genres can't take a list of strings, it needs to be assigned to db objects
-            # genres from the form is like: ['Alternative', 'Classical', 'Country']
-            for genre in genres:
-                fetch_genre = Genre.query.filter_by(name=genre).one_or_none()  # Throws an exception if more than one returned, returns None if none
-                if fetch_genre:
-                    # if found a genre, append it to the list
-                    venue.genres.append(fetch_genre)
-
-                else:
-                    # fetch_genre was None. It's not created yet, so create it
-                    new_genre = Genre(name=genre)
-                    db.session.add(new_genre)
-                    venue.genres.append(new_genre)  # Create a new Genre item and append it
-
-            db.session.commit()
-        except Exception as e:
-            error_in_update = True
-            print(f'Exception "{e}" in edit_venue_submission()')
-            db.session.rollback()
-        finally:
-            db.session.close()
-
-        if not error_in_update:
-            flash('Venue ' + request.form['name'] + ' was successfully updated!')
-            return redirect(url_for('show_venue', venue_id=venue_id))
-        else:
-            flash('An error occurred. Venue ' + name + ' could not be updated.')
-            print("Error in edit_venue_submission()")
+            save()
+        except StaleEditError:
+            flash('Venue ' + values['name'] + ' was changed by someone else. Please review and submit your edit again.')
+            return redirect(url_for('edit_venue', venue_id=venue_id))
+        except Exception:
+            app.logger.exception('Error in edit_venue_submission()')
+            flash('An error occurred. Venue ' + values['name'] + ' could not be updated.')
             abort(500)
+        flash('Venue ' + request.form['name'] + ' was successfully updated!')
+        return redirect(url_for('show_venue', venue_id=venue_id))
 #  Delete
 #  ----------------------------------------------------------------
 @app.route("/venues/<venue_id>/delete", methods={"GET"})
 def delete_venue(venue_id):
+    mode = request.args.get('mode', app.config['LISTING_DELETE_MODE'])
+
+    @transactional('delete_venue')
+    def remove():
+        venue = db.session.query(Venue.name, Venue.city, Venue.state).filter_by(id=venue_id).one_or_none()
+        if venue is None:
+            raise LookupError(f'No venue {venue_id}')
+        purge_later = mode != 'archive' and \
+            Show.query.filter_by(venue_id=venue_id).count() > app.config['LISTING_DELETE_BACKGROUND_THRESHOLD']
+        if mode == 'archive':
+            archive_listing(Venue, venue_id)
+        elif purge_later:
+            # Too much history to delete inside the request: hide it now, a background job deletes it
+            check_no_tickets_sold(listing_show_ids('venue_id', venue_id))
+            archive_listing(Venue, venue_id)
+            enqueue('purge_listing', kind='Venue', obj_id=int(venue_id))
+        else:
+            delete_listing(Venue, venue_genre_table, 'venue_id', venue_id)
+        # The purge job records the 'delete' of a background delete once it's done
+        record_change('venue', venue_id, 'archive' if mode == 'archive' or purge_later else 'delete')
+        bump_area(venue.city, venue.state)
+        return venue.name
+
     try:
-        venue = Venue.query.get(venue_id)
-        db.session.delete(venue)
-        db.session.commit()
-        flash("Venue " + venue.name + " was deleted successfully!")
-    except:
-        db.session.rollback()
-        print(sys.exc_info())
+        name = remove()
+        flash("Venue " + name + (" was archived successfully!" if mode == 'archive' else " was deleted successfully!"))
+    except TicketsSoldError:
+        flash("Venue has shows with sold tickets and can't be deleted; archive it instead.")
+    except Exception:
+        app.logger.exception('Error in delete_venue()')
         flash("Venue was not deleted successfully.")
-    finally:
-        db.session.close()
 
     return redirect(url_for("index"))
 #  Create Artist
@@ -581,34 +649,26 @@ def create_artist_submission():
     # Much of this code is similar to create_venue view
     form = ArtistForm(request.form)
 
-    name = form.name.data.strip()
-    city = form.city.data.strip()
-    state = form.state.data
-    # address = form.address.data.strip()
-    phone = form.phone.data
-    # Normalize DB.  Strip anything from phone that isn't a number
-    phone = re.sub('\D', '', phone) # e.g. (819) 392-1234 --> 8193921234
-    genres = form.genres.data                   # ['Alternative', 'Classical', 'Country']
-    seeking_venue = True if form.seeking_venue.data == 'Yes' else False
-    seeking_description = form.seeking_description.data.strip()
-    image_link = form.image_link.data.strip()
-    website = form.website.data.strip()
-    facebook_link = form.facebook_link.data.strip()
-    
-    # Redirect back to form if errors in form validation
+    # Validate first: an invalid post is turned away before any field is read or normalized
     if not form.validate():
         flash( form.errors )
         return redirect(url_for('create_artist_submission'))
 
     else:
-        error_in_insert = False
+        values = form.listing_values()
+        # Same phone, or a similar name in the same city: show the match instead of listing it twice
+        duplicates = [] if form.confirm_duplicate.data else likely_duplicates(Artist, values)
+        if duplicates:
+            flash('Artist ' + values['name'] + ' may already be listed. Check the listings below, or confirm it is a different artist.')
+            return render_template('forms/new_artist.html', form=form, duplicates=duplicates)
+        values.update(location_values(values['city'], values['state']))
+        genres = form.genres.data                   # ['Alternative', 'Classical', 'Country']
 
         # Insert form data into DB
-        try:
+        @transactional('create_artist')
+        def save():
             # creates the new artist with all fields but not genre yet
-            new_artist = Artist(name=name, city=city, state=state, phone=phone, \
-                seeking_venue=seeking_venue, seeking_description=seeking_description, image_link=image_link, \
-                website=website, facebook_link=facebook_link)
+            new_artist = Artist(**values)
             # genres can't take a list of strings, it needs to be assigned to db objects
             # genres from the form is like: ['Alternative', 'Classical', 'Country']
             for genre in genres:
@@ -625,37 +685,52 @@ def create_artist_submission():
                     new_artist.genres.append(new_genre)  # Create a new Genre item and append it
 
             db.session.add(new_artist)
-            db.session.commit()
-        except Exception as e:
-            error_in_insert = True
-            print(f'Exception "{e}" in create_artist_submission()')
-            db.session.rollback()
-        finally:
-            db.session.close()
-
-        if not error_in_insert:
-            # on successful db insert, flash success
-            flash('Artist ' + request.form['name'] + ' was successfully listed!')
-            return redirect(url_for('index'))
-        else:
-            flash('An error occurred. Artist ' + name + ' could not be listed.')
-            print("Error in create_artist_submission()")
+            db.session.flush()
+            record_change('artist', new_artist.id, 'create', genres=genres, **values)
+
+        try:
+            save()
+        except Exception:
+            app.logger.exception('Error in create_artist_submission()')
+            flash('An error occurred. Artist ' + values['name'] + ' could not be listed.')
             abort(500)
+        # on successful db insert, flash success
+        flash('Artist ' + request.form['name'] + ' was successfully listed!')
+        return redirect(url_for('index'))
 
 #Delete Artist
 @app.route("/artists/<artist_id>/delete", methods=["GET"])
 def delete_artist(artist_id):
+    mode = request.args.get('mode', app.config['LISTING_DELETE_MODE'])
+
+    @transactional('delete_artist')
+    def remove():
+        name = db.session.query(Artist.name).filter_by(id=artist_id).scalar()
+        if name is None:
+            raise LookupError(f'No artist {artist_id}')
+        purge_later = mode != 'archive' and \
+            Show.query.filter_by(artist_id=artist_id).count() > app.config['LISTING_DELETE_BACKGROUND_THRESHOLD']
+        if mode == 'archive':
+            archive_listing(Artist, artist_id)
+        elif purge_later:
+            # Too much history to delete inside the request: hide it now, a background job deletes it
+            check_no_tickets_sold(listing_show_ids('artist_id', artist_id))
+            archive_listing(Artist, artist_id)
+            enqueue('purge_listing', kind='Artist', obj_id=int(artist_id))
+        else:
+            delete_listing(Artist, artist_genre_table, 'artist_id', artist_id)
+        # The purge job records the 'delete' of a background delete once it's done
+        record_change('artist', artist_id, 'archive' if mode == 'archive' or purge_later else 'delete')
+        return name
+
     try:
-        artist = Artist.query.get(artist_id)
-        db.session.delete(artist)
-        db.session.commit()
-        flash("Artist " + artist.name+ " was deleted successfully!")
-    except:
-        db.session.rollback()
-        print(sys.exc_info())
+        name = remove()
+        flash("Artist " + name + (" was archived successfully!" if mode == 'archive' else " was deleted successfully!"))
+    except TicketsSoldError:
+        flash("Artist has shows with sold tickets and can't be deleted; archive it instead.")
+    except Exception:
+        app.logger.exception('Error in delete_artist()')
         flash("Artist was not deleted successfully.")
-    finally:
-        db.session.close()
 
     return redirect(url_for("index"))
 
@@ -665,21 +740,8 @@ def delete_artist(artist_id):
 
 @app.route('/shows')
 def shows():
-    data = []
-
-    shows = Show.query.all()
-    for show in shows:
-        temp = {}
-        temp["venue_id"] = show.venue.id
-        temp["venue_name"] = show.venue.name
-        temp["artist_id"] = show.artist.id
-        temp["artist_name"] = show.artist.name
-        temp["artist_image_link"] = show.artist.image_link
-        temp["start_time"] = show.start_time.strftime("%m/%d/%Y, %H:%M:%S")
-        
-        data.append(temp)
-    
-    return render_template('pages/shows.html', shows=data)
+    # Column tuples instead of Show entities plus their venue and artist; see readmodels.py
+    return render_template('pages/shows.html', shows=show_listing())
 
 
 @app.route('/shows/create')
@@ -696,35 +758,217 @@ def create_show_submission():
     venue_id = form.venue_id.data.strip()
     start_time = form.start_time.data
 
-    error_in_insert = False
-    try:
+    @transactional('create_show')
+    def save():
       new_show = Show(
                 artist_id=artist_id,
                 venue_id=venue_id,
                 start_time=start_time
       )
-      db.session.add(new_show)      
-      db.session.commit()
+      db.session.add(new_show)
+      # The venue's upcoming show count is part of its area fragment on /venues
+      area = db.session.query(Venue.city, Venue.state).filter_by(id=venue_id).one()
+      bump_area(area.city, area.state)
+      db.session.flush()
+      record_change('show', new_show.id, 'create', artist_id=int(artist_id), venue_id=int(venue_id), start_time=start_time)
+
+    try:
+      save()
+      flash('Show was successfully listed')
     except Exception:
-      error_in_insert =True
-      print(sys.exc_info())
-      flash('Show was not successfully listed.')
-      db.session.rollback()
-    finally:
-      db.session.close()
-    if error_in_insert: 
+      app.logger.exception('Error in create_show_submission()')
       flash('Error Occcured, Show was not successfully listed.')
-    else:
-      flash('Show was successfully listed')
 
     return render_template('pages/home.html')
 
   
 
+#  Tours
+#  ----------------------------------------------------------------
+
+@app.route('/shows/tour', methods=['GET'])
+def create_tour_form():
+  form = TourForm()
+  return render_template('forms/new_tour.html', form=form)
+
+@app.route('/shows/tour', methods=['POST'])
+def create_tour_submission():
+    form = TourForm(request.form)
+
+    if not form.validate():
+        flash( form.errors )
+        return redirect(url_for('create_tour_form'))
+
+    artist_id = form.artist_id.data
+    all_or_nothing = form.all_or_nothing.data == 'Yes'
+    stops, unreadable = form.parsed_stops()
+    if len(stops) + len(unreadable) > app.config['TOUR_MAX_STOPS']:
+        flash(f"A tour can have at most {app.config['TOUR_MAX_STOPS']} dates.")
+        return redirect(url_for('create_tour_form'))
+
+    # The clash check and the INSERT must see the same shows: under SERIALIZABLE a concurrent
+    # booking of the same dates makes one of the two fail, and it is retried against the other
+    @transactional('book_tour', isolation='SERIALIZABLE')
+    def book():
+        if db.session.query(Artist.id).filter_by(id=artist_id, archived_at=None).scalar() is None:
+            raise LookupError(f'No artist {artist_id}')
+        # Existence and clashes are checked for the whole tour at once, then one multi-row INSERT.
+        # Unreadable lines still get every other date checked, so they can all be fixed in one go
+        return book_tour(artist_id, stops, all_or_nothing, dry_run=bool(unreadable and all_or_nothing))
+
+    try:
+        booked, rejected = book()
+    except Exception:
+        app.logger.exception('Error in create_tour_submission()')
+        flash('An error occurred. The tour could not be booked.')
+        return redirect(url_for('create_tour_form'))
+    for line, reason in sorted(unreadable + rejected):
+        flash(f'Line {line}: {reason}')
+    flash(f'{len(booked)} of {len(stops) + len(unreadable)} tour dates were booked.')
+    if not booked:
+        return redirect(url_for('create_tour_form'))
+    return redirect(url_for('show_artist', artist_id=artist_id))
+
+
+#  Calendar feeds
+#  ----------------------------------------------------------------
+
+@app.route('/artists/<int:artist_id>/shows.ics')
+@sessionless
+def artist_calendar(artist_id):
+    # Answered with a 304 until something changes; see calendars.py
+    def describe():
+        name = db.session.query(Artist.name).filter_by(id=artist_id, archived_at=None).scalar()
+        return name and (f'{name} shows', feed_query(artist_id=artist_id))
+    return calendar_response(describe)
+
+@app.route('/venues/<int:venue_id>/shows.ics')
+@sessionless
+def venue_calendar(venue_id):
+    def describe():
+        name = db.session.query(Venue.name).filter_by(id=venue_id, archived_at=None).scalar()
+        return name and (f'Shows at {name}', feed_query(venue_id=venue_id))
+    return calendar_response(describe)
+
+@app.route('/cities/<state>/<city>/shows.ics')
+@sessionless
+def city_calendar(state, city):
+    def describe():
+        if db.session.query(Venue.id).filter_by(city=city, state=state, archived_at=None).first() is None:
+            return None
+        return f'Shows in {city}, {state}', feed_query(city=city, state=state)
+    return calendar_response(describe)
+
+#  Tickets
+#  ----------------------------------------------------------------
+
+@app.route('/shows/<int:show_id>/tickets')
+def show_tickets(show_id):
+    show = show_summary(show_id)
+    if show is None:
+        abort(404)
+    return render_template('pages/tickets.html', show=show, tiers=show_tiers(show_id), form=HoldForm(),
+                           max_per_hold=app.config['TICKET_MAX_PER_HOLD'])
+
+@app.route('/shows/<int:show_id>/tickets', methods=['POST'])
+@rate_limited('tickets')
+def hold_show_tickets(show_id):
+    form = HoldForm(request.form)
+    if not form.validate() or form.quantity.data > app.config['TICKET_MAX_PER_HOLD']:
+        flash(f"Pick between 1 and {app.config['TICKET_MAX_PER_HOLD']} tickets.")
+        return redirect(url_for('show_tickets', show_id=show_id))
+
+    if db.session.query(TicketTier.id).filter_by(id=form.tier_id.data, show_id=show_id).scalar() is None:
+        abort(404)
+
+    @transactional('hold_tickets')
+    def hold():
+        # Takes the seats out of stock right away; see tickets.py
+        return hold_tickets(form.tier_id.data, form.quantity.data)
+
+    try:
+        hold_id = hold()
+    except SoldOut:
+        flash('Not enough tickets left.')
+        return redirect(url_for('show_tickets', show_id=show_id))
+    except Exception:
+        app.logger.exception('Error in hold_show_tickets()')
+        flash('An error occurred. The tickets could not be held.')
+        return redirect(url_for('show_tickets', show_id=show_id))
+    return redirect(url_for('ticket_hold', hold_id=hold_id))
+
+@app.route('/tickets/<hold_id>')
+def ticket_hold(hold_id):
+    hold = db.session.query(TicketHold.id, TicketHold.quantity, TicketHold.status, TicketHold.expires_at,
+                            TicketHold.purchased_at, TicketTier.show_id, TicketTier.name.label('tier_name'),
+                            TicketTier.price_cents) \
+        .join(TicketTier, TicketTier.id == TicketHold.tier_id).filter(TicketHold.id == hold_id).first()
+    if hold is None:
+        abort(404)
+    return render_template('pages/hold.html', hold=hold, form=TicketActionForm())
+
+@app.route('/tickets/<hold_id>/purchase', methods=['POST'])
+def purchase_tickets(hold_id):
+    if not TicketActionForm(request.form).validate():
+        abort(400)
+    purchased = False
+    try:
+        purchased = run_in_transaction('purchase_tickets', lambda: purchase_hold(hold_id))
+    except Exception:
+        app.logger.exception('Error in purchase_tickets()')
+    flash('Enjoy the show!' if purchased else 'The hold had run out; the tickets are back on sale.')
+    return redirect(url_for('ticket_hold', hold_id=hold_id))
+
+@app.route('/tickets/<hold_id>/release', methods=['POST'])
+def release_tickets(hold_id):
+    if not TicketActionForm(request.form).validate():
+        abort(400)
+    try:
+        run_in_transaction('release_tickets', lambda: release_hold(hold_id))
+    except Exception:
+        app.logger.exception('Error in release_tickets()')
+    return redirect(url_for('ticket_hold', hold_id=hold_id))
+
+#  Reports
+#  ----------------------------------------------------------------
+
+@app.route('/reports')
+def reports():
+    # Built in the background by reports.refresh_reports(); this only reads the stored result
+    data, refreshed_at = load_reports()
+    return render_template('pages/reports.html', reports=data, refreshed_at=refreshed_at)
+
+#  Change feed
+#  ----------------------------------------------------------------
+
+@app.route('/changes')
+@sessionless
+def changes():
+    # JSON lines in commit order; pass the id (feed position) of the last line back as ?since= to resume
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', app.config['CHANGE_FEED_MAX_EVENTS'], type=int),
+                app.config['CHANGE_FEED_MAX_EVENTS'])
+    return Response(stream_with_context(stream_changes(since, limit)), mimetype='application/x-ndjson')
+
+
+@app.route('/metrics/transactions')
+@sessionless
+def transactions_metrics():
+    # Commits, retries and conflicts per unit of work, counted by this worker process; see transactions.py
+    token = app.config['METRICS_TOKEN']
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(404)
+    return jsonify(transaction_metrics.snapshot())
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
 
+@app.errorhandler(429)
+def too_many_requests_error(error):
+    return render_template('errors/429.html'), 429, {'Retry-After': str(error.retry_after or 1)}
+
 @app.errorhandler(500)
 def server_error(error):
     return render_template('errors/500.html'), 500
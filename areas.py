@@ -0,0 +1,58 @@
+#IMPORTS
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import and_, func, text
+from models import db, Venue, Show, AreaVersion
+from cache import cache
+#----------------------------------------------------------------------------#
+# The /venues areas listing, cached per (city, state).
+#
+# Every area that has ever had a venue has a row in AreaVersion.  The venue
+# write handlers bump only the version of the area they touched, so a new
+# venue in one city rebuilds that city's fragment and every other fragment
+# stays cached.  Areas left without venues are skipped by the listing.
+#----------------------------------------------------------------------------#
+
+# The same statement on PostgreSQL and on SQLite (3.24 and later)
+UPSERT_AREA_VERSION = text(
+    'INSERT INTO "AreaVersion" (city, state, version) VALUES (:city, :state, 1) '
+    'ON CONFLICT (city, state) DO UPDATE SET version = "AreaVersion".version + 1')
+
+
+def bump_area(city, state):
+    '''Invalidate the cached fragment of one area; call it inside the write's transaction.'''
+    # The row stays when the last venue leaves the area (the listing skips empty areas), so the
+    # version only ever goes up: a version number is never reused for another set of venues
+    # while an old fragment under it may still sit in a worker's cache.  One upsert: with an
+    # UPDATE, then an INSERT when it matched nothing, two first venues of a new area committed
+    # at the same time would both insert and one would fail on the key
+    db.session.execute(UPSERT_AREA_VERSION, {'city': city, 'state': state})
+
+
+def build_area(city, state):
+    '''One area of the listing, in the structure pages/venues.html expects.'''
+    rows = db.session.query(Venue.id, Venue.name, func.count(Show.id)) \
+        .outerjoin(Show, and_(Show.venue_id == Venue.id, Show.start_time > datetime.now())) \
+        .filter(Venue.city == city, Venue.state == state, Venue.archived_at.is_(None)) \
+        .group_by(Venue.id, Venue.name).order_by(Venue.id).all()
+    return {
+        "city": city,
+        "state": state,
+        "venues": [{"id": id, "name": name, "num_upcoming_shows": num_upcoming} for id, name, num_upcoming in rows]
+    }
+
+
+def venue_areas():
+    '''All areas: one query for the versions, then a rebuild of only the fragments that changed.'''
+    ttl = current_app.config['AREA_CACHE_TTL']
+    areas = []
+    for city, state, version in db.session.query(AreaVersion.city, AreaVersion.state, AreaVersion.version) \
+            .order_by(AreaVersion.state, AreaVersion.city):
+        key = f'venues-area:{state}:{city}:{version}'
+        area = cache.get(key)
+        if area is None:
+            area = build_area(city, state)
+            cache.set(key, area, ttl)
+        if area["venues"]:
+            areas.append(area)
+    return areas
@@ -0,0 +1,527 @@
+#IMPORTS
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+import urllib.request
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from forms import VenueForm, ArtistForm
+from models import db, Venue, Artist, Show, BackfillCheckpoint, TicketTier, TicketStock, TicketHold, Rollup, \
+    venue_genre_table, artist_genre_table
+from readmodels import show_listing, venue_search, artist_search
+from alembic.operations import Operations
+from alembic.runtime.migration import MigrationContext
+from online_migrations import BACKFILLS, create_index_concurrently, drop_index_concurrently, run_backfill
+from geo import location_values
+from writes import delete_listing
+from tickets import SoldOut, add_tier, hold_tickets, purchase_hold, release_hold, expire_holds
+from dedup import DuplicateIndex, duplicate_pairs
+from transactions import transactional, metrics as transaction_metrics
+#----------------------------------------------------------------------------#
+# Micro-benchmarks, run with `flask bench <name>`.
+#----------------------------------------------------------------------------#
+
+bench_cli = AppGroup('bench', help='Micro-benchmarks of request-path code.')
+
+
+def report(label, seconds, number):
+    click.echo(f'{label:<40} {seconds / number * 1e6:>10.1f} us/op')
+
+
+def peak_memory(function):
+    '''Peak bytes allocated while function runs (and while the session still holds what it loaded).'''
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        db.session.expunge_all()
+
+
+VENUE_POST = {
+    'name': 'The Musical Hop', 'city': 'San Francisco', 'state': 'CA', 'address': '1015 Folsom Street',
+    'phone': '123-123-1234', 'genres': ['Jazz', 'Reggae', 'Classical', 'Folk'],
+    'seeking_talent': 'Yes', 'seeking_description': 'Looking for local artists',
+    'image_link': 'https://example.com/hop.jpg', 'website': 'https://www.themusicalhop.com',
+    'facebook_link': 'https://www.facebook.com/TheMusicalHop',
+}
+ARTIST_POST = {
+    'name': 'Guns N Petals', 'city': 'San Francisco', 'state': 'CA', 'phone': '326-123-5000',
+    'genres': ['Rock n Roll'], 'seeking_venue': 'No', 'seeking_description': '',
+    'image_link': '', 'website': '', 'facebook_link': '',
+}
+
+
+@bench_cli.command('forms')
+@click.option('--number', type=int, default=2000, help='Iterations per case.')
+def forms_command(number):
+    '''Build + validate VenueForm/ArtistForm as a POST handler does.'''
+    app = current_app._get_current_object()
+    cases = [
+        ('VenueForm valid', VenueForm, VENUE_POST),
+        ('VenueForm invalid state', VenueForm, dict(VENUE_POST, state='XX')),
+        ('VenueForm missing name', VenueForm, dict(VENUE_POST, name='')),
+        ('ArtistForm valid', ArtistForm, ARTIST_POST),
+    ]
+    for label, form_class, data in cases:
+        with app.test_request_context(method='POST', data=data):
+            def build_and_validate():
+                form = form_class(meta={'csrf': False})
+                if form.validate():
+                    form.listing_values()
+            report(label, timeit.timeit(build_and_validate, number=number), number)
+
+
+def wait_for_server(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=5).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise click.ClickException(f'Server at {url} did not come up')
+
+
+def drive(url, concurrency, duration):
+    '''Requests/second that `concurrency` looping clients get from url over duration seconds.'''
+    counts, errors = [0] * concurrency, [0] * concurrency
+    deadline = time.monotonic() + duration
+
+    def client(slot):
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(url, timeout=10).read()
+                counts[slot] += 1
+            except OSError:
+                errors[slot] += 1
+
+    clients = [threading.Thread(target=client, args=(slot,)) for slot in range(concurrency)]
+    started = time.monotonic()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return sum(counts) / (time.monotonic() - started), sum(errors)
+
+
+@bench_cli.command('load')
+@click.option('--workers', 'worker_counts', default='1,2,4', help='Comma-separated gunicorn worker counts to compare.')
+@click.option('--path', default='/venues', help='Page to request.')
+@click.option('--concurrency', type=int, default=16, help='Concurrent clients.')
+@click.option('--duration', type=float, default=10.0, help='Seconds per worker count.')
+@click.option('--port', type=int, default=5055)
+@click.option('--min-scaling', type=float, default=0.5,
+              help='Fail unless each count reaches this fraction of linear speedup (capped at the core count).')
+def load_command(worker_counts, path, concurrency, duration, port, min_scaling):
+    '''Serve the app with gunicorn.conf.py at each worker count and check throughput scales.'''
+    root = os.path.dirname(os.path.abspath(__file__))
+    url = f'http://127.0.0.1:{port}{path}'
+    counts = [int(count) for count in worker_counts.split(',')]
+    gunicorn = shutil.which('gunicorn', path=os.path.dirname(sys.executable)) or shutil.which('gunicorn')
+    if gunicorn is None:
+        raise click.ClickException('gunicorn is not installed')
+    baseline, failures = None, []
+    for count in counts:
+        server = subprocess.Popen(
+            [gunicorn, '-c', 'gunicorn.conf.py', '--workers', str(count),
+             '--bind', f'127.0.0.1:{port}', '--access-logfile', os.devnull, 'app:app'], cwd=root)
+        try:
+            wait_for_server(url)
+            drive(url, concurrency, 1.0)    # warm up every worker
+            throughput, errors = drive(url, concurrency, duration)
+        finally:
+            server.terminate()
+            server.wait()
+        baseline = baseline or (throughput, count)
+        speedup = throughput / baseline[0]
+        expected = min(count, os.cpu_count()) / min(baseline[1], os.cpu_count())
+        click.echo(f'{count:>3} workers {throughput:>10.1f} req/s  x{speedup:.2f} (ideal x{expected:.2f})  {errors} errors')
+        if speedup < expected * min_scaling or errors:
+            failures.append(count)
+    if failures:
+        raise click.ClickException(f'Throughput did not scale at {failures} workers')
+
+
+def seed_listings(shows):
+    '''Insert `shows` shows spread over shows // 20 venues and artists (inside the caller's transaction).'''
+    listings = max(1, shows // 20)
+    now = datetime.now()
+    for model in (Venue, Artist):
+        db.session.execute(model.__table__.insert(), [
+            {'name': f'Bench {model.__name__} {number}', 'city': 'San Francisco', 'state': 'CA', 'phone': '123-123-1234',
+             'image_link': 'https://example.com/image.jpg'}
+            for number in range(listings)
+        ])
+    venue_ids = [id for (id,) in db.session.query(Venue.id).filter(Venue.name.like('Bench Venue %'))]
+    artist_ids = [id for (id,) in db.session.query(Artist.id).filter(Artist.name.like('Bench Artist %'))]
+    db.session.execute(Show.__table__.insert(), [
+        {'venue_id': venue_ids[number % len(venue_ids)], 'artist_id': artist_ids[number * 7 % len(artist_ids)],
+         'start_time': now + timedelta(hours=number - shows // 2)}
+        for number in range(shows)
+    ])
+
+
+# The listings as they were built before readmodels.py: ORM entities copied into dicts
+def show_listing_entities():
+    return [{"venue_id": show.venue.id, "venue_name": show.venue.name, "artist_id": show.artist.id,
+             "artist_name": show.artist.name, "artist_image_link": show.artist.image_link,
+             "start_time": show.start_time.strftime("%m/%d/%Y, %H:%M:%S")} for show in Show.query.all()]
+
+
+def venue_search_entities(search_term):
+    now = datetime.now()
+    return [{"id": venue.id, "name": venue.name,
+             "num_upcoming_shows": sum(1 for show in Show.query.filter_by(venue_id=venue.id) if show.start_time > now)}
+            for venue in Venue.query.filter(Venue.name.ilike(f'%{search_term}%'), Venue.archived_at.is_(None))]
+
+
+def artist_search_entities(search_term):
+    now = datetime.now()
+    return [{"id": artist.id, "name": artist.name,
+             "upcoming_shows": sum(1 for show in artist.shows if show.start_time > now)}
+            for artist in Artist.query.filter(Artist.name.ilike(f'%{search_term}%'), Artist.archived_at.is_(None))]
+
+
+@bench_cli.command('listings')
+@click.option('--shows', type=int, default=20000, help='Synthetic shows to add for the run (0 uses the data as is).')
+@click.option('--number', type=int, default=5, help='Iterations per case.')
+def listings_command(shows, number):
+    '''Latency and memory per row of the listings: ORM entities vs the read models.
+
+    The synthetic rows are rolled back afterwards.
+    '''
+    try:
+        if shows:
+            seed_listings(shows)
+        cases = [
+            ('shows', show_listing_entities, show_listing),
+            ('venue search', lambda: venue_search_entities('bench'), lambda: venue_search('bench')),
+            ('artist search', lambda: artist_search_entities('bench'), lambda: artist_search('bench')),
+        ]
+        for label, *implementations in cases:
+            rows = len(implementations[1]())
+            for kind, listing in zip(('entities', 'read model'), implementations):
+                def run():
+                    listing()
+                    db.session.expunge_all()
+                report(f'{label} ({kind}, {rows} rows)', timeit.timeit(run, number=number), number)
+                click.echo(f'{"":<40} {peak_memory(listing) / max(rows, 1):>10.0f} bytes/row peak')
+    finally:
+        db.session.rollback()
+
+
+def percentile(latencies, fraction):
+    ordered = sorted(latencies)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] if ordered else 0.0
+
+
+class Reader(threading.Thread):
+    '''Point reads of an artist's upcoming shows in a loop, timing each one.'''
+
+    def __init__(self, app, artist_ids):
+        super().__init__(daemon=True)
+        self.app, self.artist_ids = app, artist_ids
+        self.latencies, self.errors = [], 0
+        self.stopping = threading.Event()
+
+    def run(self):
+        with self.app.app_context():
+            while not self.stopping.is_set():
+                started = time.monotonic()
+                try:
+                    db.session.query(Show.id, Show.start_time) \
+                        .filter(Show.artist_id == random.choice(self.artist_ids), Show.start_time > datetime.now()) \
+                        .order_by(Show.start_time).limit(10).all()
+                    db.session.rollback()
+                except Exception:
+                    self.errors += 1
+                    db.session.rollback()
+                self.latencies.append(time.monotonic() - started)
+            db.session.remove()
+
+    def take(self):
+        '''The latencies since the last take().'''
+        latencies, self.latencies = self.latencies, []
+        return latencies
+
+
+@bench_cli.command('online-migration')
+@click.option('--shows', type=int, default=100000, help='Synthetic shows to seed (deleted afterwards).')
+@click.option('--max-stall', type=float, default=1.0, help='Fail if any read takes longer than this, in seconds.')
+def online_migration_command(shows, max_stall):
+    '''Build an index on Show and run a backfill over a seeded dataset while reads continue.'''
+    app = current_app._get_current_object()
+    seed_listings(shows)
+    db.session.commit()
+    venue_filter = Venue.name.like('Bench Venue %')
+    BACKFILLS['bench-geocode'] = (Venue, (Venue.city, Venue.state), venue_filter,
+                                  lambda rows: [dict(location_values(city, state), id=id) for id, city, state in rows])
+    artist_ids = [id for (id,) in db.session.query(Artist.id).filter(Artist.name.like('Bench Artist %'))]
+    reader = Reader(app, artist_ids)
+    reader.start()
+    failures = []
+
+    def phase(label, step):
+        reader.take()
+        started = time.monotonic()
+        step()
+        elapsed = time.monotonic() - started
+        latencies = reader.take()
+        click.echo(f'{label:<28} {elapsed:>7.2f}s   reads: {len(latencies):>6}  p50 {percentile(latencies, 0.5) * 1000:>7.2f} ms'
+                   f'  p99 {percentile(latencies, 0.99) * 1000:>7.2f} ms  max {max(latencies, default=0) * 1000:>8.2f} ms')
+        if max(latencies, default=0) > max_stall:
+            failures.append(label)
+
+    def with_operations(function, *args):
+        with db.engine.connect() as connection:
+            with Operations.context(MigrationContext.configure(connection)):
+                function(*args)
+
+    try:
+        phase('baseline (no migration)', lambda: time.sleep(2))
+        phase('create index concurrently', lambda: with_operations(
+            create_index_concurrently, 'ix_bench_show_venue_start', 'Show', ['venue_id', 'start_time']))
+        phase('batched backfill', lambda: run_backfill('bench-geocode', current_app.config['BACKFILL_BATCH_SIZE'],
+                                                       current_app.config['BACKFILL_MAX_DUTY']))
+        phase('drop index concurrently', lambda: with_operations(
+            drop_index_concurrently, 'ix_bench_show_venue_start', 'Show'))
+    finally:
+        reader.stopping.set()
+        reader.join()
+        del BACKFILLS['bench-geocode']
+        BackfillCheckpoint.query.filter_by(name='bench-geocode').delete()
+        for model, genre_table, fk_name in ((Venue, venue_genre_table, 'venue_id'), (Artist, artist_genre_table, 'artist_id')):
+            for (id,) in db.session.query(model.id).filter(model.name.like(f'Bench {model.__name__} %')).all():
+                delete_listing(model, genre_table, fk_name, id)
+        db.session.commit()
+    if reader.errors:
+        failures.append(f'{reader.errors} failed reads')
+    if failures:
+        raise click.ClickException(f'Reads stalled or failed during: {", ".join(failures)}')
+
+
+class Buyer(threading.Thread):
+    '''Holds tickets in a loop, then buys, gives back or abandons each hold.'''
+
+    def __init__(self, app, tier_id, attempts):
+        super().__init__(daemon=True)
+        self.app, self.tier_id, self.attempts = app, tier_id, attempts
+        self.latencies, self.held, self.sold_out, self.errors = [], 0, 0, 0
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                with self.attempts['lock']:
+                    if self.attempts['left'] == 0:
+                        break
+                    self.attempts['left'] -= 1
+                started = time.monotonic()
+                try:
+                    hold_id = hold_tickets(self.tier_id, random.randint(1, 4))
+                    db.session.commit()
+                    self.held += 1
+                except SoldOut:
+                    db.session.rollback()
+                    self.sold_out += 1
+                    continue
+                except Exception:
+                    db.session.rollback()
+                    self.errors += 1
+                    continue
+                finally:
+                    self.latencies.append(time.monotonic() - started)
+                # Most holds are bought, some given back, the rest left to expire
+                outcome = random.random()
+                try:
+                    if outcome < 0.6:
+                        purchase_hold(hold_id)
+                    elif outcome < 0.85:
+                        release_hold(hold_id)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    self.errors += 1
+            db.session.remove()
+
+
+@bench_cli.command('tickets')
+@click.option('--capacity', type=int, default=1000, help='Seats in the synthetic tier.')
+@click.option('--buyers', type=int, default=64, help='Concurrent buyer threads.')
+@click.option('--attempts', type=int, default=5000, help='Hold attempts over all buyers.')
+@click.option('--sqlite', is_flag=True, help='Run on SQLite anyway (its writers take turns, so nothing races).')
+def tickets_command(capacity, buyers, attempts, sqlite):
+    '''Stress one ticket tier with concurrent holds and check that it is never oversold.'''
+    if db.engine.dialect.name != 'postgresql' and not sqlite:
+        # SQLite locks the whole database for a write: the stripe updates never run concurrently
+        click.echo('Skipped: needs PostgreSQL (point DATABASE_URL at one, or pass --sqlite)')
+        return
+    app = current_app._get_current_object()
+    # Show id 0 never exists, so the tier can't be reached from the site
+    tier_id = add_tier(0, 'Bench', 0, capacity).id
+    db.session.commit()
+    shared = {'left': attempts, 'lock': threading.Lock()}
+    threads = [Buyer(app, tier_id, shared) for _ in range(buyers)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    try:
+        latencies = [latency for thread in threads for latency in thread.latencies]
+        click.echo(f'{attempts} hold attempts from {buyers} buyers in {elapsed:.2f}s ({attempts / elapsed:.0f}/s): '
+                   f'{sum(t.held for t in threads)} held, {sum(t.sold_out for t in threads)} sold out, '
+                   f'{sum(t.errors for t in threads)} errors')
+        click.echo(f'hold latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms  '
+                   f'p99 {percentile(latencies, 0.99) * 1000:.2f} ms  max {max(latencies, default=0) * 1000:.2f} ms')
+
+        sold = db.session.query(db.func.coalesce(db.func.sum(TicketHold.quantity), 0)) \
+            .filter(TicketHold.tier_id == tier_id, TicketHold.status == 'purchased').scalar()
+        # Let every abandoned hold run out, then all seats are either sold or back in stock
+        TicketHold.query.filter(TicketHold.tier_id == tier_id, TicketHold.status == 'held') \
+            .update({'expires_at': datetime.utcnow() - timedelta(seconds=1)}, synchronize_session=False)
+        while expire_holds(tier_id=tier_id):
+            pass
+        db.session.commit()
+        lowest, in_stock = db.session.query(db.func.min(TicketStock.available), db.func.sum(TicketStock.available)) \
+            .filter(TicketStock.tier_id == tier_id).one()
+        click.echo(f'{sold} of {capacity} seats sold, {in_stock} back in stock, lowest stripe {lowest}')
+        if lowest < 0 or sold > capacity or sold + in_stock != capacity:
+            raise click.ClickException('Seats were oversold or lost')
+    finally:
+        TicketHold.query.filter(TicketHold.tier_id == tier_id).delete(synchronize_session=False)
+        TicketStock.query.filter(TicketStock.tier_id == tier_id).delete(synchronize_session=False)
+        TicketTier.query.filter(TicketTier.id == tier_id).delete(synchronize_session=False)
+        db.session.commit()
+
+
+def made_up_word(generator):
+    return ''.join(generator.choice('bcdfghklmnprstvz') + generator.choice('aeiou') for _ in range(generator.randint(2, 4)))
+
+
+def misspell(name, generator):
+    '''A name as someone else might have typed it in.'''
+    variant = generator.randrange(4)
+    if variant == 0:
+        position = generator.randrange(len(name) - 1)
+        return name[:position] + name[position + 1] + name[position] + name[position + 2:]
+    if variant == 1:
+        return 'The ' + name.title()
+    if variant == 2:
+        return name.replace(' and ', ' & ') if ' and ' in name else name.upper()
+    return name + '!'
+
+
+@bench_cli.command('dedup')
+@click.option('--listings', type=int, default=100000, help='Synthetic listings.')
+@click.option('--cities', type=int, default=50)
+@click.option('--duplicates', type=float, default=0.02, help='Share of listings entered twice.')
+def dedup_command(listings, cities, duplicates):
+    '''Blocking and MinHash candidate generation over synthetic listings: time, pairs compared and recall.
+
+    Nothing is written to the database.
+    '''
+    generator = random.Random(7)
+    rows, planted = {}, set()
+    for id in range(1, listings + 1):
+        words = [made_up_word(generator) for _ in range(generator.randint(2, 3))]
+        if generator.random() < 0.3:
+            words.insert(-1, 'and')
+        rows[id] = {'name': ' '.join(words), 'city': f'City {id % cities}', 'state': 'CA',
+                    'phone': f'{generator.randrange(10 ** 9, 10 ** 10)}'}
+    next_id = listings + 1
+    for original in generator.sample(range(1, listings + 1), int(listings * duplicates)):
+        row = dict(rows[original], name=misspell(rows[original]['name'], generator))
+        if generator.random() < 0.5:
+            # Entered with another phone number: only the name can match it
+            row['phone'] = f'{generator.randrange(10 ** 9, 10 ** 10)}'
+        rows[next_id] = row
+        planted.add((original, next_id))
+        next_id += 1
+
+    started = time.perf_counter()
+    index = DuplicateIndex(current_app.config['DEDUP_BANDS'], current_app.config['DEDUP_ROWS'])
+    index.build(rows)
+    built = time.perf_counter() - started
+    candidates = len(index.candidate_pairs(current_app.config['DEDUP_MAX_BUCKET']))
+    pairs = duplicate_pairs(index)
+    elapsed = time.perf_counter() - started
+    found = {(a, b) for _, a, b, _ in pairs}
+    click.echo(f'{len(rows)} listings: index built in {built:.2f}s, scanned in {elapsed:.2f}s')
+    click.echo(f'{candidates} candidate pairs compared of {len(rows) * (len(rows) - 1) // 2} '
+               f'({candidates / max(len(rows), 1):.2f} per listing)')
+    click.echo(f'{len(found & planted)} of {len(planted)} planted duplicates found '
+               f'({len(found & planted) / max(len(planted), 1):.1%} recall), {len(found - planted)} other pairs')
+
+
+class Incrementer(threading.Thread):
+    '''Read-modify-write of one shared counter in a loop: the worst case for concurrent writers.'''
+
+    def __init__(self, app, key, count, isolation):
+        super().__init__(daemon=True)
+        self.app, self.key, self.count, self.isolation = app, key, count, isolation
+        self.committed, self.errors = 0, 0
+
+    def run(self):
+        with self.app.app_context():
+            @transactional('bench_increment', isolation=self.isolation)
+            def increment():
+                value = int(db.session.query(Rollup.data).filter(Rollup.key == self.key).scalar())
+                Rollup.query.filter(Rollup.key == self.key).update({'data': str(value + 1)}, synchronize_session=False)
+
+            for _ in range(self.count):
+                try:
+                    increment()
+                    self.committed += 1
+                except Exception:
+                    self.errors += 1
+            db.session.remove()
+
+
+@bench_cli.command('transactions')
+@click.option('--threads', type=int, default=16)
+@click.option('--increments', type=int, default=200, help='Increments per thread.')
+@click.option('--isolation', default='SERIALIZABLE', help='PostgreSQL isolation level of the increments.')
+def transactions_command(threads, increments, isolation):
+    '''Contended increments through @transactional: throughput, retries, and no lost updates.'''
+    app = current_app._get_current_object()
+    key = 'bench-transactions'
+    Rollup.query.filter(Rollup.key == key).delete()
+    db.session.add(Rollup(key=key, data='0'))
+    db.session.commit()
+    before = transaction_metrics.snapshot()['units'].get('bench_increment', {})
+    workers = [Incrementer(app, key, increments, isolation) for _ in range(threads)]
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+
+    try:
+        committed = sum(worker.committed for worker in workers)
+        errors = sum(worker.errors for worker in workers)
+        value = int(db.session.query(Rollup.data).filter(Rollup.key == key).scalar())
+        after = transaction_metrics.snapshot()['units'].get('bench_increment', {})
+        click.echo(f'{committed} increments committed by {threads} threads in {elapsed:.2f}s '
+                   f'({committed / elapsed:.0f}/s), {errors} failed')
+        for event in sorted(after):
+            if event != 'commits' and after[event] != before.get(event, 0):
+                click.echo(f'  {event}: {after[event] - before.get(event, 0)}')
+        click.echo(f'counter {value}, {committed - value} lost updates')
+        if value != committed or errors:
+            raise click.ClickException('Increments were lost or failed')
+    finally:
+        Rollup.query.filter(Rollup.key == key).delete()
+        db.session.commit()
@@ -0,0 +1,94 @@
+#IMPORTS
+import threading
+import time
+from collections import OrderedDict
+#----------------------------------------------------------------------------#
+# In-process cache.
+#----------------------------------------------------------------------------#
+
+class SingleFlight:
+    '''Coalesce concurrent calls for the same key: the first caller computes,
+    the others wait for it and share its result (or its exception).
+    '''
+
+    def __init__(self):
+        self._calls = {}    # key -> [done Event, result, exception]
+        self._lock = threading.Lock()
+
+    def do(self, key, compute):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None, None]
+        if leader:
+            try:
+                call[1] = compute()
+            except Exception as e:
+                call[2] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call[0].set()
+        else:
+            call[0].wait()
+        if call[2] is not None:
+            raise call[2]
+        return call[1]
+
+
+class LocalCache:
+    '''A small thread-safe TTL cache with LRU eviction, local to one worker process.
+
+    Entries are usually keyed on a version that lives in the database (see
+    areas.py), so workers never serve stale data after a write even though
+    each keeps its own copy.
+    '''
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = LocalCache()
+flights = SingleFlight()
+
+
+def get_or_compute(key, ttl, compute):
+    '''Cached value of key; on a miss only one thread per worker runs compute().'''
+    value = cache.get(key)
+    if value is None:
+        def compute_and_cache():
+            value = compute()
+            cache.set(key, value, ttl)
+            return value
+        value = flights.do(key, compute_and_cache)
+    return value
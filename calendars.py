@@ -0,0 +1,127 @@
+#IMPORTS
+import hashlib
+from datetime import date, datetime, timedelta
+from flask import Response, abort, current_app, request, stream_with_context, url_for
+from sqlalchemy import func
+from werkzeug.http import is_resource_modified
+from models import db, Venue, Artist, Show
+#----------------------------------------------------------------------------#
+# iCalendar (.ics) feeds.
+#
+# Calendar apps poll a subscribed feed every few minutes, so every feed has
+# its own ETag, computed from what its body depends on: the window's first
+# day, the calendar name, and the count and id sum of the shows in the
+# window with the summed versions of their venues and artists.  Shows are
+# only ever created or deleted, and every edit of a venue or artist bumps its
+# version, so a write elsewhere on the site leaves the ETag alone.  A poll
+# with nothing new costs a primary key lookup of the listing (so a deleted
+# one is a 404) plus one aggregate over the feed's indexed show range, and
+# gets a bodyless 304.  Otherwise the calendar is streamed event by event
+# from the same query.
+#
+# Start times are stored without a time zone, so they are written as
+# floating times: calendar apps show them as the venue's local time.
+#----------------------------------------------------------------------------#
+
+def window_start():
+    '''The first day a feed covers; whole days, so the window (and the ETag) moves once a day.'''
+    return date.today() - timedelta(days=current_app.config['CALENDAR_PAST_DAYS'])
+
+
+def feed_etag(name, query):
+    '''A validator of the feed that the shows of query make up.'''
+    summary = query.with_entities(func.count(Show.id), func.coalesce(func.sum(Show.id), 0),
+                                  func.coalesce(func.sum(Venue.version), 0),
+                                  func.coalesce(func.sum(Artist.version), 0)).order_by(None).one()
+    return hashlib.sha1(repr((window_start().isoformat(), name) + tuple(summary)).encode()).hexdigest()[:20]
+
+
+def not_modified(etag):
+    return not is_resource_modified(request.environ, etag=etag)
+
+
+def escape_text(value):
+    # RFC 5545 TEXT values
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def fold(line):
+    '''Fold a content line to 75 octets, continuation lines starting with a space.'''
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts, start, limit = [], 0, 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Never split a UTF-8 sequence
+        while end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode())
+        start, limit = end, 74
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def ics_time(moment):
+    return moment.strftime('%Y%m%dT%H%M%S')
+
+
+def feed_query(**criteria):
+    '''The shows for a feed, oldest first: artist_id=, venue_id= or city=/state=.'''
+    since = datetime.combine(window_start(), datetime.min.time())
+    query = db.session.query(Show.id, Show.start_time, Show.artist_id, Artist.name, Show.venue_id, Venue.name,
+                             Venue.address, Venue.city, Venue.state) \
+        .join(Artist, Artist.id == Show.artist_id).join(Venue, Venue.id == Show.venue_id) \
+        .filter(Show.start_time >= since)
+    if 'artist_id' in criteria:
+        query = query.filter(Show.artist_id == criteria['artist_id'])
+    elif 'venue_id' in criteria:
+        query = query.filter(Show.venue_id == criteria['venue_id'])
+    else:
+        query = query.filter(Venue.city == criteria['city'], Venue.state == criteria['state'],
+                             Venue.archived_at.is_(None))
+    return query.order_by(Show.start_time)
+
+
+def stream_calendar(name, query):
+    '''Yield the VCALENDAR for the shows of query, a few lines at a time.'''
+    host = request.host.split(':')[0]
+    duration = timedelta(hours=current_app.config['CALENDAR_SHOW_HOURS'])
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    yield ''.join(fold(line) for line in (
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Fyyur//Shows//EN', 'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{escape_text(name)}',
+        f"REFRESH-INTERVAL;VALUE=DURATION:PT{current_app.config['CALENDAR_MAX_AGE'] // 60}M"))
+    for show_id, start_time, artist_id, artist_name, venue_id, venue_name, address, city, state in \
+            query.yield_per(current_app.config['CALENDAR_BATCH_SIZE']):
+        location = ', '.join(part for part in (venue_name, address, city, state) if part)
+        yield ''.join(fold(line) for line in (
+            'BEGIN:VEVENT',
+            f'UID:show-{show_id}@{host}',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART:{ics_time(start_time)}',
+            f'DTEND:{ics_time(start_time + duration)}',
+            f'SUMMARY:{escape_text(f"{artist_name} at {venue_name}")}',
+            f'LOCATION:{escape_text(location)}',
+            f"URL:{url_for('show_artist', artist_id=artist_id, _external=True)}",
+            'END:VEVENT'))
+    yield fold('END:VCALENDAR')
+
+
+def calendar_response(describe):
+    '''The .ics response for a feed, or a 304 if the client's copy is current.
+
+    describe() returns (calendar name, feed_query(...)), or None for a 404.
+    It is called first, so a feed of a deleted listing is a 404 even for a
+    client holding a current ETag; it only looks the listing up, the query
+    runs in full once the feed is known to have changed.
+    '''
+    described = describe()
+    if not described:
+        abort(404)
+    name, query = described
+    etag = feed_etag(name, query)
+    # Weak: the body's DTSTAMP is the time it was generated
+    headers = {'ETag': f'W/"{etag}"', 'Cache-Control': f"public, max-age={current_app.config['CALENDAR_MAX_AGE']}"}
+    if not_modified(etag):
+        return Response(status=304, headers=headers)
+    return Response(stream_with_context(stream_calendar(name, query)), mimetype='text/calendar', headers=headers)
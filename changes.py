@@ -0,0 +1,124 @@
+#IMPORTS
+import json
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, func
+from models import db, ChangeEvent
+#----------------------------------------------------------------------------#
+# Change feed (outbox).
+#
+# The write handlers call record_change() before they commit, so an event
+# exists exactly when its write does.  /changes?since=<position> streams the
+# log in position order for partners to sync from, instead of re-crawling the
+# HTML pages.  Deleting a venue or artist also deletes its shows; the feed
+# only carries the venue/artist delete.
+#
+# Event ids are handed out when a transaction inserts its events, not when it
+# commits, so a long transaction can commit an id smaller than ones a reader
+# has already gone past.  Readers therefore follow `position` instead: it is
+# given to events only once they are committed and visible, by one sequencer
+# at a time (sequence_changes()), so a position is never handed out below one
+# that a reader may already have seen.  Every reader of the log (the feed,
+# the typeahead and facet indexes, page pre-rendering) goes through
+# read_changes(), which sequences first.
+#----------------------------------------------------------------------------#
+
+# Advisory lock key of the sequencer on PostgreSQL
+SEQUENCER_LOCK = 0x43686e67
+
+def to_json(data):
+    return json.dumps(data, default=lambda value: value.isoformat(), sort_keys=True)
+
+
+def record_change(entity, entity_id, op, **data):
+    db.session.add(ChangeEvent(entity=entity, entity_id=int(entity_id), op=op, data=to_json(data)))
+
+
+def changed_values(previous, values):
+    '''The columns of an update_listing() call whose value differs from the stored row.'''
+    return {key: value for key, value in values.items() if getattr(previous, key) != value}
+
+
+def record_changes(events):
+    '''Bulk record_change(): events is a list of (entity, entity_id, op, data).'''
+    if events:
+        db.session.execute(ChangeEvent.__table__.insert(), [
+            {'entity': entity, 'entity_id': int(entity_id), 'op': op, 'data': to_json(data),
+             'created_at': datetime.utcnow()}
+            for entity, entity_id, op, data in events
+        ])
+
+
+def sequence_changes():
+    '''Give the committed events without a position the next positions, in id order.
+
+    Returns how many were sequenced; 0 as well when another process holds the
+    sequencer, which is then doing the same work.
+    '''
+    if db.engine.dialect.name == 'postgresql':
+        # Writers on PostgreSQL commit in any order; one sequencer at a time keeps positions increasing
+        if not db.session.execute('SELECT pg_try_advisory_xact_lock(:key)', {'key': SEQUENCER_LOCK}).scalar():
+            db.session.rollback()
+            return 0
+    ids = [id for (id,) in db.session.query(ChangeEvent.id).filter(ChangeEvent.position.is_(None))
+           .order_by(ChangeEvent.id).limit(current_app.config['CHANGE_FEED_SEQUENCE_BATCH'])]
+    if ids:
+        last = db.session.query(func.max(ChangeEvent.position)).scalar() or 0
+        table = ChangeEvent.__table__
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('event_id')).values(position=bindparam('event_position')),
+            [{'event_id': id, 'event_position': last + number} for number, id in enumerate(ids, 1)])
+    db.session.commit()
+    return len(ids)
+
+
+def latest_position():
+    '''The position a reader that has just loaded the current state can follow the log from.'''
+    return db.session.query(func.max(ChangeEvent.position)).scalar() or 0
+
+
+def read_changes(after, limit=None, entity=None):
+    '''[(position, entity, entity_id, op, data, created_at)] of the events past position `after`.'''
+    sequence_changes()
+    query = db.session.query(ChangeEvent.position, ChangeEvent.entity, ChangeEvent.entity_id, ChangeEvent.op,
+                             ChangeEvent.data, ChangeEvent.created_at) \
+        .filter(ChangeEvent.position > after)
+    if entity is not None:
+        query = query.filter(ChangeEvent.entity == entity)
+    return query.order_by(ChangeEvent.position).limit(limit).all()
+
+
+def stream_changes(since, limit):
+    '''Yield the feed after position `since` as JSON lines, reading it a page at a time.
+
+    The "id" of a line is its position, the cursor to resume from.
+    '''
+    page_size = current_app.config['CHANGE_FEED_PAGE_SIZE']
+    sent = 0
+    while sent < limit:
+        rows = read_changes(since, min(page_size, limit - sent))
+        if not rows:
+            return
+        for position, entity, entity_id, op, data, created_at in rows:
+            yield '{"id": %d, "entity": %s, "entity_id": %d, "op": %s, "at": "%s", "data": %s}\n' % (
+                position, json.dumps(entity), entity_id, json.dumps(op), created_at.isoformat(), data)
+        sent += len(rows)
+        since = rows[-1].position
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+changes_cli = AppGroup('changes', help='Maintain the change feed.')
+
+
+@changes_cli.command('prune')
+@click.option('--days', type=int, default=None, help='Keep this many days of events (default CHANGE_FEED_RETENTION_DAYS).')
+def prune_command(days):
+    days = current_app.config['CHANGE_FEED_RETENTION_DAYS'] if days is None else days
+    deleted = ChangeEvent.query.filter(ChangeEvent.created_at < datetime.utcnow() - timedelta(days=days)) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    click.echo(f'Pruned {deleted} change events')
@@ -0,0 +1,98 @@
+#IMPORTS
+import json
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func
+from models import db, Venue, Artist, Show, Genre, Rollup, artist_genre_table
+from jobs import periodic, schedule_next
+#----------------------------------------------------------------------------#
+# Home page dashboard.
+#
+# The home page is the busiest page, so it doesn't aggregate anything live:
+# refresh_home_rollup() builds the lists below into a single Rollup row and
+# index() reads that row back by primary key.  The job workers start the
+# refresh on their own; until its first run (e.g. right after a fresh deploy)
+# the home page computes the lists live instead of showing an empty page.
+#----------------------------------------------------------------------------#
+
+HOME_KEY = 'home'
+# How far ahead to look for the busiest week and trending genres
+UPCOMING_WEEKS = 12
+TRENDING_DAYS = 30
+
+
+def compute_home_rollup(now=None):
+    now = now or datetime.utcnow()
+    size = current_app.config['HOME_ROLLUP_SIZE']
+
+    recent_artists = db.session.query(Artist.id, Artist.name, Artist.city, Artist.state, Artist.image_link) \
+        .filter(Artist.archived_at.is_(None)).order_by(Artist.created_at.desc()).limit(size).all()
+    recent_venues = db.session.query(Venue.id, Venue.name, Venue.city, Venue.state, Venue.image_link) \
+        .filter(Venue.archived_at.is_(None)).order_by(Venue.created_at.desc()).limit(size).all()
+
+    # Busiest upcoming week per city: count shows per (city, state, week) and keep each city's top week
+    upcoming = db.session.query(Venue.city, Venue.state, Show.start_time) \
+        .join(Show, Show.venue_id == Venue.id) \
+        .filter(Show.start_time > now, Show.start_time <= now + timedelta(weeks=UPCOMING_WEEKS),
+                Venue.archived_at.is_(None)).all()
+    weeks = defaultdict(Counter)
+    for city, state, start_time in upcoming:
+        week_of = (start_time - timedelta(days=start_time.weekday())).date()
+        weeks[(city, state)][week_of] += 1
+    busiest_weeks = []
+    for (city, state), counts in weeks.items():
+        week_of, num_shows = max(counts.items(), key=lambda item: (item[1], -item[0].toordinal()))
+        busiest_weeks.append({'city': city, 'state': state, 'week_of': week_of.isoformat(), 'num_shows': num_shows})
+    busiest_weeks.sort(key=lambda week: week['num_shows'], reverse=True)
+
+    # Trending genres: genres of the artists playing the most shows in the next TRENDING_DAYS
+    trending = db.session.query(Genre.name, func.count(Show.id).label('num_shows')) \
+        .join(artist_genre_table, artist_genre_table.c.genre_id == Genre.id) \
+        .join(Show, Show.artist_id == artist_genre_table.c.artist_id) \
+        .filter(Show.start_time > now, Show.start_time <= now + timedelta(days=TRENDING_DAYS)) \
+        .group_by(Genre.name).order_by(func.count(Show.id).desc()).limit(size).all()
+
+    return {
+        'recent_artists': [row._asdict() for row in recent_artists],
+        'recent_venues': [row._asdict() for row in recent_venues],
+        'busiest_weeks': busiest_weeks[:size],
+        'trending_genres': [{'name': name, 'num_shows': num_shows} for name, num_shows in trending],
+    }
+
+
+def load_home_rollup():
+    '''The precomputed dashboard, or None before the first refresh.'''
+    data = db.session.query(Rollup.data).filter(Rollup.key == HOME_KEY).scalar()
+    return json.loads(data) if data else None
+
+
+def home_dashboard():
+    '''The dashboard for the home page: the precomputed one, or a live one before the first refresh.'''
+    return load_home_rollup() or compute_home_rollup()
+
+
+@periodic('HOME_ROLLUP_INTERVAL', autostart=True)
+def refresh_home_rollup():
+    data = json.dumps(compute_home_rollup())
+    rollup = Rollup.query.get(HOME_KEY)
+    if rollup is None:
+        db.session.add(Rollup(key=HOME_KEY, data=data))
+    else:
+        rollup.data = data
+        rollup.refreshed_at = datetime.utcnow()
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+dashboard_cli = AppGroup('dashboard', help='Maintain the home page dashboard.')
+
+
+@dashboard_cli.command('refresh')
+def refresh_command():
+    refresh_home_rollup()
+    # Keep the dashboard refreshing on its own from now on
+    schedule_next('refresh_home_rollup')
+    db.session.commit()
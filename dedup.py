@@ -0,0 +1,343 @@
+#IMPORTS
+import random
+import re
+import unicodedata
+import zlib
+from functools import lru_cache
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, func, or_
+from sqlalchemy.exc import IntegrityError
+from models import db, Venue, Artist, Genre, Show, ShowArchive, venue_genre_table, artist_genre_table
+from areas import bump_area
+from changes import record_change
+from transactions import transactional, savepoint
+#----------------------------------------------------------------------------#
+# Duplicate venue and artist detection.
+#
+# Comparing every listing with every other one is quadratic, so a scan of the
+# catalog first puts listings into buckets by blocking keys and only compares
+# listings sharing a bucket:
+#   - the phone number (digits only), across the whole catalog;
+#   - the bands of a MinHash signature of the name's character trigrams,
+#     within one city and state.  Two names whose trigram sets overlap with
+#     Jaccard similarity s share a band with probability 1 - (1 - s^r)^b
+#     (b = DEDUP_BANDS bands of r = DEDUP_ROWS hashes), so similar names
+#     almost always meet and dissimilar ones almost never do.
+# The candidates are then scored with the exact trigram Jaccard similarity of
+# their normalized names.  A scan is linear in the number of listings plus
+# the (small) number of candidate pairs.
+#
+# Creating a listing only needs the one block it falls in, read through the
+# phone and (state, city) indexes.  `flask dedup scan` lists the duplicates
+# across the catalog and `flask dedup merge` folds duplicates into one
+# listing.
+#----------------------------------------------------------------------------#
+
+PRIME = (1 << 61) - 1
+
+
+def name_key(name):
+    '''"The Musical Hop & Café!" -> "musical hop and cafe".'''
+    name = unicodedata.normalize('NFKD', name or '').encode('ascii', 'ignore').decode().lower()
+    words = re.findall(r'[a-z0-9]+', name.replace('&', ' and '))
+    if len(words) > 1 and words[0] == 'the':
+        words = words[1:]
+    return ' '.join(words)
+
+
+def phone_key(phone):
+    '''The digits of a phone number, without a leading US country code; None if too short to tell listings apart.'''
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) == 11 and digits.startswith('1'):
+        digits = digits[1:]
+    return digits if len(digits) >= 7 else None
+
+
+def place_key(city, state):
+    return (name_key(city), state or '')
+
+
+def trigrams(key):
+    padded = f' {key} '
+    return {padded[start:start + 3] for start in range(len(padded) - 2)}
+
+
+@lru_cache(maxsize=4096)
+def name_trigrams(name):
+    return frozenset(trigrams(name_key(name)))
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+@lru_cache(maxsize=16)
+def coefficients(size):
+    # Fixed seed: every worker (and every scan) must hash the same way
+    generator = random.Random(20240601)
+    return [(generator.randrange(1, PRIME), generator.randrange(PRIME)) for _ in range(size)]
+
+
+@lru_cache(maxsize=65536)
+def shingle_hashes(shingle, size):
+    # The same few thousand trigrams make up every name, so their hashes are worth keeping
+    value = zlib.crc32(shingle.encode())
+    return tuple((a * value + b) % PRIME for a, b in coefficients(size))
+
+
+def signature(shingles, size):
+    '''MinHash signature: per hash function, the smallest hash over the shingles.'''
+    return tuple(map(min, zip(*(shingle_hashes(shingle, size) for shingle in shingles))))
+
+
+class DuplicateIndex:
+    '''Blocking buckets of a set of listings, and the candidate duplicates they give.'''
+
+    def __init__(self, bands, rows):
+        self.bands, self.rows = bands, rows
+        self._listings = {}     # id -> {'name', 'city', 'state', 'phone'}
+        self._buckets = {}      # hash of a blocking key -> [id]
+
+    def keys(self, listing):
+        keys = []
+        phone = phone_key(listing.get('phone'))
+        if phone:
+            keys.append(hash(('phone', phone)))
+        key = name_key(listing.get('name'))
+        if key:
+            place = place_key(listing.get('city'), listing.get('state'))
+            hashes = signature(trigrams(key), self.bands * self.rows)
+            keys += [hash((place, band, hashes[band * self.rows:(band + 1) * self.rows]))
+                     for band in range(self.bands)]
+        return keys
+
+    def build(self, listings):
+        '''Replace the contents with {id: listing}.'''
+        buckets = {}
+        for id, listing in listings.items():
+            for key in self.keys(listing):
+                buckets.setdefault(key, []).append(id)
+        self._listings, self._buckets = listings, buckets
+
+    def listing(self, id):
+        return self._listings.get(id)
+
+    def candidate_pairs(self, max_bucket):
+        '''Every pair of ids sharing a bucket.  Larger buckets than max_bucket are skipped:
+        a placeholder phone number shared by hundreds of listings says nothing.'''
+        pairs = set()
+        for bucket in self._buckets.values():
+            if 1 < len(bucket) <= max_bucket:
+                bucket = sorted(bucket)
+                pairs.update((a, b) for position, a in enumerate(bucket) for b in bucket[position + 1:])
+        return pairs
+
+
+def compare(a, b):
+    '''(similarity, reasons) of two listings, or None if they don't look like the same one.'''
+    config = current_app.config
+    similarity = jaccard(name_trigrams(a['name']), name_trigrams(b['name']))
+    reasons = []
+    if phone_key(a.get('phone')) and phone_key(a.get('phone')) == phone_key(b.get('phone')) \
+            and similarity >= config['DEDUP_PHONE_NAME_THRESHOLD']:
+        reasons.append('same phone')
+    if place_key(a.get('city'), a.get('state')) == place_key(b.get('city'), b.get('state')) \
+            and similarity >= config['DEDUP_NAME_THRESHOLD']:
+        reasons.append('similar name')
+    return (similarity, reasons) if reasons else None
+
+
+def duplicate_pairs(index):
+    '''[(similarity, id, id, reasons)] of the likely duplicates in an index, most similar first.'''
+    pairs = []
+    for a, b in index.candidate_pairs(current_app.config['DEDUP_MAX_BUCKET']):
+        found = compare(index.listing(a), index.listing(b))
+        if found:
+            pairs.append((found[0], a, b, found[1]))
+    pairs.sort(key=lambda pair: (-pair[0], pair[1], pair[2]))
+    return pairs
+
+
+def group_pairs(pairs):
+    '''Connected groups of ids, from a list of duplicate pairs.'''
+    parent = {}
+
+    def root(id):
+        while parent.setdefault(id, id) != id:
+            parent[id] = parent[parent[id]]
+            id = parent[id]
+        return id
+
+    for _, a, b, _ in pairs:
+        parent[root(a)] = root(b)
+    groups = {}
+    for id in parent:
+        groups.setdefault(root(id), []).append(id)
+    return sorted(sorted(group) for group in groups.values())
+
+
+def load_index(model):
+    '''A DuplicateIndex of a model's active listings.'''
+    index = DuplicateIndex(current_app.config['DEDUP_BANDS'], current_app.config['DEDUP_ROWS'])
+    index.build({id: {'name': name, 'city': city, 'state': state, 'phone': phone}
+                 for id, name, city, state, phone in
+                 db.session.query(model.id, model.name, model.city, model.state, model.phone)
+                 .filter(model.archived_at.is_(None)).yield_per(current_app.config['DEDUP_BATCH_SIZE'])})
+    return index
+
+
+def likely_duplicates(model, values):
+    '''[(similarity, id, listing, reasons)] of the active listings that look like the form values.
+
+    Only the values' own blocks are read: the listings with the same phone
+    number and those in the same city and state, whatever the case of the
+    city (as `flask dedup scan` compares them).  Both are equality lookups,
+    on the phone and the (state, lower(city)) indexes.
+    '''
+    place = and_(model.state == values['state'], func.lower(model.city) == values['city'].lower())
+    key = phone_key(values['phone'])
+    # Stored phones are digits only (see forms.py), so these are all the numbers with the same phone_key()
+    block = or_(place, model.phone.in_([key, '1' + key])) if key else place
+    found = []
+    for id, name, city, state, phone in db.session.query(model.id, model.name, model.city, model.state, model.phone) \
+            .filter(block, model.archived_at.is_(None)):
+        listing = {'name': name, 'city': city, 'state': state, 'phone': phone}
+        compared = compare(values, listing)
+        if compared:
+            found.append((compared[0], id, listing, compared[1]))
+    found.sort(key=lambda match: (-match[0], match[1]))
+    return found[:current_app.config['DEDUP_CHECK_LIMIT']]
+
+#----------------------------------------------------------------------------#
+# Merging.
+#----------------------------------------------------------------------------#
+
+# Columns a merge copies from a duplicate when the kept listing has no value
+FILL_COLUMNS = ('phone', 'address', 'image_link', 'website', 'facebook_link', 'seeking_description')
+LISTINGS = {
+    'venue': (Venue, venue_genre_table, 'venue_id'),
+    'artist': (Artist, artist_genre_table, 'artist_id'),
+}
+
+
+def merge_listings(entity, keep_id, duplicate_ids):
+    '''Fold duplicate listings into keep_id; the caller commits.
+
+    Their shows (archived ones included) and genres move to the kept listing
+    with a few set-based statements, the kept listing takes over the column
+    values it lacks, and the duplicates are deleted.  Returns the number of
+    shows moved.
+    '''
+    model, genre_table, fk_name = LISTINGS[entity]
+    duplicate_ids = sorted(set(duplicate_ids) - {keep_id})
+    if not duplicate_ids:
+        raise ValueError('Nothing to merge')
+    fill = [column for column in FILL_COLUMNS if hasattr(model, column)]
+    columns = [model.id, model.version, model.city, model.state] + [getattr(model, column) for column in fill]
+    rows = {row.id: row for row in db.session.query(*columns).filter(model.id.in_([keep_id] + duplicate_ids))}
+    missing = [id for id in [keep_id] + duplicate_ids if id not in rows]
+    if missing:
+        raise LookupError(f'No {entity} {", ".join(map(str, missing))}')
+
+    moved = 0
+    for show_model in (Show, ShowArchive):
+        moved += show_model.query.filter(getattr(show_model, fk_name).in_(duplicate_ids)) \
+            .update({fk_name: keep_id}, synchronize_session=False)
+
+    fk = genre_table.c[fk_name]
+    kept_genres = {genre_id for (genre_id,) in db.session.query(genre_table.c.genre_id).filter(fk == keep_id)}
+    added = {genre_id for (genre_id,) in db.session.query(genre_table.c.genre_id).filter(fk.in_(duplicate_ids))} \
+        - kept_genres
+    if added:
+        db.session.execute(genre_table.insert(), [{'genre_id': genre_id, fk_name: keep_id} for genre_id in added])
+    db.session.execute(genre_table.delete().where(fk.in_(duplicate_ids)))
+
+    keep = rows[keep_id]
+    values = {}
+    for column in fill:
+        if not getattr(keep, column):
+            value = next((getattr(rows[id], column) for id in duplicate_ids if getattr(rows[id], column)), None)
+            if value:
+                values[column] = value
+    # Bumping the version makes an edit form opened before the merge stale
+    model.query.filter(model.id == keep_id).update(dict(values, version=model.version + 1), synchronize_session=False)
+    model.query.filter(model.id.in_(duplicate_ids)).delete(synchronize_session=False)
+
+    genres = [name for (name,) in db.session.query(Genre.name).join(genre_table, genre_table.c.genre_id == Genre.id)
+              .filter(fk == keep_id).order_by(Genre.name)]
+    record_change(entity, keep_id, 'update', genres=genres, merged=duplicate_ids, **values)
+    for id in duplicate_ids:
+        record_change(entity, id, 'delete', merged_into=keep_id)
+    if entity == 'venue':
+        for area in {(rows[id].city, rows[id].state) for id in rows}:
+            bump_area(*area)
+    return moved
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+dedup_cli = AppGroup('dedup', help='Find and merge duplicate venues and artists.')
+ENTITIES = {'venues': 'venue', 'artists': 'artist'}
+
+
+def keeper(entity, group):
+    '''The listing of a group the others are merged into: the one with the most shows, then the oldest.'''
+    fk = getattr(Show, LISTINGS[entity][2])
+    shows = dict(db.session.query(fk, db.func.count(Show.id)).filter(fk.in_(group)).group_by(fk))
+    return min(group, key=lambda id: (-shows.get(id, 0), id))
+
+
+@dedup_cli.command('scan')
+@click.argument('kind', type=click.Choice(sorted(ENTITIES)))
+@click.option('--merge', is_flag=True, help='Merge every group found into its listing with the most shows.')
+def scan_command(kind, merge):
+    '''List the likely duplicates among the active venues or artists.'''
+    entity = ENTITIES[kind]
+    index = load_index(LISTINGS[entity][0])
+    pairs = duplicate_pairs(index)
+    for similarity, a, b, reasons in pairs:
+        first, second = index.listing(a), index.listing(b)
+        click.echo(f"{similarity:>5.2f}  {a:>7} {first['name'][:30]:<31}{b:>7} {second['name'][:30]:<31}"
+                   f"{first['city']}, {first['state']}  ({', '.join(reasons)})")
+    groups = group_pairs(pairs)
+    click.echo(f'{len(pairs)} likely duplicate pairs in {len(groups)} groups')
+    if not merge:
+        return
+
+    @transactional('dedup_merge')
+    def merge_groups():
+        merged, skipped = [], []
+        for group in groups:
+            keep_id = keeper(entity, group)
+            # A group whose listings changed since the scan is left out; the others still merge
+            try:
+                with savepoint('dedup_merge'):
+                    merged.append((keep_id, group, merge_listings(entity, keep_id, group)))
+            except (LookupError, IntegrityError):
+                skipped.append(group)
+        return merged, skipped
+
+    merged, skipped = merge_groups()
+    for keep_id, group, moved in merged:
+        click.echo(f'Merged {", ".join(str(id) for id in group if id != keep_id)} into {keep_id} '
+                   f'({moved} shows moved)')
+    for group in skipped:
+        click.echo(f'Skipped {", ".join(map(str, group))}: changed since the scan')
+
+
+@dedup_cli.command('merge')
+@click.argument('kind', type=click.Choice(sorted(ENTITIES)))
+@click.argument('keep_id', type=int)
+@click.argument('duplicate_ids', type=int, nargs=-1, required=True)
+def merge_command(kind, keep_id, duplicate_ids):
+    '''Merge DUPLICATE_IDS into KEEP_ID: their shows and genres move over, then they are deleted.'''
+    try:
+        moved = merge_listings(ENTITIES[kind], keep_id, duplicate_ids)
+    except (LookupError, ValueError) as e:
+        db.session.rollback()
+        raise click.ClickException(str(e))
+    db.session.commit()
+    click.echo(f'Merged {len(set(duplicate_ids) - {keep_id})} {kind} into {keep_id} ({moved} shows moved)')
@@ -0,0 +1,219 @@
+#IMPORTS
+import threading
+from collections import Counter
+from flask import current_app
+from models import db, Venue, Artist, Genre, venue_genre_table, artist_genre_table
+from changes import latest_position
+from typeahead import ListingIndex
+#----------------------------------------------------------------------------#
+# Faceted browsing from in-memory bitmap indexes.
+#
+# For every value of the few-valued facets (a genre, a state, seeking or not)
+# each worker keeps a bitmap of the active listings that have it: a Python int
+# whose bit n is set for the listing with id n.  A combination of filters is
+# then a few bitwise ORs (values of one facet) and ANDs (across facets), and a
+# facet count is a popcount, instead of joins through the genre association
+# tables.  Cities are too many for a bitmap each (every one as wide as the
+# largest id), so a city keeps the set of its listing ids, and the city counts
+# are tallied from the listings that pass the other filters.  The counts of
+# each facet are computed with the filters of the other facets only, so
+# picking a genre still shows how many listings the other genres would give.
+# Like the typeahead index, the index is built on first use and then follows
+# the change feed.
+#----------------------------------------------------------------------------#
+
+FACETS = ('genre', 'state', 'city', 'seeking')
+# The facets kept as bitmaps; 'city' has a value per area and keeps id sets
+BITMAP_FACETS = ('genre', 'state', 'seeking')
+
+
+def city_value(row):
+    # City names repeat across states
+    return f"{row['city']}, {row['state']}" if row.get('city') else None
+
+
+def facet_values(row):
+    '''{facet: set of values} of a listing row.'''
+    city = city_value(row)
+    return {
+        'genre': set(row.get('genres') or ()),
+        'state': {row['state']} if row.get('state') else set(),
+        'city': {city} if city else set(),
+        'seeking': {'yes' if row.get('seeking') else 'no'},
+    }
+
+
+# int.bit_count() is Python 3.10+; bin() is ten times slower but works everywhere
+popcount = getattr(int, 'bit_count', None) or (lambda bits: bin(bits).count('1'))
+
+
+def bitmap(ids):
+    '''An int with the bits of ids set, built in one go rather than an OR per id.'''
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for id in ids:
+        buffer[id >> 3] |= 1 << (id & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def bit_ids(bits):
+    '''The positions of the set bits, in order.'''
+    return [id for id, bit in enumerate(bin(bits)[:1:-1]) if bit == '1']
+
+
+class FacetIndex:
+
+    def __init__(self):
+        self._rows = {}         # id -> {'name', 'city', 'state', 'seeking', 'genres'}
+        # facet -> value -> bitmap, or frozenset of ids for the cities
+        self._values = {facet: {} for facet in FACETS}
+        self._all = 0
+        self._lock = threading.Lock()
+
+    def build(self, rows):
+        '''Replace the contents with {id: row}.'''
+        ids = {facet: {} for facet in FACETS}
+        for id, row in rows.items():
+            for facet, values in facet_values(row).items():
+                for value in values:
+                    ids[facet].setdefault(value, []).append(id)
+        values = {facet: {value: frozenset(value_ids) if facet == 'city' else bitmap(value_ids)
+                          for value, value_ids in facet_ids.items()}
+                  for facet, facet_ids in ids.items()}
+        everything = bitmap(rows)
+        with self._lock:
+            self._rows, self._values, self._all = rows, values, everything
+
+    def row(self, id):
+        return self._rows.get(id)
+
+    def put(self, id, row):
+        with self._lock:
+            self._discard(id)
+            self._rows[id] = row
+            self._all |= 1 << id
+            for facet, values in facet_values(row).items():
+                for value in values:
+                    if facet == 'city':
+                        self._values[facet][value] = self._values[facet].get(value, frozenset()) | {id}
+                    else:
+                        self._values[facet][value] = self._values[facet].get(value, 0) | 1 << id
+
+    def remove(self, id):
+        with self._lock:
+            self._discard(id)
+
+    def _discard(self, id):
+        row = self._rows.pop(id, None)
+        if row is None:
+            return
+        self._all &= ~(1 << id)
+        for facet, values in facet_values(row).items():
+            for value in values:
+                if facet == 'city':
+                    left = self._values[facet][value] - {id}
+                else:
+                    left = self._values[facet][value] & ~(1 << id)
+                if left:
+                    self._values[facet][value] = left
+                else:
+                    del self._values[facet][value]
+
+    def query(self, selected):
+        '''(matching ids sorted by name, {facet: {value: count}}) for {facet: set of values}.'''
+        with self._lock:
+            # Bitmaps (ints) and id sets (frozensets) are replaced, never changed in place, and
+            # put() replaces a listing's row dict, so shallow copies are a consistent view
+            rows, everything = dict(self._rows), self._all
+            values = {facet: dict(facet_values) for facet, facet_values in self._values.items()}
+        # Within a facet any selected value matches; across facets all must
+        filters = {}
+        for facet, chosen in selected.items():
+            if facet == 'city':
+                filters[facet] = bitmap(set().union(*(values[facet].get(value, ()) for value in chosen)))
+            else:
+                bits = 0
+                for value in chosen:
+                    bits |= values[facet].get(value, 0)
+                filters[facet] = bits
+
+        def combined(skip=None):
+            result = everything
+            for facet, bits in filters.items():
+                if facet != skip:
+                    result &= bits
+            return result
+
+        counts = {}
+        for facet in BITMAP_FACETS:
+            base = combined(skip=facet)
+            counts[facet] = {value: popcount(bits & base) for value, bits in values[facet].items()}
+        # One pass over the listings the other filters leave, however many cities there are
+        counts['city'] = Counter(city_value(rows[id]) for id in bit_ids(combined(skip='city')))
+        counts['city'].pop(None, None)
+        matches = [(id, rows[id]['name']) for id in bit_ids(combined())]
+        matches.sort(key=lambda match: (match[1] or '').lower())
+        return matches, counts
+
+
+class ListingFacets(ListingIndex):
+    '''A FacetIndex of one model's active listings, kept current from the change feed.'''
+
+    refresh_setting = 'FACETS_REFRESH_INTERVAL'
+    rebuild_setting = 'FACETS_REBUILD_INTERVAL'
+
+    def __init__(self, model, entity, genre_table, fk_name, seeking):
+        super().__init__(model, entity)
+        self.index = FacetIndex()
+        self.genre_table, self.fk_name, self.seeking = genre_table, fk_name, seeking
+
+    def rebuild(self):
+        cursor = latest_position()
+        model = self.model
+        rows = {id: {'name': name, 'city': city, 'state': state, 'seeking': seeking, 'genres': []}
+                for id, name, city, state, seeking in
+                db.session.query(model.id, model.name, model.city, model.state, getattr(model, self.seeking))
+                .filter(model.archived_at.is_(None))}
+        for id, genre in db.session.query(self.genre_table.c[self.fk_name], Genre.name) \
+                .join(Genre, Genre.id == self.genre_table.c.genre_id):
+            if id in rows:
+                rows[id]['genres'].append(genre)
+        self.index.build(rows)
+        self.cursor = cursor
+
+    def apply(self, entity_id, op, data):
+        if op in ('archive', 'delete'):
+            self.index.remove(entity_id)
+            return
+        # Update events only carry the columns that changed (and always the genres)
+        row = dict(self.index.row(entity_id) or {})
+        if not row and op != 'create':
+            return      # not in the index (yet); the next rebuild has it
+        for key in ('name', 'city', 'state', 'genres'):
+            if key in data:
+                row[key] = data[key]
+        if self.seeking in data:
+            row['seeking'] = data[self.seeking]
+        self.index.put(entity_id, row)
+
+    def browse(self, selected):
+        return self.current().query(selected)
+
+
+def facet_choices(counts, selected):
+    '''Per facet, the values worth listing: the selected ones and the most common others.'''
+    size = current_app.config['FACETS_MAX_VALUES']
+    choices = {}
+    for facet in FACETS:
+        chosen = selected.get(facet, set())
+        ranked = sorted(((count, value) for value, count in counts[facet].items() if count and value not in chosen),
+                        key=lambda item: (-item[0], item[1]))
+        choices[facet] = [(value, counts[facet].get(value, 0), True) for value in sorted(chosen)] + \
+                         [(value, count, False) for count, value in ranked[:size]]
+    return choices
+
+
+venue_facets = ListingFacets(Venue, 'venue', venue_genre_table, 'venue_id', 'seeking_talent')
+artist_facets = ListingFacets(Artist, 'artist', artist_genre_table, 'artist_id', 'seeking_venue')
@@ -1,7 +1,127 @@
+import re
 from datetime import datetime
 from flask_wtf import FlaskForm
-from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField
-from wtforms.validators import DataRequired, AnyOf, URL, Optional
+from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, IntegerField, TextAreaField, BooleanField
+from wtforms.widgets import HiddenInput
+from wtforms.validators import DataRequired, AnyOf, URL, Optional, NumberRange
+
+# Choice tables shared by every form instance.  The frozensets make choice
+# validation a single membership test instead of a scan of the list.
+STATE_CHOICES = (
+    ('AL', 'AL'),
+    ('AK', 'AK'),
+    ('AZ', 'AZ'),
+    ('AR', 'AR'),
+    ('CA', 'CA'),
+    ('CO', 'CO'),
+    ('CT', 'CT'),
+    ('DE', 'DE'),
+    ('DC', 'DC'),
+    ('FL', 'FL'),
+    ('GA', 'GA'),
+    ('HI', 'HI'),
+    ('ID', 'ID'),
+    ('IL', 'IL'),
+    ('IN', 'IN'),
+    ('IA', 'IA'),
+    ('KS', 'KS'),
+    ('KY', 'KY'),
+    ('LA', 'LA'),
+    ('ME', 'ME'),
+    ('MT', 'MT'),
+    ('NE', 'NE'),
+    ('NV', 'NV'),
+    ('NH', 'NH'),
+    ('NJ', 'NJ'),
+    ('NM', 'NM'),
+    ('NY', 'NY'),
+    ('NC', 'NC'),
+    ('ND', 'ND'),
+    ('OH', 'OH'),
+    ('OK', 'OK'),
+    ('OR', 'OR'),
+    ('MD', 'MD'),
+    ('MA', 'MA'),
+    ('MI', 'MI'),
+    ('MN', 'MN'),
+    ('MS', 'MS'),
+    ('MO', 'MO'),
+    ('PA', 'PA'),
+    ('RI', 'RI'),
+    ('SC', 'SC'),
+    ('SD', 'SD'),
+    ('TN', 'TN'),
+    ('TX', 'TX'),
+    ('UT', 'UT'),
+    ('VT', 'VT'),
+    ('VA', 'VA'),
+    ('WA', 'WA'),
+    ('WV', 'WV'),
+    ('WI', 'WI'),
+    ('WY', 'WY'),
+)
+GENRE_CHOICES = (
+    ('Alternative', 'Alternative'),
+    ('Blues', 'Blues'),
+    ('Classical', 'Classical'),
+    ('Country', 'Country'),
+    ('Electronic', 'Electronic'),
+    ('Folk', 'Folk'),
+    ('Funk', 'Funk'),
+    ('Hip-Hop', 'Hip-Hop'),
+    ('Heavy Metal', 'Heavy Metal'),
+    ('Instrumental', 'Instrumental'),
+    ('Jazz', 'Jazz'),
+    ('Musical Theatre', 'Musical Theatre'),
+    ('Pop', 'Pop'),
+    ('Punk', 'Punk'),
+    ('R&B', 'R&B'),
+    ('Reggae', 'Reggae'),
+    ('Rock n Roll', 'Rock n Roll'),
+    ('Soul', 'Soul'),
+    ('Other', 'Other'),
+)
+SEEKING_CHOICES = (
+    ('Yes', 'Yes'),
+    ('No', 'No'),
+)
+TOUR_MODE_CHOICES = (
+    ('Yes', 'Book nothing if any date fails'),
+    ('No', 'Book the dates that are valid'),
+)
+STATES = frozenset(value for value, _ in STATE_CHOICES)
+GENRES = frozenset(value for value, _ in GENRE_CHOICES)
+SEEKING = frozenset(value for value, _ in SEEKING_CHOICES)
+TOUR_MODES = frozenset(value for value, _ in TOUR_MODE_CHOICES)
+
+# Anything in a phone number that isn't a digit
+NON_DIGITS = re.compile(r'\D')
+
+
+class ChoiceSetSelectField(SelectField):
+    '''SelectField checking the submitted value against a shared frozenset.'''
+
+    def __init__(self, label=None, validators=None, choice_set=frozenset(), **kwargs):
+        super().__init__(label, validators, **kwargs)
+        self.choice_set = choice_set
+
+    def pre_validate(self, form):
+        if self.data not in self.choice_set:
+            raise ValueError(self.gettext('Not a valid choice'))
+
+
+class ChoiceSetSelectMultipleField(SelectMultipleField):
+    '''SelectMultipleField checking every submitted value against a shared frozenset.'''
+
+    def __init__(self, label=None, validators=None, choice_set=frozenset(), **kwargs):
+        super().__init__(label, validators, **kwargs)
+        self.choice_set = choice_set
+
+    def pre_validate(self, form):
+        for value in self.data or ():
+            if value not in self.choice_set:
+                raise ValueError(self.gettext("'%(value)s' is not a valid choice for this field") % dict(value=value))
+
 
 class ShowForm(FlaskForm):
     artist_id = StringField(
@@ -13,9 +133,58 @@ class ShowForm(FlaskForm):
     start_time = DateTimeField(
         'start_time',
         validators=[DataRequired()],
-        default= datetime.today()
+        default=datetime.today    # called per form, not once at import
+    )
+
+class TourForm(FlaskForm):
+    artist_id = IntegerField(
+        'artist_id', validators=[DataRequired()]
+    )
+    # One stop per line: "venue_id, YYYY-MM-DD HH:MM"
+    stops = TextAreaField(
+        'stops', validators=[DataRequired()]
+    )
+    all_or_nothing = ChoiceSetSelectField(
+        'all_or_nothing', validators=[DataRequired()],
+        choices=TOUR_MODE_CHOICES, choice_set=TOUR_MODES
     )
 
+    def parsed_stops(self):
+        # ([(line number, venue_id, start_time)], [(line number, reason)]) for the stops box
+        stops, unreadable = [], []
+        for number, line in enumerate(self.stops.data.splitlines(), 1):
+            if not line.strip():
+                continue
+            venue_id, _, start_time = line.partition(',')
+            try:
+                stops.append((number, int(venue_id), parse_start_time(start_time.strip())))
+            except ValueError:
+                unreadable.append((number, 'expected "venue_id, YYYY-MM-DD HH:MM"'))
+        return stops, unreadable
+
+
+class HoldForm(FlaskForm):
+    tier_id = IntegerField(
+        'tier_id', validators=[DataRequired()]
+    )
+    # The upper bound is TICKET_MAX_PER_HOLD, checked by the controller
+    quantity = IntegerField(
+        'quantity', validators=[DataRequired(), NumberRange(min=1)], default=1
+    )
+
+class TicketActionForm(FlaskForm):
+    # Purchase / release buttons on a hold: only the CSRF token
+    pass
+
+
+def parse_start_time(value):
+    for format in ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError(value)
+
 class VenueForm(FlaskForm):
     name = StringField(
         'name', validators=[DataRequired()]
@@ -23,61 +192,9 @@ class VenueForm(FlaskForm):
     city = StringField(
         'city', validators=[DataRequired()]
     )
-    state = SelectField(
+    state = ChoiceSetSelectField(
         'state', validators=[DataRequired()],
-        choices=[
-            ('AL', 'AL'),
-            ('AK', 'AK'),
-            ('AZ', 'AZ'),
-            ('AR', 'AR'),
-            ('CA', 'CA'),
-            ('CO', 'CO'),
-            ('CT', 'CT'),
-            ('DE', 'DE'),
-            ('DC', 'DC'),
-            ('FL', 'FL'),
-            ('GA', 'GA'),
-            ('HI', 'HI'),
-            ('ID', 'ID'),
-            ('IL', 'IL'),
-            ('IN', 'IN'),
-            ('IA', 'IA'),
-            ('KS', 'KS'),
-            ('KY', 'KY'),
-            ('LA', 'LA'),
-            ('ME', 'ME'),
-            ('MT', 'MT'),
-            ('NE', 'NE'),
-            ('NV', 'NV'),
-            ('NH', 'NH'),
-            ('NJ', 'NJ'),
-            ('NM', 'NM'),
-            ('NY', 'NY'),
-            ('NC', 'NC'),
-            ('ND', 'ND'),
-            ('OH', 'OH'),
-            ('OK', 'OK'),
-            ('OR', 'OR'),
-            ('MD', 'MD'),
-            ('MA', 'MA'),
-            ('MI', 'MI'),
-            ('MN', 'MN'),
-            ('MS', 'MS'),
-            ('MO', 'MO'),
-            ('PA', 'PA'),
-            ('RI', 'RI'),
-            ('SC', 'SC'),
-            ('SD', 'SD'),
-            ('TN', 'TN'),
-            ('TX', 'TX'),
-            ('UT', 'UT'),
-            ('VT', 'VT'),
-            ('VA', 'VA'),
-            ('WA', 'WA'),
-            ('WV', 'WV'),
-            ('WI', 'WI'),
-            ('WY', 'WY'),
-        ]
+        choices=STATE_CHOICES, choice_set=STATES
     )
     address = StringField(
         'address', validators=[DataRequired()]
@@ -91,43 +208,43 @@ class VenueForm(FlaskForm):
     website = StringField(
         'website', validators=[Optional(), URL()]
     )
-    seeking_talent = SelectField(
+    seeking_talent = ChoiceSetSelectField(
         'seeking_talent', validators=[DataRequired()],
-        choices=[
-            ('Yes', 'Yes'),
-            ('No', 'No')
-        ]
+        choices=SEEKING_CHOICES, choice_set=SEEKING
     )
     seeking_description = StringField(
         'seeking_description', validators=[Optional()]
     )
-    genres = SelectMultipleField(
+    genres = ChoiceSetSelectMultipleField(
         'genres', validators=[DataRequired()],
-        choices=[
-            ('Alternative', 'Alternative'),
-            ('Blues', 'Blues'),
-            ('Classical', 'Classical'),
-            ('Country', 'Country'),
-            ('Electronic', 'Electronic'),
-            ('Folk', 'Folk'),
-            ('Funk', 'Funk'),
-            ('Hip-Hop', 'Hip-Hop'),
-            ('Heavy Metal', 'Heavy Metal'),
-            ('Instrumental', 'Instrumental'),
-            ('Jazz', 'Jazz'),
-            ('Musical Theatre', 'Musical Theatre'),
-            ('Pop', 'Pop'),
-            ('Punk', 'Punk'),
-            ('R&B', 'R&B'),
-            ('Reggae', 'Reggae'),
-            ('Rock n Roll', 'Rock n Roll'),
-            ('Soul', 'Soul'),
-            ('Other', 'Other'),
-        ]
+        choices=GENRE_CHOICES, choice_set=GENRES
     )
     facebook_link = StringField(
         'facebook_link', validators=[Optional(), URL()]
     )
+    # Row version the edit form was loaded with (see Venue.version); a value that isn't a number fails validation
+    version = IntegerField(
+        'version', validators=[Optional()], widget=HiddenInput()
+    )
+    # Ticked to list it anyway after the create form showed likely duplicates (see dedup.py)
+    confirm_duplicate = BooleanField(
+        'confirm_duplicate', default=False
+    )
+
+    def listing_values(self):
+        # Normalized Venue column values; only call after validate()
+        return {
+            'name': self.name.data.strip(),
+            'city': self.city.data.strip(),
+            'state': self.state.data,
+            'address': self.address.data.strip(),
+            'phone': NON_DIGITS.sub('', self.phone.data),   # e.g. (819) 392-1234 --> 8193921234
+            'seeking_talent': self.seeking_talent.data == 'Yes',
+            'seeking_description': self.seeking_description.data.strip(),
+            'image_link': self.image_link.data.strip(),
+            'website': self.website.data.strip(),
+            'facebook_link': self.facebook_link.data.strip(),
+        }
 
 class ArtistForm(FlaskForm):
     name = StringField(
@@ -136,61 +253,9 @@ class ArtistForm(FlaskForm):
     city = StringField(
         'city', validators=[DataRequired()]
     )
-    state = SelectField(
+    state = ChoiceSetSelectField(
         'state', validators=[DataRequired()],
-        choices=[
-            ('AL', 'AL'),
-            ('AK', 'AK'),
-            ('AZ', 'AZ'),
-            ('AR', 'AR'),
-            ('CA', 'CA'),
-            ('CO', 'CO'),
-            ('CT', 'CT'),
-            ('DE', 'DE'),
-            ('DC', 'DC'),
-            ('FL', 'FL'),
-            ('GA', 'GA'),
-            ('HI', 'HI'),
-            ('ID', 'ID'),
-            ('IL', 'IL'),
-            ('IN', 'IN'),
-            ('IA', 'IA'),
-            ('KS', 'KS'),
-            ('KY', 'KY'),
-            ('LA', 'LA'),
-            ('ME', 'ME'),
-            ('MT', 'MT'),
-            ('NE', 'NE'),
-            ('NV', 'NV'),
-            ('NH', 'NH'),
-            ('NJ', 'NJ'),
-            ('NM', 'NM'),
-            ('NY', 'NY'),
-            ('NC', 'NC'),
-            ('ND', 'ND'),
-            ('OH', 'OH'),
-            ('OK', 'OK'),
-            ('OR', 'OR'),
-            ('MD', 'MD'),
-            ('MA', 'MA'),
-            ('MI', 'MI'),
-            ('MN', 'MN'),
-            ('MS', 'MS'),
-            ('MO', 'MO'),
-            ('PA', 'PA'),
-            ('RI', 'RI'),
-            ('SC', 'SC'),
-            ('SD', 'SD'),
-            ('TN', 'TN'),
-            ('TX', 'TX'),
-            ('UT', 'UT'),
-            ('VT', 'VT'),
-            ('VA', 'VA'),
-            ('WA', 'WA'),
-            ('WV', 'WV'),
-            ('WI', 'WI'),
-            ('WY', 'WY'),
-        ]
+        choices=STATE_CHOICES, choice_set=STATES
     )
     phone = StringField(
         'phone', validators=[DataRequired()]
@@ -201,40 +266,39 @@ class ArtistForm(FlaskForm):
     website = StringField(
         'website', validators=[Optional(), URL()]
     )
-    seeking_venue = SelectField(
+    seeking_venue = ChoiceSetSelectField(
         'seeking_venue', validators=[DataRequired()],
-        choices=[
-            ('Yes', 'Yes'),
-            ('No', 'No')
-        ]
+        choices=SEEKING_CHOICES, choice_set=SEEKING
     )
     seeking_description = StringField(
         'seeking_description', validators=[Optional()]
     )
-    genres = SelectMultipleField(
+    genres = ChoiceSetSelectMultipleField(
         'genres', validators=[DataRequired()],
-        choices=[
-            ('Alternative', 'Alternative'),
-            ('Blues', 'Blues'),
-            ('Classical', 'Classical'),
-            ('Country', 'Country'),
-            ('Electronic', 'Electronic'),
-            ('Folk', 'Folk'),
-            ('Funk', 'Funk'),
-            ('Hip-Hop', 'Hip-Hop'),
-            ('Heavy Metal', 'Heavy Metal'),
-            ('Instrumental', 'Instrumental'),
-            ('Jazz', 'Jazz'),
-            ('Musical Theatre', 'Musical Theatre'),
-            ('Pop', 'Pop'),
-            ('Punk', 'Punk'),
-            ('R&B', 'R&B'),
-            ('Reggae', 'Reggae'),
-            ('Rock n Roll', 'Rock n Roll'),
-            ('Soul', 'Soul'),
-            ('Other', 'Other'),
-        ]
+        choices=GENRE_CHOICES, choice_set=GENRES
     )
     facebook_link = StringField(
         'facebook_link', validators=[Optional(), URL()]    # Can chain these
-    )
\ No newline at end of file
+    )
+    # Row version the edit form was loaded with (see Artist.version); a value that isn't a number fails validation
+    version = IntegerField(
+        'version', validators=[Optional()], widget=HiddenInput()
+    )
+    # Ticked to list it anyway after the create form showed likely duplicates (see dedup.py)
+    confirm_duplicate = BooleanField(
+        'confirm_duplicate', default=False
+    )
+
+    def listing_values(self):
+        # Normalized Artist column values; only call after validate()
+        return {
+            'name': self.name.data.strip(),
+            'city': self.city.data.strip(),
+            'state': self.state.data,
+            'phone': NON_DIGITS.sub('', self.phone.data),   # e.g. (819) 392-1234 --> 8193921234
+            'seeking_venue': self.seeking_venue.data == 'Yes',
+            'seeking_description': self.seeking_description.data.strip(),
+            'image_link': self.image_link.data.strip(),
+            'website': self.website.data.strip(),
+            'facebook_link': self.facebook_link.data.strip(),
+        }
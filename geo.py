@@ -0,0 +1,159 @@
+#IMPORTS
+import csv
+import math
+import os
+from functools import lru_cache
+import click
+from flask.cli import AppGroup
+from sqlalchemy import and_, or_
+from models import db, Venue, Artist
+from online_migrations import backfill
+#----------------------------------------------------------------------------#
+# Offline geocoding and proximity search.
+#
+# Venues and artists are geocoded from their city/state against a gazetteer
+# bundled in data/gazetteer.csv (falling back to the state's centroid), so no
+# external service is ever called.  Each row stores its geohash; the geohash
+# column is indexed, so a radius search is a few dozen prefix range scans
+# ('{' sorts right after 'z') followed by an exact distance check on the
+# candidates.  The controllers cap the radius at GEO_MAX_RADIUS_KM.
+#----------------------------------------------------------------------------#
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gazetteer.csv')
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9      # ~5 m cells, stored on every row
+EARTH_RADIUS_KM = 6371.0
+
+
+@lru_cache(maxsize=1)
+def gazetteer():
+    '''{(state, lower-case city): (lat, lon)}; the state centroid is under (state, '').'''
+    with open(GAZETTEER_PATH, newline='') as f:
+        return {(row['state'], row['city'].strip().lower()): (float(row['latitude']), float(row['longitude']))
+                for row in csv.DictReader(f)}
+
+
+def geocode(city, state):
+    '''(lat, lon) for a city, the state's centroid if the city isn't known, else None.'''
+    places = gazetteer()
+    return places.get((state, (city or '').strip().lower())) or places.get((state, ''))
+
+
+def location_values(city, state):
+    # Column values for Venue/Artist, so they can go through create and update_listing() like any field
+    point = geocode(city, state)
+    if point is None:
+        return {'latitude': None, 'longitude': None, 'geohash': None}
+    return {'latitude': point[0], 'longitude': point[1], 'geohash': encode_geohash(*point)}
+
+
+def encode_geohash(lat, lon, precision=GEOHASH_PRECISION):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, longitude first
+        interval, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+def cell_size_km(precision, lat):
+    '''(height, width) of a geohash cell at the given latitude.'''
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = precision * 5 // 2
+    height = 180.0 / 2 ** lat_bits * 110.574
+    width = 360.0 / 2 ** lon_bits * 111.320 * max(math.cos(math.radians(lat)), 0.01)
+    return height, width
+
+
+def covering_cells(lat, lon, radius_km, max_cells=32):
+    '''Geohash prefixes whose cells together cover the circle's bounding box.
+
+    Uses the finest precision that needs at most max_cells cells, so the
+    candidate set stays close to the circle itself.
+    '''
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size_km(precision, lat)
+        rows, columns = math.ceil(2 * radius_km / height) + 1, math.ceil(2 * radius_km / width) + 1
+        if rows * columns <= max_cells or precision == 1:
+            break
+    km_per_lat = 110.574
+    km_per_lon = 111.320 * max(math.cos(math.radians(lat)), 0.01)
+    cells = set()
+    for i in range(rows + 1):
+        cell_lat = max(min(lat - radius_km / km_per_lat + i * height / km_per_lat, 90.0), -90.0)
+        for j in range(columns + 1):
+            cell_lon = lon - radius_km / km_per_lon + j * width / km_per_lon
+            cells.add(encode_geohash(cell_lat, (cell_lon + 180.0) % 360.0 - 180.0, precision))
+    return cells
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    # Haversine
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def within(model, lat, lon, radius_km, limit=50):
+    '''[(id, name, city, state, distance_km)] of model rows within radius_km, nearest first.'''
+    cells = covering_cells(lat, lon, radius_km)
+    candidates = db.session.query(model.id, model.name, model.city, model.state, model.latitude, model.longitude) \
+        .filter(or_(*[and_(model.geohash >= cell, model.geohash < cell + '{') for cell in cells]),
+                model.archived_at.is_(None)).all()
+    results = []
+    for id, name, city, state, row_lat, row_lon in candidates:
+        distance = distance_km(lat, lon, row_lat, row_lon)
+        if distance <= radius_km:
+            results.append((id, name, city, state, round(distance, 1)))
+    results.sort(key=lambda result: result[4])
+    return results[:limit]
+
+
+# Throttled, resumable alternative to `flask geo backfill`: flask migrations backfill geocode-venues
+@backfill('geocode-venues', Venue, (Venue.city, Venue.state), where=Venue.geohash.is_(None))
+def geocode_venues(rows):
+    return [dict(location_values(city, state), id=id) for id, city, state in rows]
+
+
+@backfill('geocode-artists', Artist, (Artist.city, Artist.state), where=Artist.geohash.is_(None))
+def geocode_artists(rows):
+    return [dict(location_values(city, state), id=id) for id, city, state in rows]
+
+
+def venue_location(venue_id):
+    return db.session.query(Venue.latitude, Venue.longitude).filter(Venue.id == venue_id).one_or_none()
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+geo_cli = AppGroup('geo', help='Geocode venues and artists.')
+
+
+@geo_cli.command('backfill')
+@click.option('--batch-size', type=int, default=500)
+def backfill_command(batch_size):
+    '''Geocode every venue and artist from its city/state.'''
+    for model in (Venue, Artist):
+        # Rows are grouped by place, so every distinct city costs one UPDATE
+        places = db.session.query(model.city, model.state).distinct().all()
+        for count, (city, state) in enumerate(places, 1):
+            model.query.filter(model.city == city, model.state == state) \
+                .update(location_values(city, state), synchronize_session=False)
+            if count % batch_size == 0:
+                db.session.commit()
+        db.session.commit()
+        click.echo(f'{model.__name__}: geocoded {len(places)} places')
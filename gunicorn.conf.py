@@ -0,0 +1,54 @@
+#IMPORTS
+import os
+from config import WEB_WORKERS, WEB_THREADS
+#----------------------------------------------------------------------------#
+# gunicorn settings; `gunicorn app:app` picks this file up from the working
+# directory.
+#
+# The app is loaded once in the master and forked, so the workers share its
+# memory copy-on-write.  Workers are recycled after max_requests to cap memory
+# growth.
+#
+# Because of the preloading, `kill -HUP <master pid>` only re-forks workers
+# from the code the master already loaded: a deploy does not take effect
+# that way.  To switch to new code without dropping requests:
+#
+#   kill -USR2 <master pid>     # a new master (with the new code) and its workers start
+#   kill -WINCH <old pid>       # the old master's workers finish their requests and exit
+#   kill -QUIT <old pid>        # the old master exits
+#
+# (the old master's pid is in the pid file with a .oldbin suffix).  Set
+# GUNICORN_PRELOAD=0 to load the app in every worker instead; HUP then
+# reloads the code, at the cost of the shared memory.
+#----------------------------------------------------------------------------#
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = WEB_WORKERS
+threads = WEB_THREADS
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+# Recycle each worker after about this many requests; the jitter keeps them from all restarting at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    from flask_sqlalchemy import get_state
+    from app import app
+    from config import pool_options
+    from models import db
+    with app.app_context():
+        # Connections opened while preloading belong to the master; each worker opens its own
+        db.engine.dispose()
+        # The pool share depends on how many workers gunicorn actually runs, which the command
+        # line (--workers, --threads) or TTIN/TTOU may have changed; drop the engine so it is
+        # created again with the new size
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = pool_options(server.num_workers, server.cfg.threads)
+        get_state(app).connectors.clear()
@@ -0,0 +1,241 @@
+#IMPORTS
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Process
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func
+from models import db, Job, Venue, Artist, venue_genre_table, artist_genre_table
+from writes import delete_listing_in_batches
+#----------------------------------------------------------------------------#
+# Background jobs.
+#
+# A small queue kept in the Job table, so no broker is needed.  Controllers
+# call enqueue() inside their own transaction (the job only exists if the
+# write commits) and `flask jobs work` runs the queued jobs in a pool of
+# worker processes, retrying failures with exponential backoff.
+#
+# A job whose worker died mid-run stays 'running'; the workers put jobs that
+# have been running for longer than JOB_TIMEOUT back in the queue, so tasks
+# must be safe to run again.  Periodic tasks (@periodic) queue their next run
+# after every run, whether it succeeded, failed for good or was abandoned.
+#----------------------------------------------------------------------------#
+
+# Task name -> function.  Tasks take the JSON payload as keyword arguments.
+TASKS = {}
+
+
+def task(fn):
+    TASKS[fn.__name__] = fn
+    return fn
+
+
+# Periodic task name -> config key of the seconds between its runs
+PERIODIC = {}
+# Periodic tasks `flask jobs work` starts by itself; the others start with their own command
+AUTOSTART = set()
+
+
+def periodic(interval_key, autostart=False):
+    '''@task that runs again app.config[interval_key] seconds after each run, once started.
+
+    With autostart the workers start it when they start, so it runs on a
+    fresh deploy without anyone running its command first.
+    '''
+    def register(fn):
+        PERIODIC[fn.__name__] = interval_key
+        if autostart:
+            AUTOSTART.add(fn.__name__)
+        return task(fn)
+    return register
+
+
+def enqueue(name, delay=0, **payload):
+    '''Add a job to the current session; it is queued when the caller commits.'''
+    if name not in TASKS:
+        raise KeyError(f'Unknown task {name}')
+    job = Job(name=name, payload=json.dumps(payload),
+              max_attempts=current_app.config['JOB_MAX_ATTEMPTS'],
+              run_at=datetime.utcnow() + timedelta(seconds=delay))
+    db.session.add(job)
+    return job
+
+
+def enqueue_once(name, delay=0, **payload):
+    '''enqueue() unless a job for the same task is already waiting to run.'''
+    if db.session.query(Job.id).filter(Job.name == name, Job.status == 'queued').first() is None:
+        return enqueue(name, delay, **payload)
+
+
+def schedule_next(name):
+    '''Queue the next run of a periodic task (a no-op if one is already waiting).'''
+    return enqueue_once(name, delay=current_app.config[PERIODIC[name]])
+
+
+def start_periodic():
+    '''Queue a run now of every autostart task that isn't waiting to run already.'''
+    for name in sorted(AUTOSTART):
+        enqueue_once(name)
+    db.session.commit()
+
+
+def claim_next():
+    '''Mark the oldest runnable job as running and return (id, name, payload, attempts, max_attempts).'''
+    while True:
+        job = db.session.query(Job.id, Job.name, Job.payload, Job.attempts, Job.max_attempts) \
+            .filter(Job.status == 'queued', Job.run_at <= datetime.utcnow()) \
+            .order_by(Job.run_at) \
+            .with_for_update(skip_locked=True) \
+            .first()
+        if job is None:
+            db.session.rollback()
+            return None
+        # The status guard makes the claim safe even where SKIP LOCKED isn't available (SQLite)
+        claimed = Job.query.filter(Job.id == job.id, Job.status == 'queued') \
+            .update({'status': 'running', 'started_at': datetime.utcnow(), 'attempts': Job.attempts + 1},
+                    synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job
+
+
+def run_next():
+    '''Run one job.  Returns False when nothing was runnable.'''
+    job = claim_next()
+    if job is None:
+        return False
+    attempts = job.attempts + 1
+    try:
+        TASKS[job.name](**json.loads(job.payload))
+        db.session.commit()
+        values = {'status': 'done', 'finished_at': datetime.utcnow(), 'last_error': None}
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f'Exception "{e}" in job {job.id} {job.name} (attempt {attempts})')
+        if attempts < job.max_attempts:
+            # Exponential backoff with a little jitter so retries don't line up
+            backoff = current_app.config['JOB_RETRY_BACKOFF'] * 2 ** (attempts - 1) * random.uniform(0.8, 1.2)
+            values = {'status': 'queued', 'run_at': datetime.utcnow() + timedelta(seconds=backoff), 'last_error': repr(e)}
+        else:
+            values = {'status': 'failed', 'finished_at': datetime.utcnow(), 'last_error': repr(e)}
+    Job.query.filter(Job.id == job.id).update(values, synchronize_session=False)
+    # Not only after a success: a chain that stops at its first failure stops for good
+    if job.name in PERIODIC:
+        schedule_next(job.name)
+    db.session.commit()
+    return True
+
+
+def reclaim_abandoned():
+    '''Requeue jobs left 'running' for longer than JOB_TIMEOUT by a worker that died
+    (or fail them if that was their last attempt).  Returns how many it reclaimed.'''
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=current_app.config['JOB_TIMEOUT'])
+    abandoned = db.session.query(Job.id, Job.name, Job.attempts, Job.max_attempts) \
+        .filter(Job.status == 'running', Job.started_at < cutoff) \
+        .with_for_update(skip_locked=True) \
+        .all()
+    count = 0
+    for job in abandoned:
+        error = f'abandoned after running for more than {current_app.config["JOB_TIMEOUT"]}s'
+        current_app.logger.error(f'Job {job.id} {job.name} {error} (attempt {job.attempts})')
+        if job.attempts < job.max_attempts:
+            values = {'status': 'queued', 'run_at': now, 'last_error': error}
+        else:
+            values = {'status': 'failed', 'finished_at': now, 'last_error': error}
+        # The guard skips a job that finished after all while we were looking
+        reclaimed = Job.query.filter(Job.id == job.id, Job.status == 'running', Job.started_at < cutoff) \
+            .update(values, synchronize_session=False)
+        count += reclaimed
+        if reclaimed and values['status'] == 'failed' and job.name in PERIODIC:
+            schedule_next(job.name)
+    db.session.commit()
+    return count
+
+
+def work(app, poll_interval, burst=False):
+    '''Worker loop: run jobs until interrupted (or, with burst, until the queue is empty).'''
+    with app.app_context():
+        # Never reuse connections inherited from the parent process
+        db.get_engine().dispose()
+        next_reclaim = 0
+        try:
+            while True:
+                if time.monotonic() >= next_reclaim:
+                    reclaim_abandoned()
+                    next_reclaim = time.monotonic() + app.config['JOB_RECLAIM_INTERVAL']
+                if not run_next():
+                    if burst:
+                        return
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            db.session.remove()
+
+
+def job_metrics():
+    '''Counts and attempts per task and status, plus the age of the oldest queued job.'''
+    rows = db.session.query(Job.name, Job.status, func.count(Job.id), func.sum(Job.attempts)) \
+        .group_by(Job.name, Job.status).order_by(Job.name, Job.status).all()
+    oldest = db.session.query(func.min(Job.created_at)).filter(Job.status == 'queued').scalar()
+    return {
+        'tasks': [{'name': name, 'status': status, 'count': count, 'attempts': attempts or 0}
+                  for name, status, count, attempts in rows],
+        'oldest_queued_seconds': (datetime.utcnow() - oldest).total_seconds() if oldest else 0,
+    }
+
+#----------------------------------------------------------------------------#
+# Tasks.
+#----------------------------------------------------------------------------#
+
+LISTINGS = {
+    'Venue': (Venue, venue_genre_table, 'venue_id'),
+    'Artist': (Artist, artist_genre_table, 'artist_id'),
+}
+
+
+@task
+def purge_listing(kind, obj_id):
+    # Follow-up of a delete too large to run inside the request (see delete_venue())
+    model, genre_table, fk_name = LISTINGS[kind]
+    delete_listing_in_batches(model, genre_table, fk_name, obj_id, current_app.config['LISTING_DELETE_BATCH_SIZE'])
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+jobs_cli = AppGroup('jobs', help='Run and inspect background jobs.')
+
+
+@jobs_cli.command('work')
+@click.option('--workers', type=int, default=None, help='Worker processes (default JOB_WORKERS).')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty.')
+def work_command(workers, burst):
+    app = current_app._get_current_object()
+    workers = workers or app.config['JOB_WORKERS']
+    poll_interval = app.config['JOB_POLL_INTERVAL']
+    start_periodic()
+    if workers == 1:
+        work(app, poll_interval, burst)
+        return
+    pool = [Process(target=work, args=(app, poll_interval, burst)) for _ in range(workers)]
+    for process in pool:
+        process.start()
+    try:
+        for process in pool:
+            process.join()
+    except KeyboardInterrupt:
+        for process in pool:
+            process.join()
+
+
+@jobs_cli.command('stats')
+def stats_command():
+    metrics = job_metrics()
+    for row in metrics['tasks']:
+        click.echo(f"{row['name']:<30} {row['status']:<8} {row['count']:>8} jobs {row['attempts']:>8} attempts")
+    click.echo(f"oldest queued job: {metrics['oldest_queued_seconds']:.0f}s")
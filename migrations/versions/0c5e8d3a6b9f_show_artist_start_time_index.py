@@ -0,0 +1,25 @@
+"""Index Show on (artist_id, start_time), built without blocking writes
+
+Revision ID: 0c5e8d3a6b9f
+Revises: f4a9b2c7d1e3
+Create Date: 2026-10-19 18:52:33.870146
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '0c5e8d3a6b9f'
+down_revision = 'f4a9b2c7d1e3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_concurrently('ix_Show_artist_id_start_time', 'Show', ['artist_id', 'start_time'])
+
+
+def downgrade():
+    drop_index_concurrently('ix_Show_artist_id_start_time', 'Show')
@@ -0,0 +1,60 @@
+"""Ticket tiers, striped stock and holds
+
+Revision ID: 2e6b9d4f8a17
+Revises: 0c5e8d3a6b9f
+Create Date: 2026-10-19 21:12:48.530126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e6b9d4f8a17'
+down_revision = '0c5e8d3a6b9f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('TicketTier',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('show_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=80), nullable=False),
+    sa.Column('price_cents', sa.Integer(), nullable=False),
+    sa.Column('capacity', sa.Integer(), nullable=False),
+    sa.Column('stripes', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_TicketTier_show_id'), 'TicketTier', ['show_id'], unique=False)
+    op.create_table('TicketStock',
+    sa.Column('tier_id', sa.Integer(), nullable=False),
+    sa.Column('stripe', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('available', sa.Integer(), nullable=False),
+    sa.CheckConstraint('available >= 0', name='ck_TicketStock_available'),
+    sa.ForeignKeyConstraint(['tier_id'], ['TicketTier.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('tier_id', 'stripe')
+    )
+    op.create_table('TicketHold',
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('tier_id', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('purchased_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['tier_id'], ['TicketTier.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_TicketHold_tier_id'), 'TicketHold', ['tier_id'], unique=False)
+    op.create_index('ix_TicketHold_status_expires_at', 'TicketHold', ['status', 'expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_TicketHold_status_expires_at', table_name='TicketHold')
+    op.drop_index(op.f('ix_TicketHold_tier_id'), table_name='TicketHold')
+    op.drop_table('TicketHold')
+    op.drop_table('TicketStock')
+    op.drop_index(op.f('ix_TicketTier_show_id'), table_name='TicketTier')
+    op.drop_table('TicketTier')
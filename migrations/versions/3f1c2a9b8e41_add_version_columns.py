@@ -0,0 +1,26 @@
+"""add version columns to Venue and Artist
+
+Revision ID: 3f1c2a9b8e41
+Revises: 7da8d8590f7b
+Create Date: 2026-10-19 09:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9b8e41'
+down_revision = '7da8d8590f7b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Artist', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('Venue', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('Venue', 'version')
+    op.drop_column('Artist', 'version')
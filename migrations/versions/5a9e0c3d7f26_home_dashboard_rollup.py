@@ -0,0 +1,40 @@
+"""created_at on Venue and Artist, Rollup table for the home dashboard
+
+Revision ID: 5a9e0c3d7f26
+Revises: c47e19a2d5b8
+Create Date: 2026-10-19 12:41:03.266140
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a9e0c3d7f26'
+down_revision = 'c47e19a2d5b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite can't ALTER in a column with a non-constant default: batch mode copies the table there
+    recreate = 'always' if op.get_bind().dialect.name == 'sqlite' else 'auto'
+    for table in ('Artist', 'Venue'):
+        with op.batch_alter_table(table, recreate=recreate) as batch_op:
+            batch_op.add_column(sa.Column('created_at', sa.DateTime(), server_default=sa.func.current_timestamp(),
+                                          nullable=False))
+        op.create_index(op.f(f'ix_{table}_created_at'), table, ['created_at'], unique=False)
+    op.create_table('Rollup',
+    sa.Column('key', sa.String(length=50), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('refreshed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade():
+    op.drop_table('Rollup')
+    op.drop_index(op.f('ix_Venue_created_at'), table_name='Venue')
+    op.drop_column('Venue', 'created_at')
+    op.drop_index(op.f('ix_Artist_created_at'), table_name='Artist')
+    op.drop_column('Artist', 'created_at')
@@ -0,0 +1,25 @@
+"""Index Show on (venue_id, start_time) for the venue calendar feeds, built without blocking writes
+
+Revision ID: 7f1d3c5e9b20
+Revises: 2e6b9d4f8a17
+Create Date: 2026-10-19 21:47:05.318842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '7f1d3c5e9b20'
+down_revision = '2e6b9d4f8a17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_concurrently('ix_Show_venue_id_start_time', 'Show', ['venue_id', 'start_time'])
+
+
+def downgrade():
+    drop_index_concurrently('ix_Show_venue_id_start_time', 'Show')
@@ -0,0 +1,52 @@
+"""ON DELETE CASCADE for shows and genre links, archived_at on Venue and Artist
+
+Revision ID: 8b2d4e6f0a13
+Revises: 3f1c2a9b8e41
+Create Date: 2026-10-19 10:02:17.540981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2d4e6f0a13'
+down_revision = '3f1c2a9b8e41'
+branch_labels = None
+depends_on = None
+
+# (table, column, referenced table) for every foreign key that should cascade
+CASCADING_FKS = [
+    ('Show', 'artist_id', 'Artist'),
+    ('Show', 'venue_id', 'Venue'),
+    ('artist_genre_table', 'artist_id', 'Artist'),
+    ('venue_genre_table', 'venue_id', 'Venue'),
+]
+# SQLite has no ALTER for constraints: batch mode copies the table there instead (and runs
+# plain ALTERs on PostgreSQL).  The first migration left the SQLite foreign keys unnamed;
+# the convention gives them the names PostgreSQL picked, so they can be dropped by name
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def set_cascade(ondelete):
+    for table, column, referent in CASCADING_FKS:
+        name = f'{table}_{column}_fkey'
+        with op.batch_alter_table(table, naming_convention=NAMING_CONVENTION) as batch_op:
+            batch_op.drop_constraint(name, type_='foreignkey')
+            batch_op.create_foreign_key(name, referent, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    op.add_column('Artist', sa.Column('archived_at', sa.DateTime(), nullable=True))
+    op.add_column('Venue', sa.Column('archived_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_Show_artist_id'), 'Show', ['artist_id'], unique=False)
+    op.create_index(op.f('ix_Show_venue_id'), 'Show', ['venue_id'], unique=False)
+    set_cascade('CASCADE')
+
+
+def downgrade():
+    set_cascade(None)
+    op.drop_index(op.f('ix_Show_venue_id'), table_name='Show')
+    op.drop_index(op.f('ix_Show_artist_id'), table_name='Show')
+    op.drop_column('Venue', 'archived_at')
+    op.drop_column('Artist', 'archived_at')
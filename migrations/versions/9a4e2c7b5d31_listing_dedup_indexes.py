@@ -0,0 +1,29 @@
+"""Index Venue and Artist on phone and (state, city) for the duplicate check, built without blocking writes
+
+Revision ID: 9a4e2c7b5d31
+Revises: 7f1d3c5e9b20
+Create Date: 2026-10-19 23:12:41.207395
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4e2c7b5d31'
+down_revision = '7f1d3c5e9b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('Venue', 'Artist'):
+        create_index_concurrently(f'ix_{table}_phone', table, ['phone'])
+        create_index_concurrently(f'ix_{table}_state_city', table, ['state', 'city'])
+
+
+def downgrade():
+    for table in ('Venue', 'Artist'):
+        drop_index_concurrently(f'ix_{table}_state_city', table)
+        drop_index_concurrently(f'ix_{table}_phone', table)
@@ -0,0 +1,110 @@
+"""partition Show by year of start_time, add ShowArchive
+
+Revision ID: 9d3f5b7a1c62
+Revises: e21b6d8c4f90
+Create Date: 2026-10-19 15:08:52.731954
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+from online_migrations import is_partitioned
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3f5b7a1c62'
+down_revision = 'e21b6d8c4f90'
+branch_labels = None
+depends_on = None
+
+# Columns shared by Show and ShowArchive; the primary key has to include the partition key
+PARTITIONED_COLUMNS = '''(
+    id integer NOT NULL DEFAULT nextval('"Show_id_seq"'),
+    start_time timestamp without time zone NOT NULL,
+    artist_id integer NOT NULL REFERENCES "Artist" (id) ON DELETE CASCADE,
+    venue_id integer NOT NULL REFERENCES "Venue" (id) ON DELETE CASCADE,
+    PRIMARY KEY (id, start_time)
+) PARTITION BY RANGE (start_time)'''
+
+
+def create_indexes(table):
+    op.create_index(f'ix_{table}_start_time', table, ['start_time'], unique=False)
+    op.create_index(f'ix_{table}_artist_id', table, ['artist_id'], unique=False)
+    op.create_index(f'ix_{table}_venue_id', table, ['venue_id'], unique=False)
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql' or not current_app.config['SHOW_PARTITIONING']:
+        # No native partitioning (or not asked for, it is experimental): Show stays a plain
+        # table, ShowArchive is its cold copy
+        op.create_index('ix_Show_start_time', 'Show', ['start_time'], unique=False)
+        op.create_table('ShowArchive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('start_time', sa.DateTime(), nullable=False),
+        sa.Column('artist_id', sa.Integer(), nullable=False),
+        sa.Column('venue_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['artist_id'], ['Artist.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['venue_id'], ['Venue.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+        )
+        create_indexes('ShowArchive')
+        return
+
+    first_year, last_year = bind.execute(
+        'SELECT EXTRACT(YEAR FROM min(start_time)), EXTRACT(YEAR FROM max(start_time)) FROM "Show"').first()
+    this_year = datetime.utcnow().year
+    first_year = int(first_year or this_year)
+    last_year = max(int(last_year or this_year), this_year) + 2
+
+    # Keep the id sequence, rebuild the table around it
+    op.execute('ALTER SEQUENCE "Show_id_seq" OWNED BY NONE')
+    op.execute('ALTER TABLE "Show" RENAME TO "Show_unpartitioned"')
+    op.drop_index('ix_Show_artist_id', table_name='Show_unpartitioned')
+    op.drop_index('ix_Show_venue_id', table_name='Show_unpartitioned')
+
+    op.execute(f'CREATE TABLE "Show" {PARTITIONED_COLUMNS}')
+    op.execute(f'CREATE TABLE "ShowArchive" {PARTITIONED_COLUMNS}')
+    op.execute('ALTER TABLE "ShowArchive" ALTER COLUMN id DROP DEFAULT')
+    create_indexes('Show')
+    create_indexes('ShowArchive')
+    for year in range(first_year, last_year + 1):
+        op.execute(f'CREATE TABLE "Show_y{year}" PARTITION OF "Show" '
+                   f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')")
+    # Catches anything outside the yearly ranges until `flask shows create-partitions` runs
+    op.execute('CREATE TABLE "Show_default" PARTITION OF "Show" DEFAULT')
+
+    op.execute('INSERT INTO "Show" (id, start_time, artist_id, venue_id) '
+               'SELECT id, start_time, artist_id, venue_id FROM "Show_unpartitioned"')
+    op.drop_table('Show_unpartitioned')
+    op.execute('ALTER SEQUENCE "Show_id_seq" OWNED BY "Show".id')
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql' or not is_partitioned('Show'):
+        op.drop_table('ShowArchive')
+        op.drop_index('ix_Show_start_time', table_name='Show')
+        return
+
+    op.execute('ALTER SEQUENCE "Show_id_seq" OWNED BY NONE')
+    op.execute('ALTER TABLE "Show" RENAME TO "Show_partitioned"')
+    op.create_table('Show',
+    sa.Column('id', sa.Integer(), server_default=sa.text('nextval(\'"Show_id_seq"\')'), nullable=False),
+    sa.Column('start_time', sa.DateTime(), nullable=False),
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.Column('venue_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['artist_id'], ['Artist.id'], name='Show_artist_id_fkey', ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['venue_id'], ['Venue.id'], name='Show_venue_id_fkey', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('INSERT INTO "Show" (id, start_time, artist_id, venue_id) '
+               'SELECT id, start_time, artist_id, venue_id FROM "Show_partitioned" '
+               'UNION ALL SELECT id, start_time, artist_id, venue_id FROM "ShowArchive"')
+    # Dropping a partitioned table drops its partitions
+    op.drop_table('Show_partitioned')
+    op.drop_table('ShowArchive')
+    op.create_index('ix_Show_artist_id', 'Show', ['artist_id'], unique=False)
+    op.create_index('ix_Show_venue_id', 'Show', ['venue_id'], unique=False)
+    op.execute('ALTER SEQUENCE "Show_id_seq" OWNED BY "Show".id')
@@ -0,0 +1,40 @@
+"""latitude, longitude and geohash on Venue and Artist
+
+Revision ID: a6c8e0f2b4d7
+Revises: 9d3f5b7a1c62
+Create Date: 2026-10-19 16:31:12.094451
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6c8e0f2b4d7'
+down_revision = '9d3f5b7a1c62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+    for table in ('Artist', 'Venue'):
+        op.add_column(table, sa.Column('latitude', sa.Float(), nullable=True))
+        op.add_column(table, sa.Column('longitude', sa.Float(), nullable=True))
+        # Byte-order collation so geohash prefix ranges (see geo.within) match the index order
+        op.add_column(table, sa.Column('geohash', sa.String(length=12, collation='C' if postgresql else None), nullable=True))
+        op.create_index(op.f(f'ix_{table}_geohash'), table, ['geohash'], unique=False)
+        if postgresql:
+            # Core GiST point index, usable with <-> / <@ box queries without PostGIS
+            op.execute(f'CREATE INDEX "ix_{table}_location" ON "{table}" USING gist (point(longitude, latitude))')
+    # Run `flask geo backfill` afterwards to geocode the existing rows
+
+
+def downgrade():
+    for table in ('Venue', 'Artist'):
+        if op.get_bind().dialect.name == 'postgresql':
+            op.drop_index(f'ix_{table}_location', table_name=table)
+        op.drop_index(op.f(f'ix_{table}_geohash'), table_name=table)
+        op.drop_column(table, 'geohash')
+        op.drop_column(table, 'longitude')
+        op.drop_column(table, 'latitude')
@@ -0,0 +1,34 @@
+"""ChangeEvent table for the /changes feed
+
+Revision ID: b3e7a1d9c5f2
+Revises: a6c8e0f2b4d7
+Create Date: 2026-10-19 17:12:40.318206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e7a1d9c5f2'
+down_revision = 'a6c8e0f2b4d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ChangeEvent',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('entity', sa.String(length=20), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(length=20), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_ChangeEvent_created_at'), 'ChangeEvent', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_ChangeEvent_created_at'), table_name='ChangeEvent')
+    op.drop_table('ChangeEvent')
@@ -0,0 +1,34 @@
+"""Drop the GiST location indexes on Venue and Artist; proximity search goes through the geohash index
+
+Revision ID: b5d1f3a7c9e2
+Revises: 9a4e2c7b5d31
+Create Date: 2026-10-20 09:41:27.518306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5d1f3a7c9e2'
+down_revision = '9a4e2c7b5d31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Only PostgreSQL ever had them (migration a6c8e0f2b4d7)
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table in ('Venue', 'Artist'):
+        drop_index_concurrently(f'ix_{table}_location', table)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    with op.get_context().autocommit_block():
+        for table in ('Venue', 'Artist'):
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_{table}_location" '
+                       f'ON "{table}" USING gist (point(longitude, latitude))')
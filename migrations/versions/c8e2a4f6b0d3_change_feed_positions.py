@@ -0,0 +1,36 @@
+"""Commit-ordered position on ChangeEvent, the cursor of the change feed readers
+
+Revision ID: c8e2a4f6b0d3
+Revises: b5d1f3a7c9e2
+Create Date: 2026-10-20 10:26:53.904117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8e2a4f6b0d3'
+down_revision = 'b5d1f3a7c9e2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('ChangeEvent', sa.Column('position', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=True))
+    # Events from before are long committed: their id is their position, so readers' cursors stay valid
+    op.execute('UPDATE "ChangeEvent" SET position = id')
+    create_index_concurrently('ix_ChangeEvent_position', 'ChangeEvent', ['position'], unique=True)
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_ChangeEvent_unsequenced" '
+                       'ON "ChangeEvent" (id) WHERE position IS NULL')
+    else:
+        op.create_index('ix_ChangeEvent_unsequenced', 'ChangeEvent', ['id'], unique=False)
+
+
+def downgrade():
+    drop_index_concurrently('ix_ChangeEvent_unsequenced', 'ChangeEvent')
+    drop_index_concurrently('ix_ChangeEvent_position', 'ChangeEvent')
+    op.drop_column('ChangeEvent', 'position')
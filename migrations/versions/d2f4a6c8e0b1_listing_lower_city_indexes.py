@@ -0,0 +1,27 @@
+"""Index Venue and Artist on (state, lower(city)) for the case-insensitive duplicate check
+
+Revision ID: d2f4a6c8e0b1
+Revises: c8e2a4f6b0d3
+Create Date: 2026-10-20 14:06:52.381740
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2f4a6c8e0b1'
+down_revision = 'c8e2a4f6b0d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('Venue', 'Artist'):
+        create_index_concurrently(f'ix_{table}_state_lower_city', table, ['state', sa.text('lower(city)')])
+
+
+def downgrade():
+    for table in ('Venue', 'Artist'):
+        drop_index_concurrently(f'ix_{table}_state_lower_city', table)
@@ -0,0 +1,31 @@
+"""WebSession table for server-side sessions
+
+Revision ID: d8f2c6a0e4b1
+Revises: b3e7a1d9c5f2
+Create Date: 2026-10-19 18:03:51.662019
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8f2c6a0e4b1'
+down_revision = 'b3e7a1d9c5f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('WebSession',
+    sa.Column('id', sa.String(length=64), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_WebSession_expires_at'), 'WebSession', ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_WebSession_expires_at'), table_name='WebSession')
+    op.drop_table('WebSession')
@@ -0,0 +1,32 @@
+"""AreaVersion table for the per-area /venues cache
+
+Revision ID: e21b6d8c4f90
+Revises: 5a9e0c3d7f26
+Create Date: 2026-10-19 13:55:29.480712
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e21b6d8c4f90'
+down_revision = '5a9e0c3d7f26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('AreaVersion',
+    sa.Column('city', sa.String(length=120), nullable=False),
+    sa.Column('state', sa.String(length=120), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('city', 'state')
+    )
+    # Every area that already has venues starts at version 1
+    op.execute('INSERT INTO "AreaVersion" (city, state, version) '
+               'SELECT DISTINCT city, state, 1 FROM "Venue" WHERE archived_at IS NULL')
+
+
+def downgrade():
+    op.drop_table('AreaVersion')
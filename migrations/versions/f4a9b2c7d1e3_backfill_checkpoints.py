@@ -0,0 +1,32 @@
+"""BackfillCheckpoint table for batched backfills
+
+Revision ID: f4a9b2c7d1e3
+Revises: d8f2c6a0e4b1
+Create Date: 2026-10-19 18:41:07.209584
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a9b2c7d1e3'
+down_revision = 'd8f2c6a0e4b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('BackfillCheckpoint',
+    sa.Column('name', sa.String(length=80), nullable=False),
+    sa.Column('last_id', sa.Integer(), nullable=False),
+    sa.Column('rows_done', sa.Integer(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('BackfillCheckpoint')
@@ -15,12 +15,12 @@ class Genre(db.Model):
 # Association tables for Artist to Genre (many2many) and Venue to Genre (many2many)
 artist_genre_table = db.Table('artist_genre_table',
     db.Column('genre_id', db.Integer, db.ForeignKey('Genre.id'), primary_key=True),
-    db.Column('artist_id', db.Integer, db.ForeignKey('Artist.id'), primary_key=True)
+    db.Column('artist_id', db.Integer, db.ForeignKey('Artist.id', ondelete='CASCADE'), primary_key=True)
 )
 
 venue_genre_table = db.Table('venue_genre_table',
     db.Column('genre_id', db.Integer, db.ForeignKey('Genre.id'), primary_key=True),
-    db.Column('venue_id', db.Integer, db.ForeignKey('Venue.id'), primary_key=True)
+    db.Column('venue_id', db.Integer, db.ForeignKey('Venue.id', ondelete='CASCADE'), primary_key=True)
 )
 
 
@@ -41,7 +41,24 @@ class Venue(db.Model):
     seeking_description = db.Column(db.String(120))
     # Venue is the parent (one-to-many) of a Show (Artist is also a foreign key, in def. of Show)
      # Can reference show.venue (as well as venue.shows)
-    shows = db.relationship('Show', backref='venue', lazy='joined', cascade="all, delete")  
+    # passive_deletes: the database removes the shows (ON DELETE CASCADE), the ORM never loads them to delete
+    shows = db.relationship('Show', backref='venue', lazy='joined', cascade="all, delete", passive_deletes=True)
+    # Set when the venue is archived instead of deleted; archived venues are left out of listings and search
+    archived_at = db.Column(db.DateTime)
+    # Geocoded from city/state by geo.location_values(); geohash is indexed for proximity search
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12), index=True)
+    # When the listing was posted; drives "recently listed" on the home page
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.func.now(), index=True)
+    # Optimistic concurrency: bumped on every edit so a stale edit form can't overwrite a newer one
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+    # The blocks the duplicate check at create time reads (see dedup.py)
+    __table_args__ = (db.Index('ix_Venue_phone', 'phone'), db.Index('ix_Venue_state_city', 'state', 'city'),
+                      # Duplicate check (dedup.likely_duplicates): cities typed in another case
+                      db.Index('ix_Venue_state_lower_city', 'state', db.func.lower(city)))
 
     def __repr__(self):
         return f'<Venue {self.id} {self.name}>'
@@ -63,18 +80,191 @@ class Artist(db.Model):
     seeking_description = db.Column(db.String(120))
     # Artist is the parent (one-to-many) of a Show (Venue is also a foreign key, in def. of Show)
     # Can reference show.artist (as well as artist.shows) 
-    shows = db.relationship('Show', backref='artist', lazy='joined', cascade="all, delete")  
+    # passive_deletes: the database removes the shows (ON DELETE CASCADE), the ORM never loads them to delete
+    shows = db.relationship('Show', backref='artist', lazy='joined', cascade="all, delete", passive_deletes=True)
+    # Set when the artist is archived instead of deleted; archived artists are left out of listings and search
+    archived_at = db.Column(db.DateTime)
+    # Geocoded from city/state by geo.location_values(); geohash is indexed for proximity search
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12), index=True)
+    # When the listing was posted; drives "recently listed" on the home page
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.func.now(), index=True)
+    # Optimistic concurrency: bumped on every edit so a stale edit form can't overwrite a newer one
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+    # The blocks the duplicate check at create time reads (see dedup.py)
+    __table_args__ = (db.Index('ix_Artist_phone', 'phone'), db.Index('ix_Artist_state_city', 'state', 'city'),
+                      # Duplicate check (dedup.likely_duplicates): cities typed in another case
+                      db.Index('ix_Artist_state_lower_city', 'state', db.func.lower(city)))
 
     def __repr__(self):
         return f'<Artist {self.id} {self.name}>'
 
 
 class Show(db.Model):
+    # With SHOW_PARTITIONING on PostgreSQL this table is range-partitioned by year of start_time (see partitions.py)
     __tablename__ = 'Show'
     id = db.Column(db.Integer, primary_key=True)
-    start_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)   
-    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=False)   
-    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id', ondelete='CASCADE'), nullable=False, index=True)
+    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id', ondelete='CASCADE'), nullable=False, index=True)
+    # An artist's / a venue's shows by time: show_artist(), the clash check in writes.book_tour()
+    # and the calendar feeds in calendars.py
+    __table_args__ = (db.Index('ix_Show_artist_id_start_time', 'artist_id', 'start_time'),
+                      db.Index('ix_Show_venue_id_start_time', 'venue_id', 'start_time'))
+    # The partitioned table's primary key is (id, start_time), so that's how the ORM tells rows
+    # apart too.  Unpartitioned, the table keeps id as its key, where it is also the autoincrement column
+    __mapper_args__ = {'primary_key': [id, start_time]}
 
     def __repr__(self):
         return f'<Show {self.id} {self.start_time} artist_id={self.artist_id} venue_id={self.venue_id}>'
+
+
+class ShowArchive(db.Model):
+    # Old shows moved out of Show by `flask shows archive`; same columns, read only for show history
+    __tablename__ = 'ShowArchive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    start_time = db.Column(db.DateTime, nullable=False, index=True)
+    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id', ondelete='CASCADE'), nullable=False, index=True)
+    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id', ondelete='CASCADE'), nullable=False, index=True)
+    __mapper_args__ = {'primary_key': [id, start_time]}
+
+    def __repr__(self):
+        return f'<ShowArchive {self.id} {self.start_time} artist_id={self.artist_id} venue_id={self.venue_id}>'
+
+
+class Job(db.Model):
+    # Background work queued by the controllers and run by `flask jobs work` (see jobs.py)
+    __tablename__ = 'Job'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')   # JSON keyword arguments for the task
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    # Workers poll for the oldest runnable job in a status
+    __table_args__ = (db.Index('ix_Job_status_run_at', 'status', 'run_at'),)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.name} {self.status}>'
+
+
+class Rollup(db.Model):
+    # Precomputed page data (JSON), rebuilt periodically by a background job (see dashboard.py)
+    __tablename__ = 'Rollup'
+    key = db.Column(db.String(50), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    refreshed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Rollup {self.key} {self.refreshed_at}>'
+
+
+class AreaVersion(db.Model):
+    # One row per (city, state) that has had venues; the version is bumped whenever a venue
+    # in the area changes, which invalidates that area's cached fragment (see areas.py)
+    __tablename__ = 'AreaVersion'
+    city = db.Column(db.String(120), primary_key=True)
+    state = db.Column(db.String(120), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    def __repr__(self):
+        return f'<AreaVersion {self.city}, {self.state} v{self.version}>'
+
+
+class ChangeEvent(db.Model):
+    # Append-only log of writes, recorded in the same transaction as the write (see changes.py).
+    # The position is the cursor consumers of /changes resume from.
+    __tablename__ = 'ChangeEvent'
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)      # venue, artist, show
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(20), nullable=False)          # create, update, archive, delete
+    data = db.Column(db.Text, nullable=False, default='{}')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    # Order in which events became visible, given after commit by changes.sequence_changes()
+    position = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), unique=True, index=True)
+    # The sequencer's work list: events still without a position
+    __table_args__ = (db.Index('ix_ChangeEvent_unsequenced', 'id', postgresql_where=position.is_(None)),)
+
+    def __repr__(self):
+        return f'<ChangeEvent {self.id} {self.op} {self.entity} {self.entity_id}>'
+
+
+class WebSession(db.Model):
+    # Server-side Flask sessions (see sessions.py); the cookie only carries the id
+    __tablename__ = 'WebSession'
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<WebSession {self.id[:8]} expires {self.expires_at}>'
+
+
+class BackfillCheckpoint(db.Model):
+    # Progress of a batched backfill (see online_migrations.py), committed with every batch
+    __tablename__ = 'BackfillCheckpoint'
+    name = db.Column(db.String(80), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<BackfillCheckpoint {self.name} through {self.last_id}>'
+
+
+class TicketTier(db.Model):
+    # A kind of ticket for a show (see tickets.py).  No foreign key to Show: on PostgreSQL its
+    # primary key is (id, start_time) and old shows move to ShowArchive with the same id
+    __tablename__ = 'TicketTier'
+    id = db.Column(db.Integer, primary_key=True)
+    show_id = db.Column(db.Integer, nullable=False, index=True)
+    name = db.Column(db.String(80), nullable=False)
+    price_cents = db.Column(db.Integer, nullable=False)
+    capacity = db.Column(db.Integer, nullable=False)
+    # Number of TicketStock rows the unsold seats are spread over
+    stripes = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<TicketTier {self.id} {self.name} show_id={self.show_id}>'
+
+
+class TicketStock(db.Model):
+    # Seats of a tier not held or sold, split over several rows so concurrent holds
+    # mostly decrement different rows instead of queueing on one
+    __tablename__ = 'TicketStock'
+    tier_id = db.Column(db.Integer, db.ForeignKey('TicketTier.id', ondelete='CASCADE'), primary_key=True)
+    stripe = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    available = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.CheckConstraint('available >= 0', name='ck_TicketStock_available'),)
+
+    def __repr__(self):
+        return f'<TicketStock {self.tier_id}/{self.stripe} {self.available}>'
+
+
+class TicketHold(db.Model):
+    # Seats taken from TicketStock for a buyer; purchased, released, or expired back into stock
+    __tablename__ = 'TicketHold'
+    id = db.Column(db.String(32), primary_key=True)     # random; whoever has it can buy or release the hold
+    tier_id = db.Column(db.Integer, db.ForeignKey('TicketTier.id', ondelete='CASCADE'), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='held')   # held, purchased, released, expired
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    purchased_at = db.Column(db.DateTime)
+    # The expiry job looks for held rows past expires_at
+    __table_args__ = (db.Index('ix_TicketHold_status_expires_at', 'status', 'expires_at'),)
+
+    def __repr__(self):
+        return f'<TicketHold {self.id[:8]} {self.quantity} x tier {self.tier_id} {self.status}>'
@@ -0,0 +1,327 @@
+#IMPORTS
+import io
+import re
+import time
+from datetime import datetime
+import click
+import sqlalchemy as sa
+from alembic import command, context, op
+from alembic.runtime.migration import MigrationContext
+from flask import current_app
+from flask.cli import AppGroup
+from models import db, BackfillCheckpoint
+#----------------------------------------------------------------------------#
+# Online migrations.
+#
+# Helpers for Alembic revisions that change big, busy tables without long
+# exclusive locks:
+#   * create_index_concurrently() / drop_index_concurrently(), which also
+#     handle the partitioned Show table one partition at a time;
+#   * add_not_null_online(), which validates the column before SET NOT NULL;
+#   * set_lock_timeout(), so DDL that can't get its lock gives up instead of
+#     queueing every read behind it.
+# Data changes go through backfills instead: registered with @backfill and
+# run by `flask migrations backfill` in short committed batches, throttled and
+# resumable from a checkpoint.  `flask migrations plan` is the dry run: it
+# lists the SQL of the pending revisions with the lock each statement takes
+# and a rough duration from the table sizes.
+#----------------------------------------------------------------------------#
+
+def dialect_name():
+    return op.get_context().dialect.name
+
+
+def set_lock_timeout(milliseconds=None):
+    '''Fail this migration's DDL after waiting this long for a lock (default MIGRATION_LOCK_TIMEOUT_MS).'''
+    if dialect_name() == 'postgresql':
+        milliseconds = milliseconds or current_app.config['MIGRATION_LOCK_TIMEOUT_MS']
+        op.execute(f"SET lock_timeout = '{int(milliseconds)}ms'")
+
+
+def is_partitioned(table):
+    # Offline (--sql) there's no catalog to ask
+    if context.is_offline_mode():
+        return False
+    return bool(op.get_bind().execute(
+        sa.text("SELECT relkind = 'p' FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+        table=f'"{table}"').scalar())
+
+
+def table_partitions(table):
+    return [name for (name,) in op.get_bind().execute(
+        sa.text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname"), table=f'"{table}"')]
+
+
+def index_state(name):
+    '''(exists, valid, attached to a parent index) for an index name.'''
+    if context.is_offline_mode():
+        return False, False, False
+    row = op.get_bind().execute(sa.text(
+        "SELECT i.indisvalid, EXISTS (SELECT 1 FROM pg_inherits h WHERE h.inhrelid = i.indexrelid) "
+        "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"), name=name).first()
+    return (row is not None, bool(row and row[0]), bool(row and row[1]))
+
+
+def create_index_concurrently(name, table, columns, unique=False):
+    '''CREATE INDEX without blocking writes; a plain create_index() off PostgreSQL.
+
+    columns are column names or sa.text() expressions, e.g. sa.text('lower(city)').
+    CONCURRENTLY can't run in a transaction, so this commits whatever the
+    revision did before it.  Partitioned tables can't be indexed concurrently
+    at all: the index is built concurrently on every partition and then
+    attached to an (instant) index on the parent.  Safe to rerun after a
+    failure: a half-built INVALID index is dropped first.
+    '''
+    if dialect_name() != 'postgresql':
+        op.create_index(name, table, columns, unique=unique)
+        return
+    column_list = ', '.join(str(column) if isinstance(column, sa.sql.elements.TextClause) else f'"{column}"'
+                            for column in columns)
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    with op.get_context().autocommit_block():
+        partitioned = is_partitioned(table)
+        exists, valid, _ = index_state(name)
+        if exists and not valid and not partitioned:
+            op.execute(f'DROP INDEX CONCURRENTLY "{name}"')
+        if not partitioned:
+            op.execute(f'CREATE {kind} CONCURRENTLY IF NOT EXISTS "{name}" ON "{table}" ({column_list})')
+            return
+        op.execute(f'CREATE {kind} IF NOT EXISTS "{name}" ON ONLY "{table}" ({column_list})')
+        for partition in table_partitions(table):
+            child = f'{partition}_{name}'[:63]
+            exists, valid, attached = index_state(child)
+            if exists and not valid:
+                op.execute(f'DROP INDEX CONCURRENTLY "{child}"')
+            op.execute(f'CREATE {kind} CONCURRENTLY IF NOT EXISTS "{child}" ON "{partition}" ({column_list})')
+            if not attached:
+                # The parent index becomes valid once every partition's index is attached
+                op.execute(f'ALTER INDEX "{name}" ATTACH PARTITION "{child}"')
+
+
+def drop_index_concurrently(name, table):
+    if dialect_name() != 'postgresql':
+        op.drop_index(name, table_name=table)
+        return
+    with op.get_context().autocommit_block():
+        if is_partitioned(table):
+            # Not possible concurrently; dropping the parent drops the partitions' indexes, briefly locking them
+            op.execute(f'DROP INDEX IF EXISTS "{name}"')
+        else:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+
+def add_not_null_online(table, column):
+    '''SET NOT NULL without holding the exclusive lock through a full table scan.
+
+    The NOT VALID check is added instantly, validated under a lock that
+    doesn't block reads or writes, and then lets SET NOT NULL (PostgreSQL 12+)
+    skip its own scan.
+    '''
+    if dialect_name() != 'postgresql':
+        with op.batch_alter_table(table) as batch:
+            batch.alter_column(column, nullable=False)
+        return
+    constraint = f'{table}_{column}_not_null'
+    op.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{constraint}" CHECK ("{column}" IS NOT NULL) NOT VALID')
+    op.execute(f'ALTER TABLE "{table}" VALIDATE CONSTRAINT "{constraint}"')
+    op.execute(f'ALTER TABLE "{table}" ALTER COLUMN "{column}" SET NOT NULL')
+    op.execute(f'ALTER TABLE "{table}" DROP CONSTRAINT "{constraint}"')
+
+#----------------------------------------------------------------------------#
+# Backfills.
+#----------------------------------------------------------------------------#
+
+BACKFILLS = {}
+
+
+def backfill(name, model, columns, where=None):
+    '''Register a backfill over model's rows matching where.
+
+    The function gets a batch of (id, *columns) rows and returns
+    [{'id': id, column: value, ...}] for the rows to update.
+    '''
+    def register(function):
+        BACKFILLS[name] = (model, columns, where, function)
+        return function
+    return register
+
+
+def pending_rows(name, after_id):
+    model, _, where, _ = BACKFILLS[name]
+    query = db.session.query(sa.func.count(model.id)).filter(model.id > after_id)
+    return query.filter(where).scalar() if where is not None else query.scalar()
+
+
+def run_backfill(name, batch_size, max_duty, progress=None):
+    '''Run a backfill from its checkpoint to the end in committed batches.
+
+    After each batch it sleeps long enough that it keeps the database busy at
+    most max_duty of the time, so it yields to the live traffic.  The
+    checkpoint is committed with every batch; an interrupted run picks up
+    where it stopped.
+    '''
+    model, columns, where, function = BACKFILLS[name]
+    checkpoint = BackfillCheckpoint.query.get(name)
+    if checkpoint is None:
+        checkpoint = BackfillCheckpoint(name=name, last_id=0, rows_done=0)
+        db.session.add(checkpoint)
+    checkpoint.finished_at = None
+    db.session.commit()
+
+    table = model.__table__
+    while True:
+        started = time.monotonic()
+        query = db.session.query(model.id, *columns).filter(model.id > checkpoint.last_id)
+        if where is not None:
+            query = query.filter(where)
+        rows = query.order_by(model.id).limit(batch_size).all()
+        if not rows:
+            checkpoint.finished_at = datetime.utcnow()
+            db.session.commit()
+            return checkpoint.rows_done
+        updates = function(rows)
+        if updates:
+            values = {key: sa.bindparam(key) for key in updates[0] if key != 'id'}
+            db.session.execute(table.update().where(table.c.id == sa.bindparam('_id')).values(values),
+                               [dict(update, _id=update['id']) for update in updates])
+        checkpoint.last_id = rows[-1].id
+        checkpoint.rows_done += len(rows)
+        checkpoint.updated_at = datetime.utcnow()
+        db.session.commit()
+        elapsed = time.monotonic() - started
+        if progress:
+            progress(checkpoint, elapsed)
+        time.sleep(elapsed * (1 - max_duty) / max_duty)
+
+#----------------------------------------------------------------------------#
+# Dry run: locks and durations of the pending revisions.
+#----------------------------------------------------------------------------#
+
+# (pattern, lock, what it blocks, cost per row of the table or None if it's metadata only)
+LOCKS = [
+    (r'CREATE\s+(UNIQUE\s+)?INDEX\s+CONCURRENTLY', 'SHARE UPDATE EXCLUSIVE', 'nothing', 'index'),
+    (r'CREATE\s+(UNIQUE\s+)?INDEX\b.*\bON\s+ONLY\b', 'SHARE', 'writes', None),
+    (r'CREATE\s+(UNIQUE\s+)?INDEX', 'SHARE', 'writes', 'index'),
+    (r'DROP\s+INDEX\s+CONCURRENTLY', 'SHARE UPDATE EXCLUSIVE', 'nothing', None),
+    (r'ALTER\s+TABLE\b.*\bVALIDATE\s+CONSTRAINT', 'SHARE UPDATE EXCLUSIVE', 'nothing', 'scan'),
+    (r'ALTER\s+TABLE\b.*\bNOT\s+VALID', 'ACCESS EXCLUSIVE', 'reads and writes', None),
+    (r'ALTER\s+TABLE\b.*\bTYPE\b', 'ACCESS EXCLUSIVE', 'reads and writes', 'rewrite'),
+    (r'ALTER\s+TABLE\b.*\bADD\s+COLUMN\b.*\bDEFAULT\b.*\b(random|gen_random_uuid|clock_timestamp|uuid_generate_\w+)\s*\(',
+     'ACCESS EXCLUSIVE', 'reads and writes', 'rewrite'),
+    (r'ALTER\s+TABLE\b.*\bSET\s+NOT\s+NULL', 'ACCESS EXCLUSIVE', 'reads and writes', 'scan'),
+    (r'ALTER\s+TABLE\b.*\bADD\s+(CONSTRAINT\b.*\b)?(CHECK|FOREIGN\s+KEY)', 'ACCESS EXCLUSIVE', 'reads and writes', 'scan'),
+    (r'ALTER\s+TABLE\b.*\bADD\s+(CONSTRAINT\b.*\b)?(UNIQUE|PRIMARY\s+KEY)', 'ACCESS EXCLUSIVE', 'reads and writes', 'index'),
+    (r'ALTER\s+TABLE\b.*\bATTACH\s+PARTITION', 'SHARE UPDATE EXCLUSIVE', 'nothing', None),
+    (r'ALTER\s+(TABLE|INDEX)', 'ACCESS EXCLUSIVE', 'reads and writes', None),
+    (r'DROP\s+(TABLE|INDEX)', 'ACCESS EXCLUSIVE', 'reads and writes', None),
+    (r'(UPDATE|DELETE\s+FROM)\s', 'ROW EXCLUSIVE', 'writes to the same rows', 'update'),
+    (r'INSERT\s+INTO\b.*\bSELECT\b', 'ROW EXCLUSIVE', 'nothing', 'update'),
+]
+TABLE_NAME = re.compile(r'\b(?:TABLE|ON(?:\s+ONLY)?|UPDATE|FROM|INTO)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?"?(\w+)"?', re.I)
+
+
+def pending_sql():
+    '''SQL statements of the revisions not yet applied, as rendered by `flask db upgrade --sql`.'''
+    config = current_app.extensions['migrate'].migrate.get_config()
+    with db.engine.connect() as connection:
+        current = MigrationContext.configure(connection).get_current_revision()
+    config.output_buffer = io.StringIO()
+    command.upgrade(config, f'{current}:head' if current else 'head', sql=True)
+    statements = []
+    for statement in config.output_buffer.getvalue().split(';\n'):
+        # Drop the comment lines Alembic puts between revisions
+        statement = ' '.join(line for line in statement.splitlines() if not line.startswith('--')).strip()
+        if statement and 'alembic_version' not in statement and statement.upper() not in ('BEGIN', 'COMMIT'):
+            statements.append(statement)
+    return statements
+
+
+def table_rows(table):
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            # Planner estimate; a partitioned parent counts its partitions
+            return int(db.session.execute(
+                "SELECT COALESCE(SUM(c.reltuples), 0) FROM pg_class c "
+                "WHERE c.oid = CAST(:table AS regclass) "
+                "OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = CAST(:table AS regclass))",
+                {'table': f'"{table}"'}).scalar())
+        return db.session.execute(f'SELECT COUNT(*) FROM "{table}"').scalar()
+    except sa.exc.DBAPIError:
+        # A table the migration itself creates
+        db.session.rollback()
+        return 0
+
+
+def estimate_locks(statements):
+    '''[(statement, table, lock, blocks, estimated seconds)] for the statements that take a table lock.'''
+    costs = current_app.config['MIGRATION_ROW_COSTS']
+    rows, plan = {}, []
+    for statement in statements:
+        for pattern, lock, blocks, cost in LOCKS:
+            if re.match(pattern, statement, re.I | re.S):
+                match = TABLE_NAME.search(statement)
+                table = match.group(1) if match else None
+                if table and table not in rows:
+                    rows[table] = table_rows(table)
+                seconds = rows.get(table, 0) * costs[cost] if cost else 0.0
+                plan.append((statement, table, lock, blocks, seconds))
+                break
+    return plan
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+migrations_cli = AppGroup('migrations', help='Online migrations: dry runs and batched backfills.')
+
+
+@migrations_cli.command('plan')
+def plan_command():
+    '''Dry run of `flask db upgrade`: each statement's lock, what it blocks and a rough duration.'''
+    try:
+        statements = pending_sql()
+    except Exception as e:
+        # Older revisions that inspect the live database can't be rendered as SQL
+        raise click.ClickException(f'Could not render the pending revisions as SQL: {e}')
+    plan = estimate_locks(statements)
+    if not plan:
+        click.echo('No pending statements take table locks.')
+    for statement, table, lock, blocks, seconds in plan:
+        click.echo(f'{lock:<24} blocks {blocks:<24} ~{seconds:>8.1f}s  {table or "?"}')
+        click.echo(f'    {statement[:150]}')
+    blocking = sum(seconds for _, _, _, blocks, seconds in plan if blocks != 'nothing')
+    click.echo(f'Estimated time holding locks that block traffic: ~{blocking:.1f}s '
+               f'(every ACCESS EXCLUSIVE also waits for running transactions; see set_lock_timeout())')
+
+
+@migrations_cli.command('backfill')
+@click.argument('name')
+@click.option('--batch-size', type=int, default=None, help='Rows per batch (default BACKFILL_BATCH_SIZE).')
+@click.option('--max-duty', type=float, default=None,
+              help='Most of the time the backfill may keep the database busy, 0-1 (default BACKFILL_MAX_DUTY).')
+@click.option('--dry-run', is_flag=True, help='Only count the rows left to do.')
+def backfill_command(name, batch_size, max_duty, dry_run):
+    if name not in BACKFILLS:
+        raise click.ClickException(f'No backfill {name}; known: {", ".join(sorted(BACKFILLS))}')
+    batch_size = batch_size or current_app.config['BACKFILL_BATCH_SIZE']
+    max_duty = max_duty or current_app.config['BACKFILL_MAX_DUTY']
+    checkpoint = BackfillCheckpoint.query.get(name)
+    after_id = checkpoint.last_id if checkpoint else 0
+    if dry_run:
+        remaining = pending_rows(name, after_id)
+        click.echo(f'{name}: {remaining} rows left after id {after_id}, {-(-remaining // batch_size)} batches')
+        return
+
+    def progress(checkpoint, elapsed):
+        click.echo(f'{name}: {checkpoint.rows_done} rows, through id {checkpoint.last_id} ({elapsed * 1000:.0f} ms/batch)')
+    done = run_backfill(name, batch_size, max_duty, progress)
+    click.echo(f'{name}: finished, {done} rows')
+
+
+@migrations_cli.command('status')
+def status_command():
+    '''Checkpoints of the backfills.'''
+    for checkpoint in BackfillCheckpoint.query.order_by(BackfillCheckpoint.name):
+        state = f'finished {checkpoint.finished_at:%Y-%m-%d %H:%M}' if checkpoint.finished_at else 'in progress'
+        click.echo(f'{checkpoint.name:<30} {checkpoint.rows_done:>10} rows  through id {checkpoint.last_id:<10} {state}')
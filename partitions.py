@@ -0,0 +1,172 @@
+#IMPORTS
+import re
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from models import db, Show, ShowArchive
+#----------------------------------------------------------------------------#
+# Show partitioning and archival.
+#
+# Experimental: with SHOW_PARTITIONING=1 when migration 9d3f5b7a1c62 runs on
+# PostgreSQL, Show and ShowArchive are both range-partitioned by start_time
+# with one partition per year.  Archiving a year is then a metadata-only
+# move: the partition is detached from Show and attached to ShowArchive.
+# Queries on upcoming shows filter on start_time, so they are pruned to the
+# recent partitions.
+#
+# Shows outside the yearly ranges land in the default partition until
+# `flask shows create-partitions` creates their year.  Archiving moves the
+# old ones among them to ShowArchive in batches, into a yearly archive
+# partition of their own.
+#
+# Without partitioning (SQLite, or PostgreSQL without the flag) Show and
+# ShowArchive are plain tables and archiving copies the old rows across in
+# batches.  Only that path has been run so far; the partitioned one still
+# needs a run against a real database before the flag is turned on in
+# production.
+#----------------------------------------------------------------------------#
+
+PARTITION_NAME = re.compile(r'^Show_y(\d{4})$')
+
+
+def is_partitioned():
+    '''Whether Show is a partitioned table (see SHOW_PARTITIONING).'''
+    return db.engine.dialect.name == 'postgresql' and db.session.execute(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = CAST('\"Show\"' AS regclass)").scalar()
+
+
+def partition_name(year):
+    return f'Show_y{year}'
+
+
+def partition_bounds(year):
+    return f"FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+
+
+def show_partitions(parent='Show'):
+    '''Years that have a partition attached to the given parent table.'''
+    rows = db.session.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:parent AS regclass)", {'parent': f'"{parent}"'})
+    return sorted(int(match.group(1)) for (name,) in rows for match in [PARTITION_NAME.match(name)] if match)
+
+
+def create_partition(year):
+    '''Create one yearly partition of Show, moving its shows out of the default partition.
+
+    PostgreSQL refuses to create a partition while the default partition holds
+    rows in its range, so those rows are taken out first and inserted back
+    through Show once the partition exists, all in one transaction.
+    '''
+    name = partition_name(year)
+    bounds = {'start': datetime(year, 1, 1), 'end': datetime(year + 1, 1, 1)}
+    has_default = db.session.execute("SELECT to_regclass('\"Show_default\"') IS NOT NULL").scalar()
+    stray = has_default and db.session.execute(
+        'SELECT EXISTS (SELECT 1 FROM "Show_default" WHERE start_time >= :start AND start_time < :end)',
+        bounds).scalar()
+    if stray:
+        db.session.execute(
+            'CREATE TEMPORARY TABLE "Show_moving" ON COMMIT DROP AS '
+            'WITH moved AS (DELETE FROM "Show_default" WHERE start_time >= :start AND start_time < :end RETURNING *) '
+            'SELECT * FROM moved', bounds)
+    db.session.execute(f'CREATE TABLE "{name}" PARTITION OF "Show" FOR VALUES {partition_bounds(year)}')
+    if stray:
+        db.session.execute('INSERT INTO "Show" SELECT * FROM "Show_moving"')
+    db.session.commit()
+
+
+def ensure_partitions(until_year):
+    '''Create the yearly partitions of Show up to and including until_year.'''
+    existing = set(show_partitions('Show')) | set(show_partitions('ShowArchive'))
+    first = min(existing) if existing else datetime.utcnow().year
+    created = []
+    for year in range(first, until_year + 1):
+        if year not in existing:
+            create_partition(year)
+            created.append(year)
+    db.session.commit()
+    return created
+
+
+def archive_default_shows(before, batch_size):
+    '''Move the shows in Show_default that started before `before` (a year start) to ShowArchive, in batches.
+
+    They go to yearly partitions of ShowArchive, created as needed; Show can't
+    have a partition for those years, or its default partition wouldn't hold
+    their shows.  Returns the number of shows moved.
+    '''
+    years = [int(year) for (year,) in db.session.execute(
+        'SELECT DISTINCT EXTRACT(YEAR FROM start_time) FROM "Show_default" WHERE start_time < :before',
+        {'before': before})]
+    for year in years:
+        db.session.execute(f'CREATE TABLE IF NOT EXISTS "{partition_name(year)}" '
+                           f'PARTITION OF "ShowArchive" FOR VALUES {partition_bounds(year)}')
+    db.session.commit()
+    moved = 0
+    while True:
+        count = db.session.execute(
+            'WITH moved AS (DELETE FROM "Show_default" WHERE ctid IN '
+            '(SELECT ctid FROM "Show_default" WHERE start_time < :before LIMIT :batch_size) '
+            'RETURNING id, start_time, artist_id, venue_id) '
+            'INSERT INTO "ShowArchive" (id, start_time, artist_id, venue_id) SELECT * FROM moved',
+            {'before': before, 'batch_size': batch_size}).rowcount
+        db.session.commit()
+        if not count:
+            return moved
+        moved += count
+
+
+def archive_shows(cutoff, batch_size):
+    '''Move shows that started before cutoff from Show to ShowArchive. Returns what was moved.'''
+    if is_partitioned():
+        # Only whole years can be moved, so keep the year the cutoff falls in
+        moved = []
+        for year in show_partitions('Show'):
+            if year >= cutoff.year:
+                continue
+            name = partition_name(year)
+            db.session.execute(f'ALTER TABLE "Show" DETACH PARTITION "{name}"')
+            db.session.execute(f'ALTER TABLE "ShowArchive" ATTACH PARTITION "{name}" FOR VALUES {partition_bounds(year)}')
+            db.session.commit()
+            moved.append(name)
+        strays = archive_default_shows(datetime(cutoff.year, 1, 1), batch_size)
+        if strays:
+            moved.append(f'{strays} shows from Show_default')
+        return moved
+
+    moved = 0
+    while True:
+        rows = db.session.query(Show.id, Show.start_time, Show.artist_id, Show.venue_id) \
+            .filter(Show.start_time < cutoff).order_by(Show.id).limit(batch_size).all()
+        if not rows:
+            return moved
+        db.session.execute(ShowArchive.__table__.insert(), [row._asdict() for row in rows])
+        Show.query.filter(Show.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+        moved += len(rows)
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+shows_cli = AppGroup('shows', help='Maintain the Show partitions and archive.')
+
+
+@shows_cli.command('create-partitions')
+@click.option('--years-ahead', type=int, default=2, help='Create partitions this many years past the current one.')
+def create_partitions_command(years_ahead):
+    if not is_partitioned():
+        click.echo('Show is not partitioned on this database; nothing to do.')
+        return
+    created = ensure_partitions(datetime.utcnow().year + years_ahead)
+    click.echo(f'Created partitions for {created}' if created else 'All partitions exist.')
+
+
+@shows_cli.command('archive')
+@click.option('--keep-days', type=int, default=None, help='Keep shows newer than this (default SHOW_ARCHIVE_AFTER_DAYS).')
+def archive_command(keep_days):
+    keep_days = current_app.config['SHOW_ARCHIVE_AFTER_DAYS'] if keep_days is None else keep_days
+    cutoff = datetime.utcnow() - timedelta(days=keep_days)
+    moved = archive_shows(cutoff, current_app.config['SHOW_ARCHIVE_BATCH_SIZE'])
+    click.echo(f'Archived shows before {cutoff:%Y-%m-%d}: {moved}')
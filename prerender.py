@@ -0,0 +1,245 @@
+#IMPORTS
+import gzip
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from werkzeug.exceptions import NotFound
+from models import db, Venue, Artist, Show, ShowArchive, Rollup
+from changes import latest_position, read_changes
+from jobs import periodic, schedule_next
+try:
+    import brotli
+except ImportError:     # optional: without it only the gzip variants are written
+    brotli = None
+#----------------------------------------------------------------------------#
+# Pre-rendered artist and venue pages.
+#
+# Every /artists/<id> and /venues/<id> page is rendered to
+# PRERENDER_DIR/<artists|venues>/<id>/index.html, next to index.html.gz (and
+# .br with brotli installed), so a front proxy can serve them without the
+# app, e.g. with nginx:
+#
+#     location ~ ^/(artists|venues)/\d+$ {
+#         root /srv/fyyur/prerendered;
+#         gzip_static on;
+#         try_files $uri/index.html @app;
+#     }
+#
+# `flask pages build` renders everything over a process pool.  After that
+# the refresh_prerendered_pages job follows the change feed and re-renders
+# only the pages an event touches: the listing itself, and the pages of its
+# show partners when its name or picture changed or it was deleted.  It also
+# re-renders the pages of shows that have started since the last run, as
+# they move from upcoming to past.  Each page keeps the ids of its partners
+# in deps.json, which is how the partners of a deleted listing are found.
+# Flashed messages are never part of a pre-rendered page.
+#----------------------------------------------------------------------------#
+
+PRERENDER_KEY = 'prerender'
+# kind -> (directory, view endpoint, view argument (also the Show column), partner kind)
+PAGES = {
+    'artist': ('artists', 'show_artist', 'artist_id', 'venue'),
+    'venue': ('venues', 'show_venue', 'venue_id', 'artist'),
+}
+# Columns shown on the partners' pages
+PARTNER_COLUMNS = {'name', 'image_link'}
+
+
+def page_dir(kind, id):
+    return os.path.join(current_app.config['PRERENDER_DIR'], PAGES[kind][0], str(id))
+
+
+def partner_ids(kind, id):
+    '''Ids of the listings this page links to through its shows, past and archived included.'''
+    column, partner = PAGES[kind][2], PAGES[kind][3]
+    ids = set()
+    for model in (Show, ShowArchive):
+        ids.update(partner_id for (partner_id,) in db.session.query(getattr(model, f'{partner}_id'))
+                   .filter(getattr(model, column) == id).distinct())
+    return sorted(ids)
+
+
+def write_if_changed(path, data):
+    '''Atomically replace path with data, unless it already holds exactly that.'''
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    # The proxy never sees a half-written file
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def render_page(kind, id):
+    '''(Re)write one page and its compressed variants; a page whose view 404s is removed.'''
+    directory, endpoint, argument, _ = PAGES[kind]
+    with current_app.test_request_context(f'/{directory}/{id}'):
+        try:
+            html = current_app.view_functions[endpoint](**{argument: id})
+        except NotFound:
+            remove_page(kind, id)
+            return False
+    path = page_dir(kind, id)
+    os.makedirs(path, exist_ok=True)
+    data = html.encode()
+    if write_if_changed(os.path.join(path, 'index.html'), data):
+        write_if_changed(os.path.join(path, 'index.html.gz'), gzip.compress(data, 9, mtime=0))
+        if brotli is not None:
+            write_if_changed(os.path.join(path, 'index.html.br'), brotli.compress(data))
+    write_if_changed(os.path.join(path, 'deps.json'), json.dumps(partner_ids(kind, id)).encode())
+    # The views load every show as an entity; don't let them pile up over a rebuild
+    db.session.expunge_all()
+    return True
+
+
+def stored_partners(kind, id):
+    try:
+        with open(os.path.join(page_dir(kind, id), 'deps.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def remove_page(kind, id):
+    shutil.rmtree(page_dir(kind, id), ignore_errors=True)
+
+
+def affected_pages(events):
+    '''{(kind, id)} of the pages a list of (entity, entity_id, op, data) events touches.'''
+    pages = set()
+    for entity, entity_id, op, data in events:
+        if entity == 'show':
+            pages.update({('artist', data['artist_id']), ('venue', data['venue_id'])})
+            continue
+        pages.add((entity, entity_id))
+        if op == 'delete' or PARTNER_COLUMNS & set(data):
+            partner = PAGES[entity][3]
+            pages.update((partner, partner_id) for partner_id in stored_partners(entity, entity_id))
+    return pages
+
+
+def started_show_pages(since, until):
+    '''{(kind, id)} of the pages listing a show that started in (since, until].'''
+    pages = set()
+    for artist_id, venue_id in db.session.query(Show.artist_id, Show.venue_id) \
+            .filter(Show.start_time > since, Show.start_time <= until).distinct():
+        pages.update({('artist', artist_id), ('venue', venue_id)})
+    return pages
+
+
+def load_state():
+    data = db.session.query(Rollup.data).filter(Rollup.key == PRERENDER_KEY).scalar()
+    return json.loads(data) if data else None
+
+
+def save_state(cursor, swept_at):
+    data = json.dumps({'cursor': cursor, 'swept_at': swept_at.isoformat()})
+    rollup = Rollup.query.get(PRERENDER_KEY)
+    if rollup is None:
+        db.session.add(Rollup(key=PRERENDER_KEY, data=data))
+    else:
+        rollup.data = data
+        rollup.refreshed_at = datetime.utcnow()
+
+
+@periodic('PRERENDER_INTERVAL')
+def refresh_prerendered_pages():
+    state = load_state()
+    if state is None:
+        return      # nothing to keep current before the first `flask pages build`
+    # In commit order (see changes.py), so an event committed late by a long transaction isn't skipped
+    events = read_changes(state['cursor'], current_app.config['PRERENDER_BATCH_SIZE'])
+    now = datetime.now()
+    pages = affected_pages([(entity, entity_id, op, json.loads(data)) for _, entity, entity_id, op, data, _ in events])
+    pages |= started_show_pages(datetime.fromisoformat(state['swept_at']), now)
+    for kind, id in sorted(pages):
+        render_page(kind, id)
+    save_state(events[-1].position if events else state['cursor'], now)
+
+#----------------------------------------------------------------------------#
+# Full rebuild.
+#----------------------------------------------------------------------------#
+
+worker_app = None
+
+
+def start_worker():
+    # Pool processes are forked with the parent's app; they need their own connections
+    global worker_app
+    from app import app
+    worker_app = app
+    with app.app_context():
+        db.engine.dispose()
+
+
+def render_chunk(kind, ids):
+    with worker_app.app_context():
+        try:
+            return sum(render_page(kind, id) for id in ids)
+        finally:
+            db.session.remove()
+
+
+def build_all(processes, chunk_size=200):
+    '''Render every page; returns {kind: pages rendered}.'''
+    chunks = []
+    for kind, model in (('artist', Artist), ('venue', Venue)):
+        ids = [id for (id,) in db.session.query(model.id).order_by(model.id)]
+        # Pages of listings that are gone
+        root = os.path.join(current_app.config['PRERENDER_DIR'], PAGES[kind][0])
+        known = set(map(str, ids))
+        for name in os.listdir(root) if os.path.isdir(root) else []:
+            if name not in known:
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        chunks += [(kind, ids[start:start + chunk_size]) for start in range(0, len(ids), chunk_size)]
+
+    rendered = {'artist': 0, 'venue': 0}
+    if processes == 1:
+        for kind, ids in chunks:
+            rendered[kind] += sum(render_page(kind, id) for id in ids)
+        return rendered
+    db.session.remove()
+    with ProcessPoolExecutor(processes, initializer=start_worker) as pool:
+        for (kind, _), count in zip(chunks, pool.map(render_chunk, *zip(*chunks)) if chunks else ()):
+            rendered[kind] += count
+    return rendered
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+pages_cli = AppGroup('pages', help='Pre-render the artist and venue pages.')
+
+
+@pages_cli.command('build')
+@click.option('--processes', type=int, default=None, help='Render processes (default PRERENDER_PROCESSES).')
+def build_command(processes):
+    '''Render every artist and venue page, then keep them current in the background.'''
+    # Taken before rendering: anything that happens meanwhile is picked up by the refresh job
+    cursor = latest_position()
+    swept_at = datetime.now()
+    rendered = build_all(processes or current_app.config['PRERENDER_PROCESSES'])
+    save_state(cursor, swept_at)
+    schedule_next('refresh_prerendered_pages')
+    db.session.commit()
+    click.echo(f"Rendered {rendered['artist']} artist and {rendered['venue']} venue pages "
+               f"to {current_app.config['PRERENDER_DIR']}")
+
+
+@pages_cli.command('refresh')
+def refresh_command():
+    '''Re-render the pages touched since the last build or refresh.'''
+    if load_state() is None:
+        raise click.ClickException('Nothing pre-rendered yet; run `flask pages build` first.')
+    refresh_prerendered_pages()
+    db.session.commit()
+    click.echo('Pages refreshed')
@@ -0,0 +1,278 @@
+#IMPORTS
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import lru_cache
+import click
+from flask import current_app, g, request
+from flask.cli import AppGroup
+from itsdangerous import TimestampSigner, BadSignature
+from models import db, Rollup
+#----------------------------------------------------------------------------#
+# On-demand request profiling.
+#
+# A request is profiled when it carries a valid signed X-Profile header (see
+# `flask profiles token`), or when it is picked by the sampling rate: the
+# PROFILE_SAMPLE_RATE setting, or the rate switched on at runtime with
+# `flask profiles enable`.  A profiled request gets a sampler thread that
+# records the request thread's stack every PROFILE_INTERVAL_MS, and the
+# samples are saved as <request id>.folded under PROFILE_DIR, the collapsed
+# stack format flamegraph.pl and speedscope read.  The response carries the
+# request id in X-Profile-Id.
+#
+# Requests that aren't profiled only pay for a header lookup and a cached
+# check of the runtime switch; nothing runs on their thread or beside it.
+#----------------------------------------------------------------------------#
+
+PROFILE_TOGGLE_KEY = 'profiling'
+REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+def signer(app):
+    return TimestampSigner(app.secret_key, salt='profile-request')
+
+
+def make_token(app):
+    return signer(app).sign(b'profile').decode()
+
+
+def valid_token(app, token):
+    try:
+        signer(app).unsign(token, max_age=app.config['PROFILE_TOKEN_MAX_AGE'])
+        return True
+    except BadSignature:
+        return False
+
+
+@lru_cache(maxsize=4096)
+def frame_label(code):
+    # "function (path:line)", with paths under site-packages shortened to the package
+    path = code.co_filename
+    marker = path.rfind('site-packages' + os.sep)
+    path = path[marker + len('site-packages') + 1:] if marker >= 0 else os.path.relpath(path)
+    return f'{code.co_name} ({path}:{code.co_firstlineno})'
+
+
+class Sampler(threading.Thread):
+    '''Counts the distinct stacks of one thread, sampled every `interval` seconds.'''
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if labels:
+                self.stacks[';'.join(reversed(labels))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+class RuntimeSwitch:
+    '''The sampling rate set with `flask profiles enable`, re-read at most every PROFILE_TOGGLE_POLL seconds.'''
+
+    def __init__(self):
+        self.rate = 0.0
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def current_rate(self, app):
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < app.config['PROFILE_TOGGLE_POLL']:
+            return self.rate
+        with self.lock:
+            if self.checked_at is None or now - self.checked_at >= app.config['PROFILE_TOGGLE_POLL']:
+                self.rate = read_toggle()
+                self.checked_at = now
+        return self.rate
+
+
+def read_toggle():
+    # Its own connection, so the check never opens a transaction on the view's session
+    with db.engine.connect() as connection:
+        data = connection.execute(db.select([Rollup.data]).where(Rollup.key == PROFILE_TOGGLE_KEY)).scalar()
+    if data is None:
+        return 0.0
+    toggle = json.loads(data)
+    return toggle['rate'] if datetime.utcnow().isoformat() < toggle['until'] else 0.0
+
+
+def init_profiling(app):
+    '''Register the profiling hooks.'''
+    switch = RuntimeSwitch()
+
+    def wanted():
+        token = request.headers.get('X-Profile')
+        if token is not None:
+            return valid_token(app, token)
+        rate = max(app.config['PROFILE_SAMPLE_RATE'], switch.current_rate(app))
+        return rate > 0 and random.random() < rate
+
+    @app.before_request
+    def start_profile():
+        if request.endpoint == 'static' or not wanted():
+            return
+        request_id = request.headers.get('X-Request-ID', '')
+        g.profile_id = request_id if REQUEST_ID.match(request_id) else uuid.uuid4().hex
+        g.profile_started = time.perf_counter()
+        g.profile_sampler = Sampler(threading.get_ident(), app.config['PROFILE_INTERVAL_MS'] / 1000)
+        g.profile_sampler.start()
+
+    @app.after_request
+    def finish_profile(response):
+        if 'profile_sampler' in g:
+            save_profile(app, response.status_code)
+            response.headers['X-Profile-Id'] = g.profile_id
+        return response
+
+    @app.teardown_request
+    def abandon_profile(error=None):
+        # Never leave a sampler running if the response wasn't finalized
+        if 'profile_sampler' in g:
+            save_profile(app, 500)
+
+
+def save_profile(app, status):
+    stacks = g.pop('profile_sampler').stop()
+    duration = time.perf_counter() - g.profile_started
+    directory = app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, g.profile_id)
+    with open(path + '.folded', 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
+    with open(path + '.json', 'w') as f:
+        json.dump({'id': g.profile_id, 'method': request.method, 'path': request.full_path.rstrip('?'),
+                   'endpoint': request.endpoint, 'status': status, 'duration_ms': round(duration * 1000, 1),
+                   'samples': sum(stacks.values()), 'interval_ms': app.config['PROFILE_INTERVAL_MS'],
+                   'created_at': datetime.utcnow().isoformat()}, f)
+
+
+def load_profile(directory, profile_id):
+    '''(metadata, Counter of folded stacks) of a saved profile.'''
+    path = os.path.join(directory, profile_id)
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    stacks = Counter()
+    with open(path + '.folded') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            stacks[stack] += int(count)
+    return meta, stacks
+
+
+def hottest(stacks, size):
+    '''[(label, self samples, total samples)] of the frames with the most samples of their own.'''
+    own, total = Counter(), Counter()
+    for stack, count in stacks.items():
+        labels = stack.split(';')
+        own[labels[-1]] += count
+        for label in set(labels):
+            total[label] += count
+    return [(label, count, total[label]) for label, count in own.most_common(size)]
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+profiles_cli = AppGroup('profiles', help='Profile requests and read the saved profiles.')
+
+
+@profiles_cli.command('token')
+def token_command():
+    '''Print a token; send it as the X-Profile header to profile that request.'''
+    click.echo(make_token(current_app))
+    click.echo(f"Valid for {current_app.config['PROFILE_TOKEN_MAX_AGE']}s", err=True)
+
+
+@profiles_cli.command('enable')
+@click.option('--rate', type=float, default=0.01, help='Share of requests to profile.')
+@click.option('--minutes', type=int, default=30, help='Switch profiling off again after this long.')
+def enable_command(rate, minutes):
+    '''Profile a share of all requests, in every worker, for a while.'''
+    until = datetime.utcnow() + timedelta(minutes=minutes)
+    data = json.dumps({'rate': rate, 'until': until.isoformat()})
+    rollup = Rollup.query.get(PROFILE_TOGGLE_KEY)
+    if rollup is None:
+        db.session.add(Rollup(key=PROFILE_TOGGLE_KEY, data=data))
+    else:
+        rollup.data = data
+        rollup.refreshed_at = datetime.utcnow()
+    db.session.commit()
+    click.echo(f'Profiling {rate:.1%} of requests until {until:%H:%M} UTC')
+
+
+@profiles_cli.command('disable')
+def disable_command():
+    Rollup.query.filter(Rollup.key == PROFILE_TOGGLE_KEY).delete()
+    db.session.commit()
+    click.echo('Profiling switched off (PROFILE_SAMPLE_RATE still applies)')
+
+
+@profiles_cli.command('list')
+@click.option('--limit', type=int, default=20)
+def list_command(limit):
+    '''The most recent profiles.'''
+    directory = current_app.config['PROFILE_DIR']
+    names = [name for name in os.listdir(directory) if name.endswith('.json')] if os.path.isdir(directory) else []
+    names.sort(key=lambda name: os.path.getmtime(os.path.join(directory, name)), reverse=True)
+    for name in names[:limit]:
+        with open(os.path.join(directory, name)) as f:
+            meta = json.load(f)
+        click.echo(f"{meta['id']:<34}{meta['created_at'][:19]:>21}{meta['status']:>5}{meta['duration_ms']:>10.1f} ms"
+                   f"{meta['samples']:>7}  {meta['method']} {meta['path']}")
+
+
+@profiles_cli.command('show')
+@click.argument('profile_id')
+@click.option('--top', type=int, default=20, help='Number of functions to list.')
+@click.option('--folded', is_flag=True, help='Print the collapsed stacks instead, e.g. for flamegraph.pl.')
+def show_command(profile_id, top, folded):
+    '''Where a profiled request spent its time.'''
+    directory = current_app.config['PROFILE_DIR']
+    if not REQUEST_ID.match(profile_id) or not os.path.exists(os.path.join(directory, profile_id + '.json')):
+        raise click.ClickException(f'No profile {profile_id}')
+    meta, stacks = load_profile(directory, profile_id)
+    if folded:
+        for stack, count in stacks.most_common():
+            click.echo(f'{stack} {count}')
+        return
+    samples = max(meta['samples'], 1)
+    click.echo(f"{meta['method']} {meta['path']} -> {meta['status']} in {meta['duration_ms']} ms, "
+               f"{meta['samples']} samples every {meta['interval_ms']} ms")
+    click.echo(f"{'self':>7}{'total':>8}  function")
+    for label, own, total in hottest(stacks, top):
+        click.echo(f'{own / samples:>7.1%}{total / samples:>8.1%}  {label}')
+
+
+@profiles_cli.command('prune')
+@click.option('--days', type=int, default=7)
+def prune_command(days):
+    '''Delete profiles older than --days.'''
+    directory = current_app.config['PROFILE_DIR']
+    cutoff = time.time() - days * 86400
+    removed = 0
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        path = os.path.join(directory, name)
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed += name.endswith('.json')
+    click.echo(f'Removed {removed} profiles')
@@ -0,0 +1,92 @@
+#IMPORTS
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+#----------------------------------------------------------------------------#
+# Per-client rate limiting (token buckets).
+#
+# Every client gets a bucket per scope that holds up to `burst` tokens and
+# refills at `per_second`; a request takes one token or is turned away with
+# 429.  Buckets live in the worker by default.  With RATE_LIMIT_STORAGE_URL
+# set to a redis:// URL they are shared by every gunicorn worker instead
+# (needs the redis package, which is optional).
+#----------------------------------------------------------------------------#
+
+class MemoryBuckets:
+    '''Token buckets in this process, forgetting the least recently used clients past max_clients.'''
+
+    def __init__(self, max_clients=10000):
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()   # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, per_second):
+        '''Take a token; returns (allowed, seconds until the next token).'''
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return allowed, 0 if allowed else (1 - tokens) / per_second
+
+
+class RedisBuckets:
+    '''The same buckets in Redis, updated atomically by a script so workers share them.'''
+
+    SCRIPT = '''
+local burst, per_second, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * per_second)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / per_second) + 1)
+return {allowed, tostring(tokens)}
+'''
+
+    def __init__(self, url):
+        import redis
+        self._take = redis.Redis.from_url(url).register_script(self.SCRIPT)
+
+    def take(self, key, burst, per_second):
+        allowed, tokens = self._take(keys=[f'ratelimit:{key}'], args=[burst, per_second, time.time()])
+        return bool(allowed), 0 if allowed else (1 - float(tokens)) / per_second
+
+
+_backends = {}
+
+
+def buckets():
+    url = current_app.config['RATE_LIMIT_STORAGE_URL']
+    if url not in _backends:
+        _backends[url] = RedisBuckets(url) if url else MemoryBuckets()
+    return _backends[url]
+
+
+def rate_limited(scope):
+    '''Limit a view per client with the (burst, per_second) configured in RATE_LIMITS[scope].'''
+    def decorator(view):
+        @wraps(view)
+        def limited_view(*args, **kwargs):
+            burst, per_second = current_app.config['RATE_LIMITS'][scope]
+            allowed, retry_after = buckets().take(f'{scope}:{request.remote_addr}', burst, per_second)
+            if not allowed:
+                raise TooManyRequests(retry_after=math.ceil(retry_after))
+            return view(*args, **kwargs)
+        return limited_view
+    return decorator
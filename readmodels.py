@@ -0,0 +1,47 @@
+#IMPORTS
+from datetime import datetime
+from sqlalchemy import and_, func
+from models import db, Venue, Artist, Show
+#----------------------------------------------------------------------------#
+# Read models for the listing pages.
+#
+# Listings select only the columns the page shows, labelled with the names
+# the templates use.  Column queries come back as light named tuples, so no
+# ORM entities are built: nothing enters the session's identity map and
+# there's no per-row instance state or relationship loading.
+#----------------------------------------------------------------------------#
+
+def show_listing():
+    '''Every show of active listings for /shows, with its venue and artist names.'''
+    return db.session.query(
+        Show.id, Show.venue_id, Venue.name.label('venue_name'),
+        Show.artist_id, Artist.name.label('artist_name'), Artist.image_link.label('artist_image_link'),
+        Show.start_time,
+    ).join(Venue, Venue.id == Show.venue_id).join(Artist, Artist.id == Show.artist_id) \
+        .filter(Venue.archived_at.is_(None), Artist.archived_at.is_(None)).all()
+
+
+def show_summary(show_id):
+    '''One show of active listings with its venue and artist names, or None.'''
+    return db.session.query(
+        Show.id, Venue.name.label('venue_name'), Artist.name.label('artist_name'), Show.start_time,
+    ).join(Venue, Venue.id == Show.venue_id).join(Artist, Artist.id == Show.artist_id) \
+        .filter(Show.id == show_id, Venue.archived_at.is_(None), Artist.archived_at.is_(None)).first()
+
+
+def venue_search(search_term):
+    '''Active venues whose name contains search_term, with their upcoming show counts.'''
+    return db.session.query(Venue.id, Venue.name, func.count(Show.id).label('num_upcoming_shows')) \
+        .outerjoin(Show, and_(Show.venue_id == Venue.id, Show.start_time > datetime.now())) \
+        .filter(Venue.name.ilike(f'%{search_term}%'), Venue.archived_at.is_(None)) \
+        .group_by(Venue.id, Venue.name).order_by(Venue.id).all()
+
+
+def artist_search(search_term):
+    '''Active artists whose name, city or state contains search_term, with their upcoming show counts.'''
+    pattern = f'%{search_term}%'
+    return db.session.query(Artist.id, Artist.name, func.count(Show.id).label('upcoming_shows')) \
+        .outerjoin(Show, and_(Show.artist_id == Artist.id, Show.start_time > datetime.now())) \
+        .filter(Artist.name.ilike(pattern) | Artist.city.ilike(pattern) | Artist.state.ilike(pattern),
+                Artist.archived_at.is_(None)) \
+        .group_by(Artist.id, Artist.name).order_by(Artist.id).all()
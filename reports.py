@@ -0,0 +1,213 @@
+#IMPORTS
+import json
+from datetime import datetime
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from models import db, Venue, Artist, Show, ShowArchive, Genre, Rollup, artist_genre_table
+from jobs import periodic, schedule_next
+import numpy as np
+#----------------------------------------------------------------------------#
+# Analytics reports.
+#
+# refresh_reports() reads the show fact table (Show and ShowArchive) for the
+# reporting window once, as NumPy columns, and computes every report with
+# grouped array operations (bincount / unique) instead of one SQL query per
+# question.  The results are stored in a Rollup row, so /reports and
+# `flask reports show` never touch the Show tables.
+#----------------------------------------------------------------------------#
+
+REPORTS_KEY = 'reports'
+# Artists are bucketed by number of shows in the window: 1, 2-4, 5-9, 10+
+FREQUENCY_BINS = [1, 2, 5, 10]
+
+
+def month_number(moment):
+    # Months since 1970-01, numpy's datetime64[M] unit
+    return (moment.year - 1970) * 12 + moment.month - 1
+
+
+def month_label(number):
+    return f'{1970 + number // 12}-{number % 12 + 1:02d}'
+
+
+def reporting_window(now=None):
+    '''(since, until): the first days of the months bounding the window.'''
+    now = now or datetime.utcnow()
+    first = month_number(now) - current_app.config['REPORTS_MONTHS_BACK']
+    last = month_number(now) + current_app.config['REPORTS_MONTHS_AHEAD'] + 1
+    return (datetime(1970 + first // 12, first % 12 + 1, 1), datetime(1970 + last // 12, last % 12 + 1, 1))
+
+
+def extract_facts(since, until):
+    '''The shows starting in [since, until) as columns, plus the dimensions the reports join to.'''
+    rows = []
+    for model in (Show, ShowArchive):
+        rows += db.session.query(model.start_time, model.venue_id, model.artist_id) \
+            .filter(model.start_time >= since, model.start_time < until).all()
+    start_times, venue_ids, artist_ids = zip(*rows) if rows else ((), (), ())
+    start_times = np.array(start_times, dtype='datetime64[s]')
+
+    venues = db.session.query(Venue.id, Venue.city, Venue.state) \
+        .filter(Venue.archived_at.is_(None)).order_by(Venue.id).all()
+    artists = db.session.query(Artist.id, Artist.name).filter(Artist.archived_at.is_(None)).order_by(Artist.id).all()
+    genres = db.session.query(Genre.id, Genre.name).order_by(Genre.id).all()
+    links = db.session.query(artist_genre_table.c.artist_id, artist_genre_table.c.genre_id).all()
+    return {
+        'month': start_times.astype('datetime64[M]').astype(np.int64),
+        'day': start_times.astype('datetime64[D]').astype(np.int64),
+        'venue_id': np.array(venue_ids, dtype=np.int64),
+        'artist_id': np.array(artist_ids, dtype=np.int64),
+        'venues.id': np.array([id for id, _, _ in venues], dtype=np.int64),
+        'venues.area': np.array([f'{city}, {state}' for _, city, state in venues], dtype=str),
+        'artists.id': np.array([id for id, _ in artists], dtype=np.int64),
+        'artists.name': np.array([name for _, name in artists], dtype=str),
+        'genres.id': np.array([id for id, _ in genres], dtype=np.int64),
+        'genres.name': np.array([name for _, name in genres], dtype=str),
+        'links.artist_id': np.array([artist_id for artist_id, _ in links], dtype=np.int64),
+        'links.genre_id': np.array([genre_id for _, genre_id in links], dtype=np.int64),
+    }
+
+
+def positions(ids, keys):
+    '''Index of each key in the sorted ids array, and a mask of the keys that are there.'''
+    found = np.searchsorted(ids, keys)
+    found = np.minimum(found, max(len(ids) - 1, 0))
+    mask = ids[found] == keys if len(ids) else np.zeros(len(keys), dtype=bool)
+    return found, mask
+
+
+def genre_months(facts, first_month, months):
+    '''Shows per genre per month; a show counts once for every genre of its artist.'''
+    # Sort the artist-genre links by artist and expand every show into one row per link of its artist
+    order = np.argsort(facts['links.artist_id'], kind='stable')
+    link_artists, link_genres = facts['links.artist_id'][order], facts['links.genre_id'][order]
+    starts = np.searchsorted(link_artists, facts['artist_id'], side='left')
+    counts = np.searchsorted(link_artists, facts['artist_id'], side='right') - starts
+    shows = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    genre, known = positions(facts['genres.id'], link_genres[np.repeat(starts, counts) + offsets])
+    genre, shows = genre[known], shows[known]
+
+    table = np.bincount(genre * months + (facts['month'][shows] - first_month),
+                        minlength=len(facts['genres.id']) * months).reshape(-1, months)
+    totals = table.sum(axis=1)
+    return [{'genre': str(facts['genres.name'][row]), 'counts': table[row].tolist(), 'total': int(totals[row])}
+            for row in np.argsort(-totals, kind='stable') if totals[row]]
+
+
+def venue_utilization(facts, since, until):
+    '''Per city: venues, shows and the share of venue-days with at least one show.'''
+    venue, active = positions(facts['venues.id'], facts['venue_id'])
+    venue, day = venue[active], facts['day'][active]
+    days = (until - since).days
+    first_day = (since - datetime(1970, 1, 1)).days
+    areas, area_of_venue = np.unique(facts['venues.area'], return_inverse=True)
+
+    booked_days = np.unique(venue * days + (day - first_day)) // days
+    venues_per_area = np.bincount(area_of_venue, minlength=len(areas))
+    shows_per_area = np.bincount(area_of_venue[venue], minlength=len(areas))
+    booked_per_area = np.bincount(area_of_venue[booked_days], minlength=len(areas))
+    utilization = booked_per_area / np.maximum(venues_per_area * days, 1)
+    return [{'area': str(areas[area]), 'venues': int(venues_per_area[area]), 'shows': int(shows_per_area[area]),
+             'booked_days': int(booked_per_area[area]), 'utilization': round(float(utilization[area]) * 100, 2)}
+            for area in np.argsort(-utilization, kind='stable')]
+
+
+def artist_frequency(facts, first_month, months, size):
+    '''The most booked artists, and how many artists fall in each FREQUENCY_BINS bucket.'''
+    artist, active = positions(facts['artists.id'], facts['artist_id'])
+    artist, month = artist[active], facts['month'][active] - first_month
+    shows = np.bincount(artist, minlength=len(facts['artists.id']))
+    active_months = np.bincount(np.unique(artist * months + month) // months, minlength=len(facts['artists.id']))
+
+    top = [{'id': int(facts['artists.id'][row]), 'name': str(facts['artists.name'][row]), 'shows': int(shows[row]),
+            'active_months': int(active_months[row]),
+            'shows_per_active_month': round(float(shows[row]) / max(int(active_months[row]), 1), 2)}
+           for row in np.argsort(-shows, kind='stable')[:size] if shows[row]]
+    histogram, _ = np.histogram(shows, bins=FREQUENCY_BINS + [max(int(shows.max(initial=0)), FREQUENCY_BINS[-1]) + 1])
+    labels = [f'{low}' if high - low == 1 else f'{low}-{high - 1}' for low, high in zip(FREQUENCY_BINS, FREQUENCY_BINS[1:])]
+    return top, [{'shows': label, 'artists': int(count)} for label, count in zip(labels + [f'{FREQUENCY_BINS[-1]}+'], histogram)]
+
+
+def compute_reports(now=None):
+    since, until = reporting_window(now)
+    first_month, months = month_number(since), month_number(until) - month_number(since)
+    facts = extract_facts(since, until)
+    top_artists, frequency = artist_frequency(facts, first_month, months, current_app.config['REPORTS_TOP_ARTISTS'])
+    return {
+        'since': since.date().isoformat(),
+        'until': until.date().isoformat(),
+        'num_shows': int(len(facts['month'])),
+        'months': [month_label(first_month + offset) for offset in range(months)],
+        'genre_months': genre_months(facts, first_month, months),
+        'venue_utilization': venue_utilization(facts, since, until),
+        'top_artists': top_artists,
+        'booking_frequency': frequency,
+    }
+
+
+def load_reports():
+    '''The stored reports and when they were built, or (None, None) before the first refresh.'''
+    row = db.session.query(Rollup.data, Rollup.refreshed_at).filter(Rollup.key == REPORTS_KEY).one_or_none()
+    return (json.loads(row.data), row.refreshed_at) if row else (None, None)
+
+
+@periodic('REPORTS_INTERVAL')
+def refresh_reports():
+    data = json.dumps(compute_reports())
+    rollup = Rollup.query.get(REPORTS_KEY)
+    if rollup is None:
+        db.session.add(Rollup(key=REPORTS_KEY, data=data))
+    else:
+        rollup.data = data
+        rollup.refreshed_at = datetime.utcnow()
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+reports_cli = AppGroup('reports', help='Build and print the analytics reports.')
+
+
+@reports_cli.command('refresh')
+def refresh_command():
+    refresh_reports()
+    # Keep the reports refreshing on their own from now on
+    schedule_next('refresh_reports')
+    db.session.commit()
+    click.echo('Reports refreshed')
+
+
+@reports_cli.command('show')
+@click.argument('report', type=click.Choice(['genres', 'venues', 'artists']))
+def show_command(report):
+    '''Print one of the stored reports.'''
+    data, refreshed_at = load_reports()
+    if data is None:
+        raise click.ClickException('No reports yet; run `flask reports refresh` first.')
+    click.echo(f"{data['num_shows']} shows from {data['since']} to {data['until']}, built {refreshed_at:%Y-%m-%d %H:%M}")
+    if report == 'genres':
+        click.echo(f"{'genre':<20}" + ''.join(f'{month[2:]:>8}' for month in data['months']) + f"{'total':>8}")
+        for row in data['genre_months']:
+            click.echo(f"{row['genre']:<20}" + ''.join(f'{count:>8}' for count in row['counts']) + f"{row['total']:>8}")
+    elif report == 'venues':
+        click.echo(f"{'city':<30}{'venues':>8}{'shows':>8}{'booked days':>13}{'utilization':>13}")
+        for row in data['venue_utilization']:
+            click.echo(f"{row['area']:<30}{row['venues']:>8}{row['shows']:>8}{row['booked_days']:>13}{row['utilization']:>12}%")
+    else:
+        click.echo(f"{'artist':<30}{'shows':>8}{'months':>8}{'per month':>11}")
+        for row in data['top_artists']:
+            click.echo(f"{row['name']:<30}{row['shows']:>8}{row['active_months']:>8}{row['shows_per_active_month']:>11}")
+        for row in data['booking_frequency']:
+            click.echo(f"{row['artists']} artists with {row['shows']} shows")
+
+
+@reports_cli.command('snapshot')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+def snapshot_command(path):
+    '''Save the reporting window's fact table as a NumPy .npz file for ad-hoc analysis.'''
+    since, until = reporting_window()
+    facts = extract_facts(since, until)
+    np.savez_compressed(path, **facts)
+    click.echo(f"Saved {len(facts['month'])} shows from {since:%Y-%m-%d} to {until:%Y-%m-%d} to {path}")
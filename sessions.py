@@ -0,0 +1,150 @@
+#IMPORTS
+import os
+import secrets
+from datetime import datetime
+import click
+from flask.cli import AppGroup
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+from werkzeug.exceptions import HTTPException
+from models import db, WebSession
+from jobs import periodic
+#----------------------------------------------------------------------------#
+# Server-side sessions.
+#
+# Session data (mostly flashed messages and form errors) is stored in the
+# WebSession table and the cookie carries only a signed random id, so
+# requests stay small and every worker sees the same session.  Rows are
+# written on a separate connection so a session save never commits or rolls
+# back the view's own work.  Expired rows are removed by the purge_sessions
+# job or `flask sessions cleanup`.
+#
+# Views marked @sessionless (static files, JSON and calendar endpoints) get
+# Flask's read-only null session instead, so a poll of /changes or of a
+# calendar feed costs no session lookup.
+#----------------------------------------------------------------------------#
+
+def load_secret_key(path):
+    # Generated once and kept in a file, so restarts and every worker sign with the same key
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}'
+        with open(temporary, 'wb') as f:
+            f.write(os.urandom(32))
+        os.chmod(temporary, 0o600)
+        try:
+            os.link(temporary, path)    # fails if another process got there first; theirs wins
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temporary)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def init_secret_key(app):
+    if not app.config['SECRET_KEY']:
+        app.config['SECRET_KEY'] = load_secret_key(app.config['SECRET_KEY_PATH'])
+
+
+def sessionless(view):
+    '''Mark a view that never reads or writes the session.'''
+    view.sessionless = True
+    return view
+
+
+def is_sessionless(app, request):
+    # The session is opened before Flask routes the request, so look the endpoint up here
+    try:
+        endpoint, _ = app.create_url_adapter(request).match()
+    except HTTPException:
+        return False
+    return endpoint == 'static' or getattr(app.view_functions.get(endpoint), 'sessionless', False)
+
+
+class DatabaseSession(CallbackDict, SessionMixin):
+
+    def __init__(self, data=None, sid=None, expires_at=None):
+        def on_update(session):
+            session.modified = True
+        super().__init__(data, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.new = sid is None
+        self.modified = False
+
+
+class DatabaseSessionInterface(SessionInterface):
+
+    def signer(self, app):
+        return Signer(app.secret_key, salt='session-id')
+
+    def open_session(self, app, request):
+        if is_sessionless(app, request):
+            return self.make_null_session(app)
+        cookie = request.cookies.get(app.session_cookie_name)
+        if not cookie or not app.secret_key:
+            return DatabaseSession()
+        try:
+            sid = self.signer(app).unsign(cookie).decode()
+        except BadSignature:
+            return DatabaseSession()
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                db.select([WebSession.data, WebSession.expires_at])
+                .where(WebSession.id == sid).where(WebSession.expires_at > datetime.utcnow())).first()
+        if row is None:
+            return DatabaseSession()
+        return DatabaseSession(session_json_serializer.loads(row.data), sid, row.expires_at)
+
+    def save_session(self, app, session, response):
+        domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+        table = WebSession.__table__
+        if not session:
+            if session.sid is not None:
+                with db.engine.begin() as connection:
+                    connection.execute(table.delete().where(table.c.id == session.sid))
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime
+        now = datetime.utcnow()
+        # Untouched sessions are written only to push out an expiry that is more than half used up
+        if not session.modified and session.expires_at - now > lifetime / 2:
+            return
+        expires_at = now + lifetime
+        values = {'data': session_json_serializer.dumps(dict(session)), 'expires_at': expires_at}
+        with db.engine.begin() as connection:
+            updated = session.sid is not None and \
+                connection.execute(table.update().where(table.c.id == session.sid).values(values)).rowcount
+            if not updated:
+                session.sid = secrets.token_urlsafe(32)
+                connection.execute(table.insert().values(id=session.sid, **values))
+        response.set_cookie(
+            app.session_cookie_name, self.signer(app).sign(session.sid).decode(),
+            expires=expires_at if session.permanent else None,
+            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+def delete_expired_sessions():
+    deleted = WebSession.query.filter(WebSession.expires_at <= datetime.utcnow()).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+@periodic('SESSION_CLEANUP_INTERVAL')
+def purge_sessions():
+    delete_expired_sessions()
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+sessions_cli = AppGroup('sessions', help='Maintain the server-side sessions.')
+
+
+@sessions_cli.command('cleanup')
+def cleanup_command():
+    click.echo(f'Deleted {delete_expired_sessions()} expired sessions')
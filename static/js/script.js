@@ -2,3 +2,36 @@ window.parseISOString = function parseISOString(s) {
   var b = s.split(/\D+/);
   return new Date(Date.UTC(b[0], --b[1], b[2], b[3], b[4], b[5], b[6]));
 };
+
+// Name autocomplete: <input data-typeahead="/artists/autocomplete" data-target="artist_id" list="...">
+// fills its datalist as the user types and puts the id of the chosen name in the target field.
+document.querySelectorAll('input[data-typeahead]').forEach(function (input) {
+  var options = document.getElementById(input.getAttribute('list'));
+  var target = document.getElementById(input.dataset.target);
+  var ids = {};
+  var pending = null;
+
+  input.addEventListener('input', function () {
+    target.value = ids[input.value] || '';
+    clearTimeout(pending);
+    pending = setTimeout(function () {
+      fetch(input.dataset.typeahead + '?q=' + encodeURIComponent(input.value))
+        .then(function (response) { return response.ok ? response.json() : { results: [] }; })
+        .then(function (data) {
+          options.innerHTML = '';
+          data.results.forEach(function (result) {
+            // Two listings can share a name; tell them apart by id
+            var label = result.name;
+            if (ids[label] !== undefined && ids[label] !== result.id) {
+              label += ' (#' + result.id + ')';
+            }
+            ids[label] = result.id;
+            var option = document.createElement('option');
+            option.value = label;
+            options.appendChild(option);
+          });
+          target.value = ids[input.value] || '';
+        });
+    }, 100);
+  });
+});
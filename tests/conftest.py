@@ -0,0 +1,11 @@
+#IMPORTS
+import os
+import sys
+#----------------------------------------------------------------------------#
+# Checks of the pure helpers behind the request paths, run with
+# `python -m pytest` from the project directory.  They need neither a
+# database nor a running app.
+#----------------------------------------------------------------------------#
+
+# The modules are imported the way app.py imports them, from the project directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,79 @@
+#IMPORTS
+import threading
+import time
+import pytest
+from cache import SingleFlight
+#----------------------------------------------------------------------------#
+# Request coalescing (cache.py).
+#----------------------------------------------------------------------------#
+
+def run_together(flight, key, compute, callers):
+    '''Start callers threads calling flight.do(key, compute); returns their results (or exceptions).'''
+    results = [None] * callers
+
+    def call(number):
+        try:
+            results[number] = flight.do(key, compute)
+        except Exception as e:
+            results[number] = e
+
+    threads = [threading.Thread(target=call, args=(number,)) for number in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_concurrent_callers_share_one_computation():
+    flight, release, calls = SingleFlight(), threading.Event(), []
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return 'result'
+
+    threads, results = run_together(flight, 'key', compute, 8)
+    # Let the followers queue up behind the leader before it finishes
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert results == ['result'] * 8
+
+
+def test_the_leaders_exception_reaches_every_waiter():
+    flight, release = SingleFlight(), threading.Event()
+
+    def compute():
+        release.wait(5)
+        raise ValueError('boom')
+
+    threads, results = run_together(flight, 'key', compute, 4)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_a_finished_key_is_computed_again():
+    flight, calls = SingleFlight(), []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert flight.do('key', compute) == 1
+    assert flight.do('key', compute) == 2
+    with pytest.raises(ZeroDivisionError):
+        flight.do('key', lambda: 1 / 0)
+    assert flight.do('key', compute) == 3
+
+
+def test_different_keys_do_not_wait_for_each_other():
+    flight, release = SingleFlight(), threading.Event()
+    threads, _ = run_together(flight, 'slow', lambda: release.wait(5), 1)
+    try:
+        assert flight.do('fast', lambda: 'done') == 'done'
+    finally:
+        release.set()
+        threads[0].join(5)
@@ -0,0 +1,34 @@
+#IMPORTS
+import pytest
+from calendars import escape_text, fold
+#----------------------------------------------------------------------------#
+# iCalendar line folding and escaping (calendars.py, RFC 5545).
+#----------------------------------------------------------------------------#
+
+def unfold(text):
+    return text.replace('\r\n ', '')
+
+
+@pytest.mark.parametrize('line', [
+    'SUMMARY:short',
+    'SUMMARY:' + 'x' * 67,                      # exactly 75 octets
+    'SUMMARY:' + 'x' * 68,
+    'LOCATION:' + 'Café Zürich, ' * 30,
+    'SUMMARY:' + '🎸' * 40,                     # 4-octet characters
+])
+def test_folded_lines_fit_and_unfold_to_the_original(line):
+    folded = fold(line)
+    assert folded.endswith('\r\n')
+    assert unfold(folded) == line + '\r\n'
+    physical = folded[:-2].split('\r\n')
+    assert all(len(part.encode()) <= 75 for part in physical)
+    assert all(part.startswith(' ') for part in physical[1:])
+
+
+def test_short_lines_are_not_folded():
+    assert fold('BEGIN:VCALENDAR') == 'BEGIN:VCALENDAR\r\n'
+
+
+def test_escape_text():
+    assert escape_text('Rock; Roll, and\\more\nlines') == 'Rock\\; Roll\\, and\\\\more\\nlines'
+    assert escape_text(None) == ''
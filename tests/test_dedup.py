@@ -0,0 +1,62 @@
+#IMPORTS
+from dedup import DuplicateIndex, jaccard, name_key, name_trigrams, phone_key, place_key, signature, trigrams
+#----------------------------------------------------------------------------#
+# Name similarity and MinHash blocking (dedup.py).
+#----------------------------------------------------------------------------#
+
+def test_name_key_normalizes_articles_accents_and_ampersands():
+    assert name_key('The Musical Hop & Café!') == 'musical hop and cafe'
+    assert name_key('The') == 'the'
+    assert name_key(None) == ''
+
+
+def test_phone_key():
+    assert phone_key('1 (415) 555-1234') == '4155551234'
+    assert phone_key('415.555.1234') == '4155551234'
+    assert phone_key('555-12') is None
+    assert phone_key(None) is None
+
+
+def test_place_key_ignores_the_case_of_the_city():
+    assert place_key('San Francisco', 'CA') == place_key('san francisco', 'CA')
+    assert place_key('San Francisco', 'CA') != place_key('San Francisco', 'NY')
+
+
+def test_trigrams_are_padded():
+    assert trigrams('hop') == {' ho', 'hop', 'op '}
+
+
+def test_jaccard():
+    assert jaccard(name_trigrams('The Musical Hop'), name_trigrams('musical hop!')) == 1.0
+    assert jaccard(frozenset(), frozenset()) == 0.0
+    similar = jaccard(name_trigrams('The Musical Hop'), name_trigrams('The Musicla Hop'))
+    different = jaccard(name_trigrams('The Musical Hop'), name_trigrams('Park Square Live'))
+    assert 0 <= different < similar < 1
+
+
+def test_signatures_are_stable_and_track_similarity():
+    assert signature(trigrams('musical hop'), 36) == signature(trigrams('musical hop'), 36)
+    assert len(signature(trigrams('musical hop'), 36)) == 36
+    base = signature(trigrams('musical hop'), 200)
+
+    def agreement(name):
+        return sum(a == b for a, b in zip(base, signature(trigrams(name), 200))) / 200
+
+    # The share of equal MinHash values estimates the Jaccard similarity of the trigram sets
+    assert agreement('musicla hop') > agreement('park square live music') + 0.2
+
+
+def test_blocking_pairs_misspelled_names_in_the_same_place():
+    index = DuplicateIndex(bands=12, rows=3)
+    index.build({
+        1: {'name': 'The Musical Hop', 'city': 'San Francisco', 'state': 'CA', 'phone': ''},
+        2: {'name': 'Musical Hop!', 'city': 'san francisco', 'state': 'CA', 'phone': ''},
+        3: {'name': 'The Musical Hop', 'city': 'Boston', 'state': 'MA', 'phone': ''},
+        4: {'name': 'Park Square', 'city': 'Boston', 'state': 'MA', 'phone': '1-415-555-1234'},
+        5: {'name': 'Dueling Pianos', 'city': 'New York', 'state': 'NY', 'phone': '415 555 1234'},
+    })
+    pairs = index.candidate_pairs(max_bucket=200)
+    assert (1, 2) in pairs
+    assert (1, 3) not in pairs and (2, 3) not in pairs
+    assert (4, 5) in pairs          # same phone, wherever they are
+    assert index.candidate_pairs(max_bucket=1) == set()
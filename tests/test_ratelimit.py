@@ -0,0 +1,66 @@
+#IMPORTS
+import pytest
+import ratelimit
+from ratelimit import MemoryBuckets
+#----------------------------------------------------------------------------#
+# Token buckets (ratelimit.py), on a clock the tests move by hand.
+#----------------------------------------------------------------------------#
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    return clock
+
+
+def test_a_full_bucket_allows_a_burst_then_refuses(clock):
+    buckets = MemoryBuckets()
+    assert [buckets.take('client', 3, 2)[0] for _ in range(3)] == [True, True, True]
+    allowed, wait = buckets.take('client', 3, 2)
+    assert not allowed
+    assert wait == pytest.approx(0.5)
+
+
+def test_tokens_refill_at_the_rate(clock):
+    buckets = MemoryBuckets()
+    for _ in range(3):
+        buckets.take('client', 3, 2)
+    clock.now += 0.5
+    assert buckets.take('client', 3, 2)[0]
+    assert not buckets.take('client', 3, 2)[0]
+
+
+def test_refill_stops_at_the_burst(clock):
+    buckets = MemoryBuckets()
+    buckets.take('client', 3, 2)
+    clock.now += 3600
+    assert [buckets.take('client', 3, 2)[0] for _ in range(4)] == [True, True, True, False]
+
+
+def test_a_refused_request_takes_no_token(clock):
+    buckets = MemoryBuckets()
+    buckets.take('client', 1, 1)
+    assert buckets.take('client', 1, 1) == (False, pytest.approx(1.0))
+    clock.now += 0.5
+    assert buckets.take('client', 1, 1) == (False, pytest.approx(0.5))
+    clock.now += 0.5
+    assert buckets.take('client', 1, 1)[0]
+
+
+def test_clients_have_their_own_buckets_and_the_oldest_is_forgotten(clock):
+    buckets = MemoryBuckets(max_clients=2)
+    buckets.take('a', 1, 1)
+    assert not buckets.take('a', 1, 1)[0]
+    assert buckets.take('b', 1, 1)[0]
+    buckets.take('c', 1, 1)
+    # 'a' was the least recently used and was dropped: it starts over with a full bucket
+    assert buckets.take('a', 1, 1)[0]
@@ -0,0 +1,22 @@
+#IMPORTS
+import pytest
+from tickets import stripe_sizes
+#----------------------------------------------------------------------------#
+# Stock striping (tickets.py).
+#----------------------------------------------------------------------------#
+
+@pytest.mark.parametrize('capacity, stripes', [(1000, 16), (17, 16), (16, 16), (5, 16), (1, 16), (1001, 16), (10, 1)])
+def test_stripes_hold_exactly_the_capacity_evenly(capacity, stripes):
+    sizes = stripe_sizes(capacity, stripes)
+    assert sum(sizes) == capacity
+    assert len(sizes) == min(capacity, stripes)
+    assert max(sizes) - min(sizes) <= 1
+    assert min(sizes) >= 1
+
+
+def test_first_stripes_take_the_remainder():
+    assert stripe_sizes(10, 4) == [3, 3, 2, 2]
+
+
+def test_an_empty_tier_still_has_one_stripe():
+    assert stripe_sizes(0, 16) == [0]
@@ -0,0 +1,59 @@
+#IMPORTS
+from typeahead import PrefixIndex, name_keys
+#----------------------------------------------------------------------------#
+# The autocomplete prefix index (typeahead.py).
+#----------------------------------------------------------------------------#
+
+NAMES = [(1, 'The Musical Hop'), (2, 'Hop Scotch'), (3, 'Park Square Live Music & Coffee'),
+         (4, 'Guns N Petals'), (5, 'Hopper'), (6, 'Zz Top')]
+
+
+def built(rows=NAMES):
+    index = PrefixIndex()
+    index.build(rows)
+    return index
+
+
+def test_name_keys():
+    assert name_keys('  The  Musical Hop ') == ('the musical hop', {'musical hop', 'hop'})
+    assert name_keys('Hopper') == ('hopper', set())
+
+
+def test_whole_name_matches_come_before_later_words():
+    assert built().search('hop', 10) == [(2, 'Hop Scotch'), (5, 'Hopper'), (1, 'The Musical Hop')]
+
+
+def test_the_limit_bounds_the_result():
+    assert built().search('hop', 2) == [(2, 'Hop Scotch'), (5, 'Hopper')]
+    assert built().search('hop', 0) == []
+
+
+def test_prefixes_at_the_ends_of_the_lists():
+    index = built()
+    assert index.search('zz', 10) == [(6, 'Zz Top')]
+    assert index.search('zzz', 10) == []
+    assert index.search('a', 10) == []
+    assert index.search('top', 10) == [(6, 'Zz Top')]
+
+
+def test_a_name_is_listed_once_however_many_words_match():
+    index = built([(1, 'Music Music Music')])
+    assert index.search('mus', 10) == [(1, 'Music Music Music')]
+
+
+def test_blank_prefixes_and_spacing():
+    index = built()
+    assert index.search('   ', 10) == []
+    assert index.search(' MUSICAL   hop', 10) == [(1, 'The Musical Hop')]
+
+
+def test_add_and_remove_keep_the_index_sorted():
+    index = built()
+    index.add(7, 'Hop On')
+    index.add(2, 'Scotch Hop')      # renamed
+    index.remove(5)
+    assert index.search('hop', 10) == [(7, 'Hop On'), (1, 'The Musical Hop'), (2, 'Scotch Hop')]
+    assert index._whole == sorted(index._whole)
+    assert index._inner == sorted(index._inner)
+    index.remove(99)                # not there: nothing happens
+    assert index.search('hopper', 10) == []
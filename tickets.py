@@ -0,0 +1,205 @@
+#IMPORTS
+import random
+import secrets
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func
+from models import db, TicketTier, TicketStock, TicketHold
+from jobs import periodic, schedule_next
+#----------------------------------------------------------------------------#
+# Ticket inventory.
+#
+# A show has ticket tiers, and the unsold seats of a tier are spread over
+# several TicketStock rows ("stripes").  Holding seats is a single
+# conditional UPDATE on one randomly picked stripe
+#     UPDATE "TicketStock" SET available = available - n
+#     WHERE tier_id = ? AND stripe = ? AND available >= n
+# so concurrent holds on a popular show mostly touch different rows, and a
+# stripe can never go below zero: a tier can't be oversold.  A hold takes the
+# seats out of stock right away; purchasing it only flips its status, while
+# releasing or expiring it puts the seats back on a random stripe.
+# Expired holds are returned by the expire_holds job and, for a tier that
+# looks sold out, by the hold attempt itself.
+#----------------------------------------------------------------------------#
+
+class SoldOut(Exception):
+    '''Not enough seats left in the tier for the hold.'''
+
+
+def stripe_sizes(capacity, stripes):
+    '''The seats of each stock stripe: at most `stripes` of them (and at least one), as even as possible.'''
+    stripes = max(min(stripes, capacity), 1)
+    # The first stripes take the remainder
+    return [capacity // stripes + (stripe < capacity % stripes) for stripe in range(stripes)]
+
+
+def add_tier(show_id, name, price_cents, capacity):
+    '''Create a tier with its stock stripes; the caller commits.'''
+    sizes = stripe_sizes(capacity, current_app.config['TICKET_STRIPES'])
+    tier = TicketTier(show_id=show_id, name=name, price_cents=price_cents, capacity=capacity, stripes=len(sizes))
+    db.session.add(tier)
+    db.session.flush()
+    db.session.execute(TicketStock.__table__.insert(), [
+        {'tier_id': tier.id, 'stripe': stripe, 'available': available} for stripe, available in enumerate(sizes)])
+    return tier
+
+
+def show_tiers(show_id):
+    '''The tiers of a show with the seats still available in each.'''
+    return db.session.query(TicketTier.id, TicketTier.name, TicketTier.price_cents, TicketTier.capacity,
+                            func.coalesce(func.sum(TicketStock.available), 0).label('available')) \
+        .outerjoin(TicketStock, TicketStock.tier_id == TicketTier.id) \
+        .filter(TicketTier.show_id == show_id) \
+        .group_by(TicketTier.id, TicketTier.name, TicketTier.price_cents, TicketTier.capacity) \
+        .order_by(TicketTier.price_cents).all()
+
+
+def take_from_stripe(tier_id, stripe, quantity):
+    stock = TicketStock.__table__
+    return db.session.execute(
+        stock.update()
+        .where(stock.c.tier_id == tier_id).where(stock.c.stripe == stripe).where(stock.c.available >= quantity)
+        .values(available=stock.c.available - quantity)).rowcount == 1
+
+
+def take_seats(tier_id, quantity):
+    '''Take quantity seats out of the tier's stock, or return False if it doesn't have them.'''
+    # Fast path: one stripe that can cover the whole hold, tried in random order.  A failed
+    # UPDATE keeps no lock, so at most one stripe is locked at any time
+    stripes = [stripe for (stripe,) in db.session.query(TicketStock.stripe)
+               .filter(TicketStock.tier_id == tier_id, TicketStock.available >= quantity)]
+    random.shuffle(stripes)
+    for stripe in stripes:
+        if take_from_stripe(tier_id, stripe, quantity):
+            return True
+
+    # Nearly sold out: gather the seats from several stripes, locking them in stripe order
+    # so two such holds can't deadlock
+    taken = []
+    for stripe, available in db.session.query(TicketStock.stripe, TicketStock.available) \
+            .filter(TicketStock.tier_id == tier_id, TicketStock.available > 0).order_by(TicketStock.stripe):
+        amount = min(available, quantity - sum(amount for _, amount in taken))
+        if take_from_stripe(tier_id, stripe, amount):
+            taken.append((stripe, amount))
+            if sum(amount for _, amount in taken) == quantity:
+                return True
+    for stripe, amount in taken:
+        put_on_stripe(tier_id, stripe, amount)
+    return False
+
+
+def put_on_stripe(tier_id, stripe, quantity):
+    stock = TicketStock.__table__
+    db.session.execute(
+        stock.update()
+        .where(stock.c.tier_id == tier_id).where(stock.c.stripe == stripe)
+        .values(available=stock.c.available + quantity))
+
+
+def return_seats(tier_id, quantity):
+    stripes = db.session.query(TicketTier.stripes).filter(TicketTier.id == tier_id).scalar()
+    put_on_stripe(tier_id, random.randrange(stripes), quantity)
+
+
+def hold_tickets(tier_id, quantity):
+    '''Hold quantity seats of a tier and return the hold's id; the caller commits.
+
+    Raises SoldOut if the tier doesn't have that many seats left, even after
+    returning its expired holds.
+    '''
+    if not take_seats(tier_id, quantity):
+        if not expire_holds(tier_id=tier_id) or not take_seats(tier_id, quantity):
+            raise SoldOut(tier_id)
+    hold_id = secrets.token_urlsafe(16)
+    db.session.execute(TicketHold.__table__.insert().values(
+        id=hold_id, tier_id=tier_id, quantity=quantity, status='held', created_at=datetime.utcnow(),
+        expires_at=datetime.utcnow() + timedelta(seconds=current_app.config['TICKET_HOLD_SECONDS'])))
+    return hold_id
+
+
+def purchase_hold(hold_id):
+    '''Turn a live hold into a purchase; returns False if it is no longer held.
+
+    Payment is out of scope here: this is the step a payment callback would make.
+    '''
+    now = datetime.utcnow()
+    return TicketHold.query.filter(TicketHold.id == hold_id, TicketHold.status == 'held',
+                                   TicketHold.expires_at > now) \
+        .update({'status': 'purchased', 'purchased_at': now}, synchronize_session=False) == 1
+
+
+def release_hold(hold_id, status='released'):
+    '''Give a held hold's seats back; returns False if it wasn't held any more.'''
+    hold = db.session.query(TicketHold.tier_id, TicketHold.quantity).filter(TicketHold.id == hold_id).one_or_none()
+    # The status guard makes sure a hold's seats only go back once, whoever gets there first
+    if hold is None or TicketHold.query.filter(TicketHold.id == hold_id, TicketHold.status == 'held') \
+            .update({'status': status}, synchronize_session=False) != 1:
+        return False
+    return_seats(hold.tier_id, hold.quantity)
+    return True
+
+
+def expire_holds(tier_id=None, batch_size=500):
+    '''Return the seats of holds past their expiry; returns how many holds expired.'''
+    expired = db.session.query(TicketHold.id) \
+        .filter(TicketHold.status == 'held', TicketHold.expires_at <= datetime.utcnow())
+    if tier_id is not None:
+        expired = expired.filter(TicketHold.tier_id == tier_id)
+    return sum(release_hold(hold_id, status='expired') for (hold_id,) in expired.limit(batch_size).all())
+
+
+@periodic('TICKET_EXPIRY_INTERVAL')
+def expire_ticket_holds():
+    while expire_holds():
+        db.session.commit()
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+tickets_cli = AppGroup('tickets', help='Ticket tiers and holds.')
+
+
+@tickets_cli.command('add-tier')
+@click.argument('show_id', type=int)
+@click.argument('name')
+@click.argument('price', type=float)
+@click.argument('capacity', type=int)
+def add_tier_command(show_id, name, price, capacity):
+    '''Put CAPACITY tickets called NAME on sale for SHOW_ID at PRICE.'''
+    tier = add_tier(show_id, name, round(price * 100), capacity)
+    # Holds expire on their own from now on
+    schedule_next('expire_ticket_holds')
+    db.session.commit()
+    click.echo(f'Tier {tier.id}: {capacity} x {name} at {price:.2f} over {tier.stripes} stripes')
+
+
+@tickets_cli.command('status')
+@click.argument('show_id', type=int)
+def status_command(show_id):
+    '''Seats available, held and sold per tier of SHOW_ID.'''
+    held = dict(db.session.query(TicketHold.tier_id, func.sum(TicketHold.quantity))
+                .join(TicketTier, TicketTier.id == TicketHold.tier_id)
+                .filter(TicketTier.show_id == show_id, TicketHold.status == 'held').group_by(TicketHold.tier_id))
+    sold = dict(db.session.query(TicketHold.tier_id, func.sum(TicketHold.quantity))
+                .join(TicketTier, TicketTier.id == TicketHold.tier_id)
+                .filter(TicketTier.show_id == show_id, TicketHold.status == 'purchased').group_by(TicketHold.tier_id))
+    click.echo(f"{'tier':<24}{'price':>9}{'capacity':>10}{'available':>11}{'held':>7}{'sold':>7}")
+    for tier in show_tiers(show_id):
+        click.echo(f'{tier.name[:23]:<24}{tier.price_cents / 100:>9.2f}{tier.capacity:>10}{tier.available:>11}'
+                   f'{held.get(tier.id, 0):>7}{sold.get(tier.id, 0):>7}')
+
+
+@tickets_cli.command('expire')
+def expire_command():
+    '''Return the seats of every expired hold now.'''
+    total = 0
+    while True:
+        expired = expire_holds()
+        db.session.commit()
+        if not expired:
+            break
+        total += expired
+    click.echo(f'Expired {total} holds')
@@ -0,0 +1,225 @@
+#IMPORTS
+import glob
+import http.cookiejar
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+import click
+from flask import g, request
+from flask.cli import AppGroup
+#----------------------------------------------------------------------------#
+# Traffic capture and replay.
+#
+# With TRAFFIC_CAPTURE_PATH set, every request (or a TRAFFIC_CAPTURE_SAMPLE
+# share of them) is appended to a log as one short JSON line: arrival time,
+# method, path, route, query and form fields, status and duration.  Headers
+# and cookies are never recorded, the CSRF token is dropped and the fields in
+# TRAFFIC_CAPTURE_REDACT are replaced.
+# Each worker process writes its own file, <path>.<pid>.
+#
+# `flask traffic replay` plays the logs back against a running instance with
+# the original timing (optionally sped up) and reports latency percentiles and
+# error rates per route.
+#----------------------------------------------------------------------------#
+
+def init_capture(app):
+    '''Register the capture hooks if TRAFFIC_CAPTURE_PATH is configured.'''
+    path = app.config['TRAFFIC_CAPTURE_PATH']
+    if not path:
+        return
+    sample = app.config['TRAFFIC_CAPTURE_SAMPLE']
+    redact = app.config['TRAFFIC_CAPTURE_REDACT']
+    log = {'pid': None, 'file': None}
+    lock = threading.Lock()
+
+    def log_file():
+        # Opened lazily per process, so preforked workers don't share one file
+        if log['pid'] != os.getpid():
+            log.update(pid=os.getpid(), file=open(f'{path}.{os.getpid()}', 'a', buffering=1))
+        return log['file']
+
+    @app.before_request
+    def start_capture():
+        if request.endpoint != 'static' and random.random() < sample:
+            g.capture_started = time.perf_counter()
+
+    @app.after_request
+    def capture(response):
+        started = g.pop('capture_started', None)
+        if started is None:
+            return response
+        duration = time.perf_counter() - started
+        form = {key: [redact.get(key, value) for value in values]
+                for key, values in request.form.lists() if key != 'csrf_token'}
+        record = {
+            'm': request.method,
+            'p': request.path,
+            'r': request.url_rule.rule if request.url_rule else None,
+            'q': {key: values for key, values in request.args.lists()},
+            'f': form,
+            's': response.status_code,
+            'd': round(duration * 1000, 2),
+            't': round(time.time() - duration, 3),
+        }
+        with lock:
+            log_file().write(json.dumps(record, separators=(',', ':')) + '\n')
+        return response
+
+
+def read_logs(pattern):
+    '''Every record of the log files matching pattern, in arrival order.'''
+    records = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record['t'])
+    return records
+
+
+def route_of(record):
+    return f"{record['m']} {record['r'] or record['p']}"
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] if ordered else 0.0
+
+#----------------------------------------------------------------------------#
+# Replay.
+#----------------------------------------------------------------------------#
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+    # Time the handler itself, not the page it redirects to
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"|value="([^"]+)"[^>]*name="csrf_token"')
+
+
+class Replayer:
+    '''Sends records to target from `concurrency` client threads, each with its own session.'''
+
+    def __init__(self, target, concurrency):
+        self.target = target.rstrip('/')
+        self.concurrency = concurrency
+        self.queue = queue.Queue(maxsize=concurrency * 2)
+        self.results = defaultdict(list)    # route -> [(seconds, status or None)]
+        self.lag = []
+        self.lock = threading.Lock()
+
+    def client(self):
+        opener = urllib.request.build_opener(
+            NoRedirects, urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        # Posted forms need a CSRF token that belongs to this client's session
+        try:
+            match = CSRF_TOKEN.search(opener.open(f'{self.target}/venues/create', timeout=30).read().decode())
+        except OSError:
+            match = None
+        token = (match.group(1) or match.group(2)) if match else None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            record, due = item
+            url = self.target + record['p']
+            if record['q']:
+                url += '?' + urllib.parse.urlencode(record['q'], doseq=True)
+            body = None
+            if record['m'] == 'POST':
+                form = dict(record['f'], csrf_token=[token]) if token else record['f']
+                body = urllib.parse.urlencode(form, doseq=True).encode()
+            started = time.monotonic()
+            try:
+                response = opener.open(urllib.request.Request(url, data=body, method=record['m']), timeout=30)
+                response.read()
+                status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code     # redirects land here too, as NoRedirects refuses to follow them
+            except OSError:
+                status = None
+            with self.lock:
+                self.results[route_of(record)].append((time.monotonic() - started, status))
+                self.lag.append(started - due)
+
+    def run(self, records, speed):
+        clients = [threading.Thread(target=self.client, daemon=True) for _ in range(self.concurrency)]
+        for thread in clients:
+            thread.start()
+        start, first = time.monotonic(), records[0]['t']
+        for record in records:
+            due = start + (record['t'] - first) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.queue.put((record, due))
+        for _ in clients:
+            self.queue.put(None)
+        for thread in clients:
+            thread.join()
+        return time.monotonic() - start
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+traffic_cli = AppGroup('traffic', help='Replay captured traffic.')
+
+
+@traffic_cli.command('replay')
+@click.argument('pattern')
+@click.option('--target', default='http://127.0.0.1:5000', help='Base URL of the instance to load.')
+@click.option('--speed', type=float, default=1.0, help='Play the log this many times faster than it was captured.')
+@click.option('--concurrency', type=int, default=8, help='Concurrent client connections.')
+@click.option('--limit', type=int, default=None, help='Replay only the first N requests.')
+def replay_command(pattern, target, speed, concurrency, limit):
+    '''Replay the capture logs matching PATTERN (e.g. "traffic.log.*") against --target.
+
+    Every client starts its own session.  The target rate-limits per client
+    address, so raise RATE_LIMITS there when replaying faster than real time.
+    '''
+    records = read_logs(pattern)[:limit]
+    if not records:
+        raise click.ClickException(f'No requests in {pattern}')
+    captured = defaultdict(list)
+    for record in records:
+        captured[route_of(record)].append(record['d'] / 1000)
+
+    replayer = Replayer(target, concurrency)
+    elapsed = replayer.run(records, speed)
+
+    click.echo(f'{len(records)} requests in {elapsed:.1f}s ({len(records) / elapsed:.1f} req/s), '
+               f'schedule lag p99 {percentile(replayer.lag, 0.99) * 1000:.0f} ms')
+    click.echo(f"{'route':<45}{'count':>7}{'errors':>8}{'4xx':>6}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'captured p50':>14}")
+    for route in sorted(replayer.results, key=lambda route: -len(replayer.results[route])):
+        results = replayer.results[route]
+        latencies = [seconds * 1000 for seconds, _ in results]
+        errors = sum(1 for _, status in results if status is None or status >= 500)
+        client_errors = sum(1 for _, status in results if status is not None and 400 <= status < 500)
+        click.echo(f'{route[:44]:<45}{len(results):>7}{errors / len(results):>8.1%}{client_errors:>6}'
+                   f'{percentile(latencies, 0.5):>9.1f}{percentile(latencies, 0.9):>9.1f}'
+                   f'{percentile(latencies, 0.99):>9.1f}{max(latencies):>9.1f}'
+                   f'{percentile(captured[route], 0.5) * 1000:>14.1f}')
+
+
+@traffic_cli.command('summary')
+@click.argument('pattern')
+def summary_command(pattern):
+    '''Requests per route in the capture logs matching PATTERN.'''
+    records = read_logs(pattern)
+    routes = defaultdict(list)
+    for record in records:
+        routes[route_of(record)].append(record['d'])
+    span = records[-1]['t'] - records[0]['t'] if records else 0
+    click.echo(f'{len(records)} requests over {span:.0f}s')
+    for route, durations in sorted(routes.items(), key=lambda item: -len(item[1])):
+        click.echo(f'{route[:44]:<45}{len(durations):>7}  p50 {percentile(durations, 0.5):>8.1f} ms  '
+                   f'p99 {percentile(durations, 0.99):>8.1f} ms')
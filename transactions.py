@@ -0,0 +1,168 @@
+#IMPORTS
+import functools
+import os
+import random
+import threading
+import time
+from collections import Counter
+from flask import current_app
+from sqlalchemy.exc import DBAPIError
+from models import db
+#----------------------------------------------------------------------------#
+# Units of work.
+#
+# A write handler puts its database work in a function decorated with
+# @transactional(name).  Calling it runs the function and commits the
+# transaction; any exception rolls it back and is re-raised for
+# the handler to turn into a message.  Serialization failures, deadlocks,
+# lock timeouts and dropped connections are different: running the same work
+# again will most likely succeed.  They are retried up to
+# TRANSACTION_RETRIES times, sleeping a random time below an exponentially
+# growing cap in between ("full jitter"), so the retrying writers don't
+# collide again in lockstep.  The session is closed in every case.
+# A connection that drops during the COMMIT is not retried: the transaction
+# may have been committed, and running the work again could do it twice.
+#
+# The work function may run more than once, so it must only touch the
+# database (and build values from its arguments): no flash() or other side
+# effects inside it.
+#
+# Counts of commits, retries and failures per unit are kept per process and
+# served as JSON at /metrics/transactions, to requests bearing METRICS_TOKEN.
+#----------------------------------------------------------------------------#
+
+# PostgreSQL SQLSTATEs worth a retry
+TRANSIENT_SQLSTATES = {
+    '40001': 'serialization failure',
+    '40P01': 'deadlock',
+    '55P03': 'lock timeout',
+}
+
+
+def conflict_kind(error):
+    '''What kind of transient conflict an exception is, or None if running the work again can't help.'''
+    if not isinstance(error, DBAPIError):
+        return None
+    if error.connection_invalidated:
+        return 'disconnect'
+    code = getattr(error.orig, 'pgcode', None)
+    if code in TRANSIENT_SQLSTATES:
+        return TRANSIENT_SQLSTATES[code]
+    # SQLite's answer to two writers upgrading their locks at the same time
+    if 'database is locked' in str(error.orig):
+        return 'database locked'
+    return None
+
+
+class TransactionMetrics:
+    '''Per-unit counters of this process.'''
+
+    def __init__(self):
+        self._units = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, event, kind=None):
+        with self._lock:
+            counters = self._units.setdefault(name, Counter())
+            counters[event] += 1
+            if kind is not None:
+                counters[f'{event}: {kind}'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {'pid': os.getpid(), 'units': {name: dict(counters) for name, counters in sorted(self._units.items())}}
+
+
+metrics = TransactionMetrics()
+
+
+def backoff(attempt):
+    '''Seconds to wait before retry number `attempt` (1, 2, ...).'''
+    cap = min(current_app.config['TRANSACTION_RETRY_MAX_DELAY'],
+              current_app.config['TRANSACTION_RETRY_BASE_DELAY'] * 2 ** (attempt - 1))
+    return random.uniform(0, cap)
+
+
+def set_isolation(level):
+    dialect = db.engine.dialect.name
+    if level and dialect == 'postgresql':
+        # The level can only be set before the transaction's first statement, so end whatever
+        # the handler read before; the pool resets the level when the connection is returned
+        db.session.close()
+        db.session.connection(execution_options={'isolation_level': level})
+    elif level == 'SERIALIZABLE' and dialect == 'sqlite':
+        # pysqlite only opens the transaction at the first write, after the reads it depends
+        # on; take the write lock up front instead, other writers wait for it
+        db.session.close()
+        db.session.execute('BEGIN IMMEDIATE')
+
+
+def run_in_transaction(name, work, isolation=None, retries=None):
+    '''Run work() as one transaction and commit; returns what work() returned.'''
+    retries = current_app.config['TRANSACTION_RETRIES'] if retries is None else retries
+    isolation = isolation or current_app.config['TRANSACTION_ISOLATION']
+    attempt = 0
+    try:
+        while True:
+            committing = False
+            try:
+                set_isolation(isolation)
+                result = work()
+                committing = True
+                db.session.commit()
+                metrics.count(name, 'commits')
+                return result
+            except Exception as e:
+                db.session.rollback()
+                kind = conflict_kind(e)
+                if kind is None or (kind == 'disconnect' and committing):
+                    metrics.count(name, 'errors', type(e).__name__)
+                    raise
+                metrics.count(name, 'conflicts', kind)
+                attempt += 1
+                if attempt > retries:
+                    metrics.count(name, 'gave up')
+                    current_app.logger.warning(f'{name}: gave up after {retries} retries ({kind})')
+                    raise
+                metrics.count(name, 'retries')
+                time.sleep(backoff(attempt))
+    finally:
+        db.session.close()
+
+
+def transactional(name, isolation=None, retries=None):
+    '''Decorator: every call of the function is a unit of work (see run_in_transaction()).
+
+    isolation is an isolation level for PostgreSQL, e.g. 'SERIALIZABLE'
+    (default TRANSACTION_ISOLATION); retries overrides TRANSACTION_RETRIES.
+    '''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            return run_in_transaction(name, lambda: fn(*args, **kwargs), isolation, retries)
+        return run
+    return decorate
+
+
+class savepoint:
+    '''Context manager for one step of a batch inside a unit of work.
+
+    The step's statements are rolled back to the savepoint if it raises, and
+    the exception propagates; the rest of the transaction stays intact, so a
+    batch can skip the steps that fail and commit the others.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.transaction = db.session.begin_nested()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is None:
+            self.transaction.commit()
+            return False
+        self.transaction.rollback()
+        metrics.count(self.name, 'savepoint rollbacks', error_type.__name__)
+        return False
@@ -0,0 +1,143 @@
+#IMPORTS
+import bisect
+import json
+import threading
+import time
+from flask import current_app
+from models import db, Venue, Artist
+from changes import latest_position, read_changes
+#----------------------------------------------------------------------------#
+# Name autocomplete from an in-memory prefix index.
+#
+# Each worker keeps sorted lists of (lower-case key, id): one of the whole
+# names and one of every later word suffix of every active venue and artist
+# name, so 'hop' finds "The Musical Hop".  A lookup is a bisect into each
+# list plus a scan that stops after `limit` matches.  The index is built on
+# first use and then follows the change feed (changes.py), so writes made
+# through any worker show up everywhere within TYPEAHEAD_REFRESH_INTERVAL.
+#----------------------------------------------------------------------------#
+
+def name_keys(name):
+    '''(the whole name, {the name from each later word on}), in lower case.'''
+    words = name.lower().split()
+    return ' '.join(words), {' '.join(words[start:]) for start in range(1, len(words))}
+
+
+class PrefixIndex:
+
+    def __init__(self):
+        self._whole = []    # sorted [(whole name key, id)]
+        self._inner = []    # sorted [(later-word key, id)]
+        self._names = {}    # id -> name
+        self._lock = threading.Lock()
+
+    def build(self, rows):
+        '''Replace the contents with [(id, name)].'''
+        keyed = [(id, name_keys(name)) for id, name in rows]
+        whole = sorted((key, id) for id, (key, _) in keyed)
+        inner = sorted((key, id) for id, (_, keys) in keyed for key in keys)
+        with self._lock:
+            self._whole, self._inner = whole, inner
+            self._names = dict(rows)
+
+    def add(self, id, name):
+        with self._lock:
+            self._discard(id)
+            self._names[id] = name
+            whole, inner = name_keys(name)
+            bisect.insort(self._whole, (whole, id))
+            for key in inner:
+                bisect.insort(self._inner, (key, id))
+
+    def remove(self, id):
+        with self._lock:
+            self._discard(id)
+
+    def _discard(self, id):
+        name = self._names.pop(id, None)
+        if name is not None:
+            whole, inner = name_keys(name)
+            for keys, key in [(self._whole, whole)] + [(self._inner, key) for key in inner]:
+                position = bisect.bisect_left(keys, (key, id))
+                if position < len(keys) and keys[position] == (key, id):
+                    del keys[position]
+
+    @staticmethod
+    def _scan(keys, prefix, limit, found):
+        # Stops at limit matches, so a one-letter prefix costs as little as a long one
+        position = bisect.bisect_left(keys, (prefix,))
+        while position < len(keys) and len(found) < limit:
+            key, id = keys[position]
+            if not key.startswith(prefix):
+                break
+            found.setdefault(id)
+            position += 1
+
+    def search(self, prefix, limit):
+        '''[(id, name)] of up to limit names with a word starting with prefix; whole-name matches first.'''
+        prefix = ' '.join(prefix.lower().split())
+        if not prefix:
+            return []
+        found = {}      # ids in match order
+        with self._lock:
+            self._scan(self._whole, prefix, limit, found)
+            self._scan(self._inner, prefix, limit, found)
+            return [(id, self._names[id]) for id in found]
+
+
+class ListingIndex:
+    '''A PrefixIndex of one model's active names, kept current from the change feed.'''
+
+    refresh_setting = 'TYPEAHEAD_REFRESH_INTERVAL'
+    rebuild_setting = 'TYPEAHEAD_REBUILD_INTERVAL'
+
+    def __init__(self, model, entity):
+        self.model = model
+        self.entity = entity
+        self.index = PrefixIndex()
+        self.cursor = None          # position of the last ChangeEvent applied; None until built
+        self.refreshed_at = 0.0
+        self.rebuilt_at = 0.0
+        self._lock = threading.Lock()
+
+    def rebuild(self):
+        cursor = latest_position()
+        self.index.build(db.session.query(self.model.id, self.model.name)
+                         .filter(self.model.archived_at.is_(None)).all())
+        self.cursor = cursor
+
+    def refresh(self):
+        for position, _, entity_id, op, data, _ in read_changes(self.cursor, entity=self.entity):
+            self.apply(entity_id, op, json.loads(data))
+            self.cursor = position
+
+    def apply(self, entity_id, op, data):
+        if op in ('archive', 'delete'):
+            self.index.remove(entity_id)
+        elif data.get('name') is not None:
+            self.index.add(entity_id, data['name'])
+
+    def current(self):
+        '''Bring the index up to date if it is due, and return it.'''
+        refresh_interval = current_app.config[self.refresh_setting]
+        now = time.monotonic()
+        # One thread refreshes; the others answer from the index as it is (or wait for the first build)
+        if now - self.refreshed_at > refresh_interval and self._lock.acquire(blocking=self.cursor is None):
+            try:
+                if self.cursor is None or now - self.rebuilt_at > current_app.config[self.rebuild_setting]:
+                    # Also picks up writes made without a change event (e.g. by hand in the database)
+                    self.rebuild()
+                    self.rebuilt_at = now
+                elif now - self.refreshed_at > refresh_interval:
+                    self.refresh()
+                self.refreshed_at = now
+            finally:
+                self._lock.release()
+        return self.index
+
+    def search(self, prefix, limit):
+        return self.current().search(prefix, limit)
+
+
+venue_names = ListingIndex(Venue, 'venue')
+artist_names = ListingIndex(Artist, 'artist')
@@ -0,0 +1,191 @@
+#IMPORTS
+from datetime import datetime
+from sqlalchemy import or_
+from models import db, Genre, Venue, Show, ShowArchive, TicketTier, TicketStock, TicketHold
+from areas import bump_area
+from changes import record_change, record_changes
+#----------------------------------------------------------------------------#
+# Write helpers shared by the create/edit/delete controllers.
+#----------------------------------------------------------------------------#
+
+class StaleEditError(Exception):
+    '''The row was edited (or deleted) by someone else after the form was loaded.'''
+
+
+class TicketsSoldError(Exception):
+    '''The listing has shows with purchased tickets, so it can't be deleted (archive it instead).'''
+
+
+def resolve_genre_ids(names):
+    '''Map genre names to Genre ids, creating any that don't exist yet.
+
+    One SELECT for the known genres and one multi-row INSERT for the new ones,
+    instead of a query per genre.
+    '''
+    names = list(dict.fromkeys(names))  # drop duplicates, keep order
+    if not names:
+        return []
+    found = dict(db.session.query(Genre.name, Genre.id).filter(Genre.name.in_(names)).all())
+    missing = [name for name in names if name not in found]
+    if missing:
+        db.session.execute(Genre.__table__.insert(), [{'name': name} for name in missing])
+        found.update(db.session.query(Genre.name, Genre.id).filter(Genre.name.in_(missing)).all())
+    return [found[name] for name in names]
+
+
+def update_listing(model, genre_table, fk_name, obj_id, version, values, genres):
+    '''Apply an edit form to a Venue/Artist row without loading the entity.
+
+    Only the columns whose value actually changed go into a single UPDATE, and
+    only the genre links that were added or removed are written.  The UPDATE is
+    guarded by the row version so two people editing the same listing can't
+    silently overwrite each other; StaleEditError is raised instead.
+
+    Returns the previously stored column values if anything was written,
+    otherwise None.
+    '''
+    columns = [getattr(model, key) for key in values]
+    current = db.session.query(model.version, *columns).filter(model.id == obj_id).one_or_none()
+    if current is None or (version is not None and current.version != version):
+        raise StaleEditError(obj_id)
+
+    changes = {key: value for key, value in values.items() if getattr(current, key) != value}
+
+    # Genre association delta: compare the stored links with the submitted names
+    fk = genre_table.c[fk_name]
+    stored_ids = {genre_id for (genre_id,) in db.session.query(genre_table.c.genre_id).filter(fk == obj_id)}
+    wanted_ids = set(resolve_genre_ids(genres))
+    removed = stored_ids - wanted_ids
+    added = wanted_ids - stored_ids
+
+    if not (changes or removed or added):
+        return None
+
+    # Bump the version even when only genres changed, so concurrent edits still conflict
+    changes['version'] = current.version + 1
+    updated = model.query.filter(model.id == obj_id, model.version == current.version) \
+        .update(changes, synchronize_session=False)
+    if updated != 1:
+        raise StaleEditError(obj_id)
+
+    if removed:
+        db.session.execute(genre_table.delete().where(fk == obj_id).where(genre_table.c.genre_id.in_(removed)))
+    if added:
+        db.session.execute(genre_table.insert(), [{'genre_id': genre_id, fk_name: obj_id} for genre_id in added])
+    return current
+
+
+def listing_show_ids(fk_name, obj_id):
+    '''Query of the ids of a Venue's/Artist's shows, current and archived.'''
+    return db.session.query(Show.id).filter(getattr(Show, fk_name) == obj_id) \
+        .union_all(db.session.query(ShowArchive.id).filter(getattr(ShowArchive, fk_name) == obj_id))
+
+
+def check_no_tickets_sold(show_ids):
+    '''Raise TicketsSoldError if any of the shows (a list or query of ids) has purchased tickets.'''
+    if db.session.query(TicketHold.id).join(TicketTier, TicketTier.id == TicketHold.tier_id) \
+            .filter(TicketTier.show_id.in_(show_ids), TicketHold.status == 'purchased').first() is not None:
+        raise TicketsSoldError(show_ids)
+
+
+def delete_show_tickets(show_ids):
+    '''Delete the ticket tiers of the shows with their stock and holds.
+
+    TicketTier.show_id has no foreign key to Show (see models.py), so nothing
+    cascades: whoever deletes shows deletes their tickets first.
+    '''
+    tier_ids = db.session.query(TicketTier.id).filter(TicketTier.show_id.in_(show_ids))
+    TicketHold.query.filter(TicketHold.tier_id.in_(tier_ids)).delete(synchronize_session=False)
+    TicketStock.query.filter(TicketStock.tier_id.in_(tier_ids)).delete(synchronize_session=False)
+    TicketTier.query.filter(TicketTier.show_id.in_(show_ids)).delete(synchronize_session=False)
+
+
+def delete_listing(model, genre_table, fk_name, obj_id):
+    '''Delete a Venue/Artist together with its shows, their tickets and its genre links.
+
+    A few set-based DELETEs instead of loading every Show into the session
+    and deleting them one by one.  The foreign keys also carry ON DELETE
+    CASCADE, so the child DELETEs are only a formality on PostgreSQL.
+    Raises TicketsSoldError, before deleting anything, if tickets to any of
+    the shows were bought.
+    '''
+    show_ids = listing_show_ids(fk_name, obj_id)
+    check_no_tickets_sold(show_ids)
+    delete_show_tickets(show_ids)
+    Show.query.filter(getattr(Show, fk_name) == obj_id).delete(synchronize_session=False)
+    ShowArchive.query.filter(getattr(ShowArchive, fk_name) == obj_id).delete(synchronize_session=False)
+    db.session.execute(genre_table.delete().where(genre_table.c[fk_name] == obj_id))
+    return model.query.filter(model.id == obj_id).delete(synchronize_session=False)
+
+
+def archive_listing(model, obj_id):
+    '''Soft-delete a Venue/Artist: hide it from listings but keep its show history.'''
+    return model.query.filter(model.id == obj_id, model.archived_at.is_(None)) \
+        .update({'archived_at': datetime.utcnow(), 'version': model.version + 1}, synchronize_session=False)
+
+
+def delete_listing_in_batches(model, genre_table, fk_name, obj_id, batch_size=1000):
+    '''Like delete_listing(), but removes the shows in short committed batches
+    so a listing with years of history never holds one long lock.
+    '''
+    check_no_tickets_sold(listing_show_ids(fk_name, obj_id))
+    fk = getattr(Show, fk_name)
+    while True:
+        ids = [show_id for (show_id,) in db.session.query(Show.id).filter(fk == obj_id).limit(batch_size)]
+        if not ids:
+            break
+        delete_show_tickets(ids)
+        Show.query.filter(Show.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+    delete_listing(model, genre_table, fk_name, obj_id)
+    record_change(model.__name__.lower(), obj_id, 'delete')
+    db.session.commit()
+
+
+def book_tour(artist_id, stops, all_or_nothing, dry_run=False):
+    '''Book many shows for one artist: one query for the venues, one for clashing
+    shows, then a single multi-row INSERT.
+
+    stops is a list of (label, venue_id, start_time).  Returns (booked, rejected)
+    where rejected is a list of (label, reason).  With all_or_nothing nothing is
+    booked unless every stop can be; with dry_run the stops are only checked.
+    '''
+    venue_ids = {venue_id for _, venue_id, _ in stops}
+    start_times = {start_time for _, _, start_time in stops}
+    areas = {venue_id: (city, state) for venue_id, city, state in
+             db.session.query(Venue.id, Venue.city, Venue.state)
+             .filter(Venue.id.in_(venue_ids), Venue.archived_at.is_(None))}
+    clashes = db.session.query(Show.artist_id, Show.venue_id, Show.start_time) \
+        .filter(Show.start_time.in_(start_times),
+                or_(Show.artist_id == artist_id, Show.venue_id.in_(venue_ids))).all()
+    artist_busy = {start_time for show_artist_id, _, start_time in clashes if show_artist_id == artist_id}
+    venue_busy = {(venue_id, start_time) for _, venue_id, start_time in clashes}
+
+    booked, rejected = [], []
+    for label, venue_id, start_time in stops:
+        if venue_id not in areas:
+            rejected.append((label, f'no venue {venue_id}'))
+        elif start_time in artist_busy:
+            rejected.append((label, 'the artist already plays a show at that time'))
+        elif (venue_id, start_time) in venue_busy:
+            rejected.append((label, 'the venue already has a show at that time'))
+        else:
+            # Later stops in the same tour can clash with this one too
+            artist_busy.add(start_time)
+            venue_busy.add((venue_id, start_time))
+            booked.append((label, venue_id, start_time))
+
+    if dry_run or not booked or (rejected and all_or_nothing):
+        return [], rejected
+    db.session.execute(Show.__table__.insert().values([
+        {'artist_id': artist_id, 'venue_id': venue_id, 'start_time': start_time}
+        for _, venue_id, start_time in booked
+    ]))
+    for area in {areas[venue_id] for _, venue_id, _ in booked}:
+        bump_area(*area)
+    # The multi-row INSERT doesn't hand back ids; an artist has one show per start time
+    show_ids = db.session.query(Show.id, Show.venue_id, Show.start_time) \
+        .filter(Show.artist_id == artist_id, Show.start_time.in_({start_time for _, _, start_time in booked}))
+    record_changes([('show', show_id, 'create', {'artist_id': artist_id, 'venue_id': venue_id, 'start_time': start_time})
+                    for show_id, venue_id, start_time in show_ids])
+    return booked, rejected